@@ -1,5 +1,6 @@
 """Common Nuxeo Automation client utilities."""
 
+import os
 import sys
 import base64
 import json
@@ -9,11 +10,13 @@ import random
 import time
 import urllib
 from urllib import urlencode
+from cStringIO import StringIO
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from nxdrive.logging_config import get_logger
 from nxdrive.client.common import DEFAULT_IGNORED_PREFIXES
 from nxdrive.client.common import DEFAULT_IGNORED_SUFFIXES
+from nxdrive.client.connection_pool import build_keep_alive_handlers
 
 
 log = get_logger(__name__)
@@ -39,6 +42,85 @@ class Unauthorized(Exception):
                 " the provided credentials" % (self.user_id, self.server_url))
 
 
+class MultipartBody(object):
+    """File-like HTTP request body made of byte strings and file objects
+
+    The file objects are read chunk by chunk while the request is sent so
+    that the memory usage does not depend on the size of the uploaded
+    files. The total length is computed up front so that urllib2 can set the
+    Content-Length header.
+    """
+
+    def __init__(self, parts):
+        self._parts = []
+        self._length = 0
+        for part in parts:
+            if isinstance(part, str):
+                part = StringIO(part)
+            start = part.tell()
+            size = _get_size(part) - start
+            self._parts.append((part, start, size))
+            self._length += size
+        self._index = 0
+        self._remaining = self._parts[0][2] if self._parts else 0
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        chunks = []
+        while self._index < len(self._parts) and size != 0:
+            part = self._parts[self._index][0]
+            if size < 0:
+                to_read = self._remaining
+            else:
+                to_read = min(size, self._remaining)
+            chunk = part.read(to_read) if to_read > 0 else ''
+            if not chunk:
+                if self._remaining > 0:
+                    raise IOError("%d bytes missing in %r, was it truncated"
+                                  " while uploading?" % (self._remaining,
+                                                         part))
+                self._next_part()
+                continue
+            self._remaining -= len(chunk)
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return ''.join(chunks)
+
+    def _next_part(self):
+        self._index += 1
+        if self._index < len(self._parts):
+            self._remaining = self._parts[self._index][2]
+
+    def seek(self, offset, whence=0):
+        """Rewind the body to resend it, only offset 0 is supported"""
+        if offset != 0 or whence != 0:
+            raise ValueError("MultipartBody can only be rewound")
+        for part, start, _ in self._parts:
+            part.seek(start)
+        self._index = 0
+        self._remaining = self._parts[0][2] if self._parts else 0
+
+
+def _get_size(file_object):
+    """Total size of the content of a file-like object"""
+    if hasattr(file_object, '__len__'):
+        return len(file_object)
+    if hasattr(file_object, 'fileno'):
+        try:
+            return os.fstat(file_object.fileno()).st_size
+        except (AttributeError, IOError):
+            # cStringIO objects do not have any file descriptor
+            pass
+    position = file_object.tell()
+    file_object.seek(0, os.SEEK_END)
+    size = file_object.tell()
+    file_object.seek(position)
+    return size
+
+
 class BaseAutomationClient(object):
     """Client for the Nuxeo Content Automation HTTP API
 
@@ -48,6 +130,9 @@ class BaseAutomationClient(object):
     blob_timeout is long (or infinite) timeout dedicated to long HTTP
     requests involving a blob transfer.
 
+    connection_pool is an optional ConnectionPool to reuse the HTTP
+    connections across requests and clients.
+
     """
 
     # Used for testing network errors
@@ -61,7 +146,7 @@ class BaseAutomationClient(object):
     def __init__(self, server_url, user_id, device_id,
                  password=None, token=None, repository="default",
                  ignored_prefixes=None, ignored_suffixes=None,
-                 timeout=10, blob_timeout=None):
+                 timeout=10, blob_timeout=None, connection_pool=None):
         self.timeout = timeout
         self.blob_timeout = blob_timeout
         if ignored_prefixes is not None:
@@ -86,7 +171,11 @@ class BaseAutomationClient(object):
         self._update_auth(password=password, token=token)
 
         cookie_processor = urllib2.HTTPCookieProcessor()
-        self.opener = urllib2.build_opener(cookie_processor)
+        handlers = [cookie_processor]
+        self.connection_pool = connection_pool
+        if connection_pool is not None:
+            handlers.extend(build_keep_alive_handlers(connection_pool))
+        self.opener = urllib2.build_opener(*handlers)
         self.automation_url = server_url + 'site/automation/'
 
         self.fetch_api()
@@ -171,6 +260,11 @@ class BaseAutomationClient(object):
             return s
 
     def execute_with_blob(self, command, blob_content, filename, **params):
+        """Execute an operation with a blob as input
+
+        blob_content is either a byte string or a file-like object that is
+        streamed while sending the request.
+        """
         self._check_params(command, None, params)
 
         container = MIMEMultipart("related",
@@ -199,7 +293,8 @@ class BaseAutomationClient(object):
         content_disposition = ("attachment; filename*=UTF-8''%s"
                                 % quoted_filename)
         blob_part.add_header("Content-Disposition", content_disposition)
-        blob_part.set_payload(blob_content)
+        # The payload is streamed: only generate the headers of the part
+        blob_part.set_payload('')
         container.attach(blob_part)
 
         # Create data by hand :(
@@ -214,25 +309,21 @@ class BaseAutomationClient(object):
         }
         headers.update(self._get_common_headers())
 
-        # TODO: find a way to stream the parts without loading them all in
-        # memory as a byte string
-
-        # The code http://atlee.ca/software/poster/ might provide some
-        # guidance to implement this although it cannot be reused directly
-        # as we need tighter control on the headers of the multipart
-        data = (
+        # Only the JSON part and the headers of the blob part are generated
+        # in memory, the blob content is read when sending the request
+        head = (
             "--%s\r\n"
             "%s\r\n"
             "--%s\r\n"
-            "%s\r\n"
-            "--%s--"
+            "%s"
         ) % (
             boundary,
             json_part.as_string(),
             boundary,
             blob_part.as_string(),
-            boundary,
         )
+        tail = "\r\n--%s--" % boundary
+        data = MultipartBody([head, blob_content, tail])
         url = self.automation_url.encode('ascii') + command
         log.trace("Calling '%s' for file '%s'", url, filename)
         req = urllib2.Request(url, data, headers)
@@ -0,0 +1,318 @@
+"""Persistent HTTP connections shared by the Automation clients.
+
+The default urllib2 handlers open a new TCP (and TLS) connection for each
+request and close it as soon as the response is read. The handlers of this
+module keep the connections alive in a pool shared by the clients of a
+server binding, whatever their thread, so that consecutive requests reuse
+the same sockets.
+"""
+
+import errno
+import httplib
+import select
+import socket
+import time
+import urllib2
+from threading import Lock
+
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Requests that can safely be sent again once the server may have received
+# them, see RFC 7231 section 4.2.2
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS',
+                                'TRACE'])
+
+# Errors of a connection closed by the server while idle
+CONNECTION_CLOSED_ERRNOS = frozenset([errno.ECONNRESET, errno.ECONNABORTED,
+                                      errno.EPIPE])
+
+
+class ConnectionPool(object):
+    """Thread safe pool of idle HTTP connections, by scheme and host
+
+    At most max_idle connections are kept per host. Connections idle for
+    more than idle_timeout seconds are closed instead of being reused as
+    the server has most probably dropped them.
+    """
+
+    def __init__(self, max_idle=4, idle_timeout=15):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = Lock()
+        self.created = 0
+        self.reused = 0
+        self.retried = 0
+        self.discarded = 0
+
+    def get(self, key, connection_factory):
+        """Return a (connection, reused) tuple for the provided key"""
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                connection, released = idle.pop()
+                if now - released < self.idle_timeout:
+                    self.reused += 1
+                    return connection, True
+                self.discarded += 1
+                connection.close()
+            self.created += 1
+        return connection_factory(), False
+
+    def release(self, key, connection):
+        """Make a connection with a fully read response available again"""
+        if connection.sock is None:
+            # Closed by the server (Connection: close or HTTP/1.0)
+            self.discard(connection)
+            return
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((connection, time.time()))
+                return
+            self.discarded += 1
+        connection.close()
+
+    def discard(self, connection):
+        with self._lock:
+            self.discarded += 1
+        connection.close()
+
+    def retry(self, key, connection):
+        """Discard a stale connection along with the idle ones of its host"""
+        with self._lock:
+            self.retried += 1
+            idle = self._idle.pop(key, [])
+            self.discarded += len(idle) + 1
+        connection.close()
+        for idle_connection, _ in idle:
+            idle_connection.close()
+
+    def close(self):
+        """Close all the idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, _ in connections:
+                connection.close()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'retried': self.retried,
+                'discarded': self.discarded,
+                'idle': sum(len(c) for c in self._idle.values()),
+            }
+
+
+class PooledResponse(object):
+    """File-like wrapper releasing the connection once the body is read"""
+
+    def __init__(self, response, release, discard):
+        self._response = response
+        self._release = release
+        self._discard = discard
+        self._done = False
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        self._check_done()
+        return data
+
+    def readline(self, limit=-1):
+        # Rarely used: fallback to byte by byte reads
+        chars = []
+        while limit < 0 or len(chars) < limit:
+            c = self.read(1)
+            if not c:
+                break
+            chars.append(c)
+            if c == '\n':
+                break
+        return ''.join(chars)
+
+    def readlines(self, sizehint=0):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def _check_done(self):
+        if not self._done and self._response.isclosed():
+            self._done = True
+            self._release()
+
+    def close(self):
+        if self._done:
+            return
+        self._done = True
+        # The connection cannot be reused without reading the whole body
+        self._response.close()
+        self._discard()
+
+
+class KeepAliveHandlerMixin(object):
+    """Open urllib2 requests with the connections of a pool"""
+
+    connection_class = None
+
+    def __init__(self, pool, debuglevel=0):
+        self._pool = pool
+        self._debuglevel = debuglevel
+
+    def _open(self, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        key = (self.connection_class, host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items()
+                       if k not in headers)
+        headers = dict((name.title(), val) for name, val in headers.items())
+        tunnel_host = getattr(req, '_tunnel_host', None)
+        if tunnel_host:
+            tunnel_headers = {}
+            auth_header = "Proxy-Authorization"
+            if auth_header in headers:
+                tunnel_headers[auth_header] = headers.pop(auth_header)
+
+        timeout = req.timeout
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+
+        def new_connection():
+            connection = self.connection_class(host, timeout=timeout)
+            connection.set_debuglevel(self._debuglevel)
+            if tunnel_host:
+                connection.set_tunnel(tunnel_host, headers=tunnel_headers)
+            return connection
+
+        while True:
+            connection, reused = self._pool.get(key, new_connection)
+            if reused:
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                if _is_dropped(connection):
+                    # Closed by the server while idle: do not even try to
+                    # send the request on it
+                    log.trace("Discarding connection to %s closed by the"
+                              " server", host)
+                    self._pool.retry(key, connection)
+                    continue
+            sent = False
+            try:
+                connection.request(req.get_method(), req.get_selector(),
+                                   req.data, headers)
+                sent = True
+                response = connection.getresponse()
+            except (socket.error, httplib.HTTPException) as e:
+                if reused and self._can_resend(req, e, sent):
+                    # The server has closed the idle connection in the mean
+                    # time: retry with a new connection
+                    log.trace("Retrying request to %s on a new connection"
+                              " after error on reused one: %r", host, e)
+                    self._pool.retry(key, connection)
+                    continue
+                self._pool.discard(connection)
+                raise urllib2.URLError(e)
+            break
+
+        fp = PooledResponse(
+            response,
+            lambda: self._pool.release(key, connection),
+            lambda: self._pool.discard(connection))
+        if response.isclosed():
+            # Empty body (e.g. HEAD requests or 204 responses)
+            fp._check_done()
+        resp = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+    def _can_resend(self, req, error, sent):
+        """Check whether a request failing on a reused connection can be sent
+        again on a new one
+
+        The server may still be processing a request that has timed out. Once
+        the request is sent, only idempotent requests are sent again, and
+        only if the connection was closed before any byte of the response.
+        """
+        if isinstance(error, socket.timeout):
+            return False
+        if sent and (req.get_method() not in IDEMPOTENT_METHODS
+                     or not _is_closed_before_response(error)):
+            return False
+        return self._rewind(req)
+
+    def _rewind(self, req):
+        """Prepare the body of a request to be sent again if possible"""
+        data = req.data
+        if data is None or isinstance(data, basestring):
+            return True
+        if hasattr(data, 'seek'):
+            data.seek(0)
+            return True
+        return False
+
+
+def _is_dropped(connection):
+    """Check whether an idle connection has been closed by the server
+
+    No data is expected on an idle connection: if its socket is readable,
+    the server has closed it (or sent garbage) and it cannot be reused.
+    """
+    if connection.sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([connection.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+def _is_closed_before_response(error):
+    """Check whether an error means that no byte of the response was read"""
+    if isinstance(error, httplib.BadStatusLine):
+        # Empty status line, the message depends on the Python version
+        return (not error.line
+                or error.line.startswith("No status line received"))
+    return (isinstance(error, socket.error)
+            and error.errno in CONNECTION_CLOSED_ERRNOS)
+
+
+class KeepAliveHandler(KeepAliveHandlerMixin, urllib2.HTTPHandler):
+
+    connection_class = httplib.HTTPConnection
+
+    def __init__(self, pool, debuglevel=0):
+        urllib2.HTTPHandler.__init__(self, debuglevel)
+        KeepAliveHandlerMixin.__init__(self, pool, debuglevel)
+
+    def http_open(self, req):
+        return self._open(req)
+
+
+class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
+
+    connection_class = httplib.HTTPSConnection
+
+    def __init__(self, pool, debuglevel=0):
+        urllib2.HTTPSHandler.__init__(self, debuglevel)
+        KeepAliveHandlerMixin.__init__(self, pool, debuglevel)
+
+    def https_open(self, req):
+        return self._open(req)
+
+
+def build_keep_alive_handlers(pool):
+    """urllib2 handlers to pass to build_opener to reuse connections"""
+    return [KeepAliveHandler(pool), KeepAliveHTTPSHandler(pool)]
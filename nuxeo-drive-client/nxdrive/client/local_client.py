@@ -3,8 +3,11 @@
 from datetime import datetime
 import hashlib
 import os
+import sys
 import shutil
 import re
+import stat
+import time
 from nxdrive.logging_config import get_logger
 from nxdrive.client.common import NotFound
 from nxdrive.client.common import DEFAULT_IGNORED_PREFIXES
@@ -19,6 +22,13 @@ log = get_logger(__name__)
 
 DEDUPED_BASENAME_PATTERN = r'^(.*)__(\d{1,3})$'
 
+try:
+    # Optional backport of the Python 3.5 os.scandir: the directory entries
+    # carry their type and, under Windows, their stat info for free
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
 
 def safe_filename(name, replacement='-'):
     """Replace invalid character in candidate filename"""
@@ -31,7 +41,7 @@ class FileInfo(object):
     """Data Transfer Object for file info on the Local FS"""
 
     def __init__(self, root, path, folderish, last_modification_time,
-                 digest_func='md5'):
+                 digest_func='md5', stat_info=None, digest_cache=None):
         self.root = root  # the sync root folder local path
         self.path = path  # the truncated path (under the root)
         self.folderish = folderish  # True if a Folder
@@ -42,6 +52,12 @@ class FileInfo(object):
         # Function to use
         self._digest_func = digest_func.lower()
 
+        # Raw OS stat info used to reuse the digests of unchanged files
+        self._stat_info = stat_info
+        self._digest_cache = digest_cache
+        self._digest = None
+        self._digest_future = None
+
         # Precompute base name once and for all are it's often useful in
         # practice
         self.name = os.path.basename(path)
@@ -50,12 +66,50 @@ class FileInfo(object):
             root, path[1:].replace('/', os.path.sep))
 
     def get_digest(self):
-        """Lazy computation of the digest"""
+        """Lazy computation of the digest
+
+        The digest is computed at most once per info instance and is reused
+        from the digest cache if the file has not changed since it was last
+        computed.
+        """
         if self.folderish:
             return None
+        if self._digest is None:
+            digest = self.get_cached_digest()
+            if digest is None and self._digest_future is not None:
+                # Wait for the worker or compute it in the current thread if
+                # no worker has picked up the task yet
+                self._digest_future.run()
+                digest = self._digest_future.result()
+            elif digest is None:
+                digest = self.compute_digest()
+            self._digest = digest
+        return self._digest
+
+    def get_cached_digest(self):
+        """Return the digest if already known, None otherwise"""
+        if self._digest is not None:
+            return self._digest
+        cache_key = self._get_cache_key()
+        if cache_key is not None:
+            return self._digest_cache.get(self.path, cache_key)
+        return None
+
+    def defer_digest(self, future):
+        """Delegate the computation of the digest to a future"""
+        self._digest_future = future
+
+    def get_size(self):
+        if self._stat_info is not None:
+            return self._stat_info.st_size
+        return os.path.getsize(safe_long_path(self.filepath))
+
+    def compute_digest(self):
+        """Hash the content of the file and update the digest cache"""
+        cache_key = self._get_cache_key()
         digester = getattr(hashlib, self._digest_func, None)
         if digester is None:
-            raise ValueError('Unknow digest method: ' + self.digest_func)
+            raise ValueError('Unknow digest method: ' + self._digest_func)
 
         h = digester()
         with open(safe_long_path(self.filepath), 'rb') as f:
@@ -64,8 +118,135 @@ class FileInfo(object):
                 if buffer == '':
                     break
                 h.update(buffer)
+            recorded_ns = _time_ns()
+            if cache_key is not None and cache_key == _get_cache_key(
+                    os.fstat(f.fileno()), self._digest_func):
+                # Only cache the digest if the file was not modified while
+                # reading it
+                self._digest_cache.set(self.path, cache_key, h.hexdigest(),
+                                       recorded_ns=recorded_ns)
         return h.hexdigest()
 
+    def _get_cache_key(self):
+        if self._digest_cache is None or self._stat_info is None:
+            return None
+        return _get_cache_key(self._stat_info, self._digest_func)
+
+
+def _get_cache_key(stat_info, digest_func):
+    """Identify the content of a file by its OS level metadata"""
+    mtime_ns = getattr(stat_info, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        # Python 2 only exposes the float modification time
+        mtime_ns = int(stat_info.st_mtime * 1000000000)
+    return (stat_info.st_ino, stat_info.st_size, mtime_ns, digest_func)
+
+
+def _time_ns():
+    return int(time.time() * 1000000000)
+
+
+class PartFile(object):
+    """Write the content of a local file to a temporary .part file
+
+    The digest is computed while the content is written and the .part file
+    atomically replaces the target file on commit. Used as a context manager
+    the .part file is removed if it has not been committed.
+    """
+
+    suffix = '.part'
+
+    def __init__(self, client, ref, os_path, digest_func='md5'):
+        self.client = client
+        self.ref = ref
+        self.os_path = os_path
+        self.part_path = os_path + self.suffix
+        digester = getattr(hashlib, digest_func.lower(), None)
+        if digester is None:
+            raise ValueError('Unknow digest method: ' + digest_func)
+        self.digest_func = digest_func.lower()
+        self._hash = digester()
+        self._file = open(self.part_path, 'wb')
+        self._committed = False
+
+    def write(self, data):
+        self._file.write(data)
+        self._hash.update(data)
+
+    def get_digest(self):
+        """Digest of the content written so far"""
+        return self._hash.hexdigest()
+
+    def commit(self):
+        """Replace the target file and return its info, digest included"""
+        self._file.flush()
+        recorded_ns = _time_ns()
+        stat_info = os.fstat(self._file.fileno())
+        self._file.close()
+        if sys.platform == 'win32' and os.path.exists(self.os_path):
+            # Windows cannot rename over an existing file
+            os.remove(self.os_path)
+        os.rename(self.part_path, self.os_path)
+        self._committed = True
+
+        digest = self._hash.hexdigest()
+        cache_key = _get_cache_key(stat_info, self.digest_func)
+        if self.client._digest_cache is not None:
+            self.client._digest_cache.set(self.ref, cache_key, digest,
+                                          recorded_ns=recorded_ns)
+        info = self.client.get_info(self.ref)
+        if (info._stat_info is not None and cache_key == _get_cache_key(
+                info._stat_info, self.digest_func)):
+            # No need to read the content again
+            info._digest = digest
+        return info
+
+    def abort(self):
+        if self._committed:
+            return
+        self._file.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.abort()
+
+
+class ContentStream(object):
+    """Sized and seekable reader of the content of a local file
+
+    Makes it possible to upload a file without loading it in memory. The
+    size is the one of the file when opened.
+    """
+
+    def __init__(self, os_path):
+        self._file = open(os_path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def seek(self, offset, whence=0):
+        self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 
 class LocalClient(object):
     """Client API implementation for the local file system"""
@@ -74,7 +255,7 @@ class LocalClient(object):
     # Automation operations fetched at controller init time.
 
     def __init__(self, base_folder, digest_func='md5', ignored_prefixes=None,
-                 ignored_suffixes=None):
+                 ignored_suffixes=None, digest_cache=None):
         if ignored_prefixes is not None:
             self.ignored_prefixes = ignored_prefixes
         else:
@@ -89,62 +270,94 @@ class LocalClient(object):
             base_folder = base_folder[:-1]
         self.base_folder = base_folder
         self._digest_func = digest_func
+        self._digest_cache = digest_cache
 
     # Getters
     def get_info(self, ref, raise_if_missing=True):
         os_path = self._abspath(ref)
-        if not os.path.exists(os_path):
+        try:
+            stat_info = os.stat(os_path)
+        except OSError:
             if raise_if_missing:
                 raise NotFound("Could not found file '%s' under '%s'" % (
                 ref, self.base_folder))
             else:
                 return None
-        folderish = os.path.isdir(os_path)
-        stat_info = os.stat(os_path)
-        mtime = datetime.fromtimestamp(stat_info.st_mtime)
         path = '/' + os_path[len(safe_long_path(self.base_folder)) + 1:]
         path = path.replace(os.path.sep, '/')  # unix style path
+        return self._make_info(path, stat_info)
+
+    def _make_info(self, path, stat_info):
+        """Build the info of a file from a single stat call result"""
+        folderish = stat.S_ISDIR(stat_info.st_mode)
+        mtime = datetime.fromtimestamp(stat_info.st_mtime)
         # On unix we could use the inode for file move detection but that won't
         # work on Windows. To reduce complexity of the code and the possibility
         # to have Windows specific bugs, let's not use the unix inode at all.
         # uid = str(stat_info.st_ino)
         return FileInfo(self.base_folder, path, folderish, mtime,
-                        digest_func=self._digest_func)
+                        digest_func=self._digest_func, stat_info=stat_info,
+                        digest_cache=self._digest_cache)
 
     def get_content(self, ref):
-        return open(self._abspath(ref), "rb").read()
+        with open(self._abspath(ref), "rb") as f:
+            return f.read()
+
+    def get_content_stream(self, ref):
+        """Open the content of a file for streaming, to be closed after use"""
+        return ContentStream(self._abspath(ref))
 
     def get_children_info(self, ref):
+        """List the infos of the children of a folder sorted by name
+
+        The parent path is resolved once and each child costs a single stat
+        call (none under Windows when the scandir module is available)
+        instead of going through get_info.
+        """
         os_path = self._abspath(ref)
+        prefix = '/' if ref == '/' else ref + '/'
         result = []
-        children = os.listdir(os_path)
-        children.sort()
-        for child_name in children:
-            ignore = False
-
-            for suffix in self.ignored_suffixes:
-                if child_name.endswith(suffix):
-                    ignore = True
-                    break
+        for child_name, child_stat in sorted(self._list_stats(os_path)):
+            if self.is_ignored(child_name):
+                continue
+            if child_stat is None:
+                try:
+                    child_stat = os.stat(os.path.join(os_path, child_name))
+                except OSError:
+                    # the child file has been deleted in the mean time
+                    continue
+            result.append(self._make_info(prefix + child_name, child_stat))
+        return result
 
-            for prefix in self.ignored_prefixes:
-                if child_name.startswith(prefix):
-                    ignore = True
-                    break
+    def _list_stats(self, os_path):
+        """Yield (name, stat_info) pairs for the entries of a folder
 
-            if not ignore:
-                if ref == '/':
-                    child_ref = ref + child_name
-                else:
-                    child_ref = ref + '/' + child_name
+        stat_info is None if it is not provided by the directory listing.
+        """
+        if scandir is None:
+            for name in os.listdir(os_path):
+                yield name, None
+            return
+        for entry in scandir(os_path):
+            if os.name == 'nt':
+                # Free on Windows as FindNextFile returns the attributes
                 try:
-                    result.append(self.get_info(child_ref))
-                except (OSError, NotFound):
-                    # the child file has been deleted in the mean time or while
-                    # reading some of its attributes
+                    yield entry.name, entry.stat()
+                except OSError:
                     pass
+            else:
+                yield entry.name, None
 
-        return result
+    def is_ignored(self, name):
+        """Return True if name matches an ignored prefix or suffix"""
+        for suffix in self.ignored_suffixes:
+            if name.endswith(suffix):
+                return True
+
+        for prefix in self.ignored_prefixes:
+            if name.startswith(prefix):
+                return True
+        return False
 
     def make_folder(self, parent, name):
         os_path, name = self._abspath_deduped(parent, name)
@@ -153,14 +366,24 @@ class LocalClient(object):
             return "/" + name
         return parent + "/" + name
 
-    def make_file(self, parent, name, content=None):
+    def get_new_file(self, parent, name):
+        """Return the ref and OS path of a new file without creating it"""
         os_path, name = self._abspath_deduped(parent, name)
+        if parent == "/":
+            return "/" + name, os_path
+        return parent + "/" + name, os_path
+
+    def make_file(self, parent, name, content=None):
+        ref, os_path = self.get_new_file(parent, name)
         with open(os_path, "wb") as f:
             if content:
                 f.write(content)
-        if parent == "/":
-            return "/" + name
-        return parent + "/" + name
+        return ref
+
+    def open_part_file(self, ref):
+        """Return a PartFile to write the new content of a file"""
+        return PartFile(self, ref, self._abspath(ref),
+                        digest_func=self._digest_func)
 
     def update_content(self, ref, content):
         with open(self._abspath(ref), "wb") as f:
@@ -173,6 +396,7 @@ class LocalClient(object):
             os.unlink(os_path)
         elif os.path.isdir(os_path):
             shutil.rmtree(os_path)
+        self._forget_digests(ref)
 
     def exists(self, ref):
         os_path = self._abspath(ref)
@@ -195,6 +419,7 @@ class LocalClient(object):
         parent = '/' if parent == '' else parent
         target_os_path, new_name = self._abspath_deduped(parent, new_name)
         shutil.move(source_os_path, target_os_path)
+        self._forget_digests(ref)
         if parent == '/':
             new_ref = '/' + new_name
         else:
@@ -213,12 +438,17 @@ class LocalClient(object):
         name = ref.rsplit('/', 1)[1]
         target_os_path, new_name = self._abspath_deduped(new_parent_ref, name)
         shutil.move(source_os_path, target_os_path)
+        self._forget_digests(ref)
         if new_parent_ref == '/':
             new_ref = '/' + new_name
         else:
             new_ref = new_parent_ref + "/" + new_name
         return self.get_info(new_ref)
 
+    def _forget_digests(self, ref):
+        if self._digest_cache is not None:
+            self._digest_cache.forget(ref, recursive=True)
+
     def _abspath(self, ref):
         """Absolute path on the operating system"""
         if not ref.startswith('/'):
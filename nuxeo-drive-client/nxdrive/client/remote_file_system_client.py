@@ -1,9 +1,11 @@
 """API to access a remote file system for synchronization."""
 
+import json
 import unicodedata
 from collections import namedtuple
 from datetime import datetime
 import urllib2
+import httplib
 import time
 from nxdrive.logging_config import get_logger
 from nxdrive.client.common import NotFound
@@ -46,8 +48,20 @@ class RemoteFileSystemClient(BaseAutomationClient):
     """File system oriented Automation client
 
     Uses the FileSystemItem API.
+
+    The fs items fetched by get_info can be cached for a short time, e.g.
+    during the synchronization of a document pair, to avoid fetching the
+    same item several times: see enable_fs_item_cache.
     """
 
+    # Cache of fs items by id, disabled by default
+    _fs_item_cache = None
+
+    fs_item_cache_ttl = 5
+
+    # Maximum number of fs items fetched by a single GetFileSystemItems call
+    fs_items_batch_size = 100
+
     #
     # API common with the local client API
     #
@@ -61,18 +75,31 @@ class RemoteFileSystemClient(BaseAutomationClient):
             return None
         return self._file_to_info(fs_item)
 
+    def get_infos(self, fs_item_ids):
+        """Return the RemoteFileInfo of several items, in the same order
+
+        The info of the items that cannot be found is None. The items are
+        fetched in batches if the server supports it, one at a time
+        otherwise.
+        """
+        return [None if fs_item is None else self._file_to_info(fs_item)
+                for fs_item in self.get_fs_items(fs_item_ids)]
+
     def get_filesystem_root_info(self):
         toplevel_folder = self.execute("NuxeoDrive.GetTopLevelFolder");
         return self._file_to_info(toplevel_folder)
 
-    def get_content(self, fs_item_id, file_out=None):
+    def get_content(self, fs_item_id, file_out=None, fs_item_info=None):
         """Downloads the binary content of a file system item
 
+        fs_item_info can be provided to spare a round-trip to the server when
+        the RemoteFileInfo of the item has just been fetched.
+
         Raises NotFound if file system item with id fs_item_id
         cannot be found
         """
-
-        fs_item_info = self.get_info(fs_item_id)
+        if fs_item_info is None:
+            fs_item_info = self.get_info(fs_item_id)
         download_url = self.server_url + fs_item_info.download_url
         return self._do_get(download_url, file_out=file_out)
 
@@ -83,21 +110,26 @@ class RemoteFileSystemClient(BaseAutomationClient):
     def make_folder(self, parent_id, name):
         fs_item = self.execute("NuxeoDrive.CreateFolder",
             parentId=parent_id, name=name)
+        self._cache_fs_item(fs_item)
         return fs_item['id']
 
     def make_file(self, parent_id, name, content):
         fs_item = self.execute_with_blob("NuxeoDrive.CreateFile",
             content, name, parentId=parent_id, name=name)
+        self._cache_fs_item(fs_item)
         return fs_item['id']
 
     def update_content(self, fs_item_id, content, name=None):
         if name is None:
             name = self.get_info(fs_item_id).name
+        self._forget_fs_item(fs_item_id)
         fs_item  = self.execute_with_blob('NuxeoDrive.UpdateFile',
             content, name, id=fs_item_id)
+        self._cache_fs_item(fs_item)
         return fs_item['id']
 
     def delete(self, fs_item_id):
+        self._forget_fs_item(fs_item_id)
         self.execute("NuxeoDrive.Delete", id=fs_item_id)
 
     def exists(self, fs_item_id):
@@ -108,12 +140,19 @@ class RemoteFileSystemClient(BaseAutomationClient):
         pass
 
     def rename(self, fs_item_id, new_name):
-        return self._file_to_info(self.execute("NuxeoDrive.Rename",
-            id=fs_item_id, name=new_name))
+        self._forget_fs_item(fs_item_id)
+        fs_item = self.execute("NuxeoDrive.Rename",
+            id=fs_item_id, name=new_name)
+        self._cache_fs_item(fs_item)
+        return self._file_to_info(fs_item)
 
     def move(self, fs_item_id, new_parent_id):
-        return self._file_to_info(self.execute("NuxeoDrive.Move",
-            srcId=fs_item_id, destId=new_parent_id))
+        # The ids of the moved items may change: forget them all
+        self.clear_fs_item_cache()
+        fs_item = self.execute("NuxeoDrive.Move",
+            srcId=fs_item_id, destId=new_parent_id)
+        self._cache_fs_item(fs_item)
+        return self._file_to_info(fs_item)
 
     def can_move(self, fs_item_id, new_parent_id):
         return self.execute("NuxeoDrive.CanMove", srcId=fs_item_id,
@@ -170,11 +209,20 @@ class RemoteFileSystemClient(BaseAutomationClient):
             req = urllib2.Request(url, headers=headers)
             response = self.opener.open(req, timeout=self.blob_timeout)
             if hasattr(file_out, "write"):
+                size = 0
                 while True:
                     buffer_ = response.read(BUFFER_SIZE)
                     if buffer_ == '':
                         break
                     file_out.write(buffer_)
+                    size += len(buffer_)
+                # httplib returns an empty buffer instead of raising an error
+                # when the connection is closed before the end of the body
+                length = response.info().getheader('Content-Length')
+                if length is not None and size != int(length):
+                    raise httplib.HTTPException(
+                        "Incomplete download of %s: %d bytes out of %s" % (
+                            url, size, length))
             else:
                 return response.read()
         except urllib2.HTTPError as e:
@@ -193,13 +241,96 @@ class RemoteFileSystemClient(BaseAutomationClient):
     #
 
     def get_fs_item(self, fs_item_id):
-        return self.execute("NuxeoDrive.GetFileSystemItem", id=fs_item_id)
+        fs_item = self._get_cached_fs_item(fs_item_id)
+        if fs_item is not None:
+            return fs_item
+        fs_item = self.execute("NuxeoDrive.GetFileSystemItem", id=fs_item_id)
+        self._cache_fs_item(fs_item)
+        return fs_item
+
+    def can_batch_get_fs_items(self):
+        """Check whether the server can fetch several fs items at once"""
+        return 'NuxeoDrive.GetFileSystemItems' in self.operations
+
+    def get_fs_items(self, fs_item_ids):
+        if not self.can_batch_get_fs_items():
+            return [self.get_fs_item(fs_item_id) for fs_item_id in fs_item_ids]
+        fs_items = {}
+        missing = []
+        for fs_item_id in fs_item_ids:
+            cached = self._get_cached_fs_item(fs_item_id)
+            if cached is not None:
+                fs_items[fs_item_id] = cached
+            else:
+                missing.append(fs_item_id)
+        for i in range(0, len(missing), self.fs_items_batch_size):
+            chunk = missing[i:i + self.fs_items_batch_size]
+            # The ids can contain commas: send them as a JSON array
+            results = self.execute("NuxeoDrive.GetFileSystemItems",
+                                   ids=json.dumps(chunk))
+            for fs_item_id, fs_item in zip(chunk, results):
+                fs_items[fs_item_id] = fs_item
+                self._cache_fs_item(fs_item)
+        return [fs_items.get(fs_item_id) for fs_item_id in fs_item_ids]
+
+    def enable_fs_item_cache(self, ttl=None):
+        """Cache the fs items fetched by id until clear_fs_item_cache
+
+        Items are kept at most ttl seconds (fs_item_cache_ttl by default) and
+        are invalidated by the updates performed with this client. Updates
+        performed by other clients or users are not detected: the cache is
+        only meant to be enabled for short periods of time such as the
+        synchronization of a single document pair.
+        """
+        if ttl is not None:
+            self.fs_item_cache_ttl = ttl
+        self._fs_item_cache = {}
+
+    def clear_fs_item_cache(self):
+        if self._fs_item_cache is not None:
+            self._fs_item_cache.clear()
+
+    def disable_fs_item_cache(self):
+        self._fs_item_cache = None
+
+    def _get_cached_fs_item(self, fs_item_id):
+        cache = self._fs_item_cache
+        if cache is None:
+            return None
+        cached = cache.get(fs_item_id)
+        if cached is None:
+            return None
+        fs_item, expiry = cached
+        if time.time() < expiry:
+            return fs_item
+        del cache[fs_item_id]
+        return None
+
+    def _cache_fs_item(self, fs_item):
+        if self._fs_item_cache is not None and fs_item is not None:
+            self._fs_item_cache[fs_item['id']] = (
+                fs_item, time.time() + self.fs_item_cache_ttl)
+
+    def _forget_fs_item(self, fs_item_id):
+        if self._fs_item_cache is not None:
+            self._fs_item_cache.pop(fs_item_id, None)
 
     def get_top_level_children(self):
         return self.execute("NuxeoDrive.GetTopLevelChildren")
 
     def get_changes(self, last_sync_date=None, last_root_definitions=None):
-        return self.execute(
+        """Fetch the summary of the changes since last_sync_date
+
+        The file system item embedded in a change, if any, is converted to
+        the RemoteFileInfo stored under the 'fileSystemItemInfo' key so that
+        it does not have to be fetched again.
+        """
+        summary = self.execute(
             'NuxeoDrive.GetChangeSummary',
             lastSyncDate=last_sync_date,
             lastSyncActiveRootDefinitions=last_root_definitions)
+        for change in summary['fileSystemChanges']:
+            fs_item = change.get('fileSystemItem')
+            change['fileSystemItemInfo'] = (
+                None if fs_item is None else self._file_to_info(fs_item))
+        return summary
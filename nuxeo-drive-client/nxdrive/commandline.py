@@ -12,6 +12,7 @@ except ImportError:
     debugger = pdb
 
 from nxdrive.controller import Controller
+from nxdrive.synchronizer import Synchronizer
 from nxdrive.daemon import daemonize
 from nxdrive.controller import default_nuxeo_drive_folder
 from nxdrive.logging_config import configure
@@ -81,7 +82,34 @@ def make_cli_parser(add_subparsers=True):
     )
     common_parser.add_argument(
         "--delay", default=DEFAULT_DELAY, type=float,
-        help="Delay in seconds between consecutive sync operations.")
+        help="Delay in seconds between consecutive sync operations, doubled"
+        " while idle or offline.")
+    common_parser.add_argument(
+        "--local-scan-workers", default=0, type=int,
+        help="Number of threads listing local folders in parallel during"
+        " full scans, useful for network or slow drives. 0 to disable.")
+    common_parser.add_argument(
+        "--remote-scan-workers", default=0, type=int,
+        help="Number of concurrent requests listing remote folders during"
+        " full scans, useful with high latency servers. 0 to disable.")
+    common_parser.add_argument(
+        "--digest-workers", default=0, type=int,
+        help="Number of threads computing the digests of new or modified"
+        " local files during scans. 0 to disable.")
+    common_parser.add_argument(
+        "--local-scan-delay", default=Synchronizer.local_scan_delay,
+        type=float,
+        help="Delay in seconds between consecutive scans of the local"
+        " folders, independent from the polls of the remote changes.")
+    common_parser.add_argument(
+        "--synchronize-delay", default=Synchronizer.synchronize_delay,
+        type=float,
+        help="Maximum delay in seconds between consecutive synchronizations"
+        " of the pending documents when no change is detected.")
+    common_parser.add_argument(
+        "--transfer-workers", default=0, type=int,
+        help="Number of files uploaded or downloaded concurrently, useful"
+        " to synchronize many small files. 0 to disable.")
     common_parser.add_argument(
         # XXX: Make it true by default as the fault tolerant mode is not yet
         # implemented
@@ -127,6 +155,15 @@ def make_cli_parser(add_subparsers=True):
     bind_server_parser.add_argument(
         "--remote-repo", default='default',
         help="Name of the remote repository.")
+    bind_server_parser.add_argument(
+        "--max-idle-connections", type=int,
+        help="Maximum number of idle HTTP connections kept open to the"
+        " server for reuse, default %d." % Controller.max_idle_connections)
+    bind_server_parser.add_argument(
+        "--connection-idle-timeout", type=int,
+        help="Number of seconds after which an idle HTTP connection to the"
+        " server is closed instead of being reused, default %d."
+        % Controller.connection_idle_timeout)
 
     # Unlink from a remote Nuxeo server
     unbind_server_parser = subparsers.add_parser(
@@ -287,7 +324,7 @@ class CliHandler(object):
         self._configure_logger(options)
 
         # Initialize a controller for this process
-        self.controller = Controller(options.nxdrive_home)
+        self._init_controller(options)
 
         # Find the command to execute based on the
         handler = getattr(self, command, None)
@@ -314,6 +351,21 @@ class CliHandler(object):
                 self.log.error("Error executing '%s': %s", command, e,
                           exc_info=True)
 
+    def _init_controller(self, options):
+        self.controller = Controller(options.nxdrive_home)
+        synchronizer = self.controller.synchronizer
+        synchronizer.local_scan_workers = getattr(
+            options, 'local_scan_workers', 0)
+        synchronizer.remote_scan_workers = getattr(
+            options, 'remote_scan_workers', 0)
+        synchronizer.digest_workers = getattr(options, 'digest_workers', 0)
+        synchronizer.transfer_workers = getattr(
+            options, 'transfer_workers', 0)
+        synchronizer.local_scan_delay = getattr(
+            options, 'local_scan_delay', synchronizer.local_scan_delay)
+        synchronizer.synchronize_delay = getattr(
+            options, 'synchronize_delay', synchronizer.synchronize_delay)
+
     def launch(self, options=None):
         """Launch the QT app in the main thread and sync in another thread."""
         # TODO: use the start method as default once implemented
@@ -327,7 +379,7 @@ class CliHandler(object):
         self.controller.dispose()
         daemonize()
 
-        self.controller = Controller(options.nxdrive_home)
+        self._init_controller(options)
         self._configure_logger(options)
         self.log.debug("Synchronization daemon started.")
         self.controller.synchronizer.loop(
@@ -359,8 +411,10 @@ class CliHandler(object):
             password = getpass()
         else:
             password = options.password
-        self.controller.bind_server(options.local_folder, options.nuxeo_url,
-                                    options.username, password)
+        self.controller.bind_server(
+            options.local_folder, options.nuxeo_url, options.username,
+            password, max_idle_connections=options.max_idle_connections,
+            connection_idle_timeout=options.connection_idle_timeout)
         for root in options.remote_roots:
             self.controller.bind_root(options.local_folder, root,
                                       repository=options.remote_repo)
@@ -405,13 +459,24 @@ class CliHandler(object):
         # List the test modules explicitly as recursive discovery is broken
         # when the app is frozen.
         argv += [
+            "nxdrive.tests.test_connection_pool",
+            "nxdrive.tests.test_folder_status",
             "nxdrive.tests.test_integration_local_client",
+            "nxdrive.tests.test_local_scan",
+            "nxdrive.tests.test_local_watcher",
+            "nxdrive.tests.test_multipart_body",
             "nxdrive.tests.test_integration_remote_changes",
             "nxdrive.tests.test_integration_remote_document_client",
             "nxdrive.tests.test_integration_remote_file_system_client",
             "nxdrive.tests.test_integration_synchronization",
             "nxdrive.tests.test_integration_versioning",
+            "nxdrive.tests.test_remote_poller",
+            "nxdrive.tests.test_remote_scan",
+            "nxdrive.tests.test_schema",
+            "nxdrive.tests.test_state_index",
+            "nxdrive.tests.test_synchronize_pending",
             "nxdrive.tests.test_synchronizer",
+            "nxdrive.tests.test_workers",
         ]
         return 0 if nose.run(argv=argv) else 1
 
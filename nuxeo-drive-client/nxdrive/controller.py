@@ -3,6 +3,7 @@
 import os
 import sys
 from threading import local
+from threading import Lock
 import subprocess
 from datetime import datetime
 from datetime import timedelta
@@ -17,10 +18,13 @@ from nxdrive.client import LocalClient
 from nxdrive.client import RemoteFileSystemClient
 from nxdrive.client import RemoteDocumentClient
 from nxdrive.client import NotFound
+from nxdrive.client.connection_pool import ConnectionPool
 from nxdrive.model import init_db
 from nxdrive.model import DeviceConfig
+from nxdrive.model import FolderStatus
 from nxdrive.model import ServerBinding
 from nxdrive.model import LastKnownState
+from nxdrive.model import PENDING_STATES
 from nxdrive.synchronizer import Synchronizer
 from nxdrive.synchronizer import POSSIBLE_NETWORK_ERROR_TYPES
 from nxdrive.logging_config import get_logger
@@ -66,6 +70,11 @@ class Controller(object):
     # Used for FS synchronization operations
     remote_fs_client_factory = RemoteFileSystemClient
 
+    # Default settings of the HTTP connection pool of each server binding,
+    # unless overridden by the binding
+    max_idle_connections = 4
+    connection_idle_timeout = 15
+
     def __init__(self, config_folder, echo=None, poolclass=None, timeout=20):
         # Log the installation location for debug
         nxdrive_install_folder = os.path.dirname(nxdrive.__file__)
@@ -89,6 +98,8 @@ class Controller(object):
             self.config_folder, echo=echo, poolclass=poolclass)
         self._local = local()
         self._remote_error = None
+        self._connection_pools = {}
+        self._connection_pools_lock = Lock()
         self.device_id = self.get_device_config().device_id
         self.synchronizer = Synchronizer(self)
 
@@ -155,50 +166,24 @@ class Controller(object):
         except NoResultFound:
             return []
 
-        states = self._pair_states_recursive(session, folder_state)
-
-        return [(os.path.basename(s.local_path), pair_state)
-                for s, pair_state in states
-                if s.local_parent_path == path]
-
-    def _pair_states_recursive(self, session, doc_pair):
-        """Recursive call to collect pair state under a given location."""
-        if not doc_pair.folderish:
-            return [(doc_pair, doc_pair.pair_state)]
-
-        if doc_pair.local_path is not None and doc_pair.remote_ref is not None:
-            f = or_(
-                LastKnownState.local_parent_path == doc_pair.local_path,
-                LastKnownState.remote_parent_ref == doc_pair.remote_ref,
-            )
-        elif doc_pair.local_path is not None:
-            f = LastKnownState.local_parent_path == doc_pair.local_path
-        elif doc_pair.remote_ref is not None:
-            f = LastKnownState.remote_parent_ref == doc_pair.remote_ref
-        else:
-            raise ValueError("Illegal state %r: at least path or remote_ref"
-                             " should be not None." % doc_pair)
-
-        children_states = session.query(LastKnownState).filter_by(
-            local_folder=doc_pair.local_folder).filter(f).order_by(
-                asc(LastKnownState.local_name),
-                asc(LastKnownState.remote_name),
-            ).all()
-
-        results = []
-        for child_state in children_states:
-            sub_results = self._pair_states_recursive(session, child_state)
-            results.extend(sub_results)
-
-        # A folder stays synchronized (or unknown) only if all the descendants
-        # are themselfves synchronized.
-        pair_state = doc_pair.pair_state
-        for _, sub_pair_state in results:
-            if sub_pair_state != 'synchronized':
-                pair_state = 'children_modified'
-            break
-        # Pre-pend the folder state to the descendants
-        return [(doc_pair, pair_state)] + results
+        children = session.query(LastKnownState).filter_by(
+            local_folder=folder_state.local_folder,
+            local_parent_path=path,
+        ).order_by(
+            asc(LastKnownState.local_name),
+            asc(LastKnownState.remote_name),
+        ).all()
+
+        # A folder stays synchronized (or unknown) only if all the
+        # descendants are themselves synchronized: read the number of the
+        # others maintained along with the states.
+        pending = FolderStatus.get_pending(
+            session, folder_state.local_folder,
+            [c.local_path for c in children if c.folderish])
+        return [(os.path.basename(c.local_path),
+                 'children_modified' if pending.get(c.local_path)
+                 else c.pair_state)
+                for c in children]
 
     def _binding_path(self, local_path, session=None):
         """Find a server binding and relative path for a given FS path"""
@@ -248,8 +233,13 @@ class Controller(object):
             session = self.get_session()
         return session.query(ServerBinding).all()
 
-    def bind_server(self, local_folder, server_url, username, password):
-        """Bind a local folder to a remote nuxeo server"""
+    def bind_server(self, local_folder, server_url, username, password,
+                    max_idle_connections=None, connection_idle_timeout=None):
+        """Bind a local folder to a remote nuxeo server
+
+        max_idle_connections and connection_idle_timeout override the
+        default settings of the HTTP connection pool of the binding.
+        """
         session = self.get_session()
         local_folder = normalized_path(local_folder)
         if not os.path.exists(local_folder):
@@ -291,12 +281,20 @@ class Controller(object):
                 if server_binding.remote_password is not None:
                     server_binding.remote_password = None
 
+            if max_idle_connections is not None:
+                server_binding.max_idle_connections = max_idle_connections
+            if connection_idle_timeout is not None:
+                server_binding.connection_idle_timeout = (
+                    connection_idle_timeout)
+
         except NoResultFound:
             log.info("Binding '%s' to '%s' with account '%s'",
                      local_folder, server_url, username)
-            server_binding = ServerBinding(local_folder, server_url, username,
-                                           remote_password=password,
-                                           remote_token=token)
+            server_binding = ServerBinding(
+                local_folder, server_url, username, remote_password=password,
+                remote_token=token,
+                max_idle_connections=max_idle_connections,
+                connection_idle_timeout=connection_idle_timeout)
             session.add(server_binding)
 
             # Creating the toplevel state for the server binding
@@ -345,6 +343,8 @@ class Controller(object):
 
         # Invalidate client cache
         self.invalidate_client_cache(binding.server_url)
+        self.synchronizer.forget_digest_cache(local_folder)
+        self._close_connection_pool(local_folder)
 
         # Delete binding info in local DB
         log.info("Unbinding '%s' from '%s' with account '%s'",
@@ -408,7 +408,7 @@ class Controller(object):
         if session is None:
             session = self.get_session()
 
-        predicates = [LastKnownState.pair_state != 'synchronized']
+        predicates = [LastKnownState.pair_state.in_(PENDING_STATES)]
         if local_folder is not None:
             predicates.append(LastKnownState.local_folder == local_folder)
 
@@ -444,6 +444,43 @@ class Controller(object):
             self._local.remote_clients = dict()
         return self._local.remote_clients
 
+    def get_connection_pool(self, server_binding):
+        """Return the HTTP connection pool shared by the clients of a binding
+
+        Connections are reused by all the threads of the process. The pool
+        follows the settings of the binding, if any.
+        """
+        sb = server_binding
+        max_idle = sb.max_idle_connections
+        if max_idle is None:
+            max_idle = self.max_idle_connections
+        idle_timeout = sb.connection_idle_timeout
+        if idle_timeout is None:
+            idle_timeout = self.connection_idle_timeout
+        with self._connection_pools_lock:
+            pool = self._connection_pools.get(sb.local_folder)
+            if pool is None:
+                pool = ConnectionPool(max_idle=max_idle,
+                                      idle_timeout=idle_timeout)
+                self._connection_pools[sb.local_folder] = pool
+            else:
+                pool.max_idle = max_idle
+                pool.idle_timeout = idle_timeout
+            return pool
+
+    def get_connection_pool_stats(self):
+        """Map the bound local folders to their connection pool statistics"""
+        with self._connection_pools_lock:
+            pools = self._connection_pools.items()
+        return dict((local_folder, pool.get_stats())
+                    for local_folder, pool in pools)
+
+    def _close_connection_pool(self, local_folder):
+        with self._connection_pools_lock:
+            pool = self._connection_pools.pop(local_folder, None)
+        if pool is not None:
+            pool.close()
+
     def get_remote_fs_client(self, server_binding):
         """Return a client for the FileSystem abstraction."""
         cache = self._get_client_cache()
@@ -455,7 +492,8 @@ class Controller(object):
             remote_client = self.remote_fs_client_factory(
                 sb.server_url, sb.remote_user, self.device_id,
                 token=sb.remote_token, password=sb.remote_password,
-                timeout=self.timeout)
+                timeout=self.timeout,
+                connection_pool=self.get_connection_pool(sb))
             cache[cache_key] = remote_client
         # Make it possible to have the remote client simulate any kind of
         # failure
@@ -470,7 +508,8 @@ class Controller(object):
             sb.server_url, sb.remote_user, self.device_id,
             token=sb.remote_token, password=sb.remote_password,
             repository=repository, base_folder=base_folder,
-            timeout=self.timeout)
+            timeout=self.timeout,
+            connection_pool=self.get_connection_pool(sb))
 
     def get_remote_client(self, server_binding, repository='default',
                           base_folder='/'):
@@ -540,7 +579,10 @@ class Controller(object):
         self._remote_error = error
 
     def dispose(self):
-        """Release all database resources"""
+        """Release all database, network and file watching resources"""
+        self.synchronizer.stop_local_watchers()
+        for local_folder in self._connection_pools.keys():
+            self._close_connection_pool(local_folder)
         self.get_session().close_all()
         self._engine.pool.dispose()
 
@@ -0,0 +1,273 @@
+"""Watch the local file system to find the folders that need a rescan.
+
+The synchronizer used to walk the whole bound folder at each iteration of the
+main loop to detect local changes. Watchers collect file system events
+instead so that only the folders with recent activity get rescanned.
+
+A watcher returns None when it cannot tell which folders have changed (at
+startup, on platforms without file system events support or when the event
+queue has overflown). The caller is then expected to perform a full scan.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+# Constants from linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+              | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+              | IN_MOVE_SELF | IN_ONLYDIR)
+
+# struct inotify_event {int wd; uint32_t mask, cookie, len; char name[];}
+EVENT_HEADER = struct.Struct('iIII')
+
+READ_SIZE = 64 * 1024
+
+
+_libc = None
+
+
+def _get_libc():
+    """Lazy load the C library functions needed to use inotify"""
+    global _libc
+    if _libc is None:
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        # Raise AttributeError early on libc versions without inotify
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+        _libc = libc
+    return _libc
+
+
+def inotify_available():
+    """Return True if the running platform supports inotify"""
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        _get_libc()
+        return True
+    except (OSError, AttributeError):
+        return False
+
+
+class LocalWatcher(object):
+    """Fallback watcher that always asks for a full scan"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def get_changes(self):
+        """Return the set of folder paths that need a rescan
+
+        Return None if a full scan is required.
+        """
+        return None
+
+
+class InotifyWatcher(LocalWatcher):
+    """Collect the folders with recent activity using Linux inotify
+
+    Each watched folder is registered with its own inotify watch. When an
+    event is received for a child of a folder, the folder path is marked
+    dirty: rescanning its direct children is enough to take the event into
+    account. Newly created or moved in sub folders are registered on the fly.
+    """
+
+    def __init__(self, client):
+        super(InotifyWatcher, self).__init__(client)
+        self._fd = None
+        self._wd_paths = {}
+        self._path_wds = {}
+        self._dirty = set()
+        self._full_scan_needed = True
+        self._encoding = sys.getfilesystemencoding() or 'utf-8'
+
+    def start(self):
+        if self._fd is not None:
+            return
+        libc = _get_libc()
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._fd = fd
+        self._full_scan_needed = True
+        try:
+            self._watch_recursive('/')
+        except OSError as e:
+            # Typically ENOSPC when reaching fs.inotify.max_user_watches
+            log.warning("Cannot watch the file system events of %s,"
+                        " falling back to full scans: %s",
+                        self.client.base_folder, e)
+            self.stop()
+
+    def stop(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._wd_paths.clear()
+        self._path_wds.clear()
+        self._dirty.clear()
+        self._full_scan_needed = True
+
+    def get_changes(self):
+        if self._fd is None:
+            return None
+        try:
+            self._read_events()
+        except OSError as e:
+            log.warning("Failed to collect the file system events of %s,"
+                        " falling back to full scans: %s",
+                        self.client.base_folder, e)
+            self.stop()
+            return None
+        if self._full_scan_needed:
+            self._full_scan_needed = False
+            self._dirty.clear()
+            return None
+        dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def _os_path(self, path):
+        return os.path.join(self.client.base_folder,
+                            path[1:].replace('/', os.path.sep))
+
+    def _child_path(self, path, name):
+        if path == '/':
+            return '/' + name
+        return path + '/' + name
+
+    def _add_watch(self, path):
+        os_path = self._os_path(path)
+        if isinstance(os_path, unicode):
+            os_path = os_path.encode(self._encoding)
+        wd = _get_libc().inotify_add_watch(self._fd, os_path, WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR):
+                # The folder has been deleted or replaced in the mean time
+                return
+            raise OSError(e, os.strerror(e), os_path)
+        old_path = self._wd_paths.get(wd)
+        if old_path is not None and old_path != path:
+            self._path_wds.pop(old_path, None)
+        self._wd_paths[wd] = path
+        self._path_wds[path] = wd
+
+    def _watch_recursive(self, path):
+        self._add_watch(path)
+        try:
+            children = os.listdir(self._os_path(path))
+        except OSError:
+            return
+        for name in children:
+            if self.client.is_ignored(name):
+                continue
+            child_path = self._child_path(path, name)
+            if os.path.isdir(self._os_path(child_path)):
+                self._watch_recursive(child_path)
+
+    def _forget_recursive(self, path):
+        """Remove the watches of a folder tree that is no longer there"""
+        prefix = path + '/'
+        for watched_path in self._path_wds.keys():
+            if watched_path == path or watched_path.startswith(prefix):
+                wd = self._path_wds.pop(watched_path)
+                self._wd_paths.pop(wd, None)
+                _get_libc().inotify_rm_watch(self._fd, wd)
+
+    def _read_events(self):
+        while True:
+            try:
+                data = os.read(self._fd, READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if not data:
+                return
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                self._handle_event(
+                    wd, mask, name.decode(self._encoding, 'replace'))
+
+    def _handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            log.debug("Overflow of the file system events queue for %s",
+                      self.client.base_folder)
+            self._full_scan_needed = True
+            # Some folders might have been created without being watched
+            self._watch_recursive('/')
+            return
+
+        path = self._wd_paths.get(wd)
+        if path is None:
+            return
+
+        if mask & IN_IGNORED:
+            # The watch was removed by the kernel (folder deleted or
+            # unmounted)
+            self._wd_paths.pop(wd, None)
+            if self._path_wds.get(path) == wd:
+                del self._path_wds[path]
+            return
+
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # Handled by the events on the parent folder
+            return
+
+        if name and self.client.is_ignored(name):
+            return
+
+        self._dirty.add(path)
+        if name and mask & IN_ISDIR:
+            child_path = self._child_path(path, name)
+            if mask & IN_MOVED_FROM:
+                self._forget_recursive(child_path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_recursive(child_path)
+
+
+def get_local_watcher(client):
+    """Build the most efficient watcher available for a local client"""
+    if inotify_available():
+        return InotifyWatcher(client)
+    return LocalWatcher(client)
@@ -2,14 +2,30 @@ import os
 import uuid
 import logging
 import datetime
+import time
+from collections import defaultdict
+from collections import namedtuple
+from threading import Lock
+from sqlalchemy import event
+from sqlalchemy import func
+from sqlalchemy import inspect
 from sqlalchemy import Column
 from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import Sequence
 from sqlalchemy import String
+from sqlalchemy import and_
+from sqlalchemy import bindparam
+from sqlalchemy import case
+from sqlalchemy import literal
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import backref
+from sqlalchemy.orm import column_property
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
@@ -35,7 +51,7 @@ log = logging.getLogger(__name__)
 Base = declarative_base()
 
 
-__model_version__ = 1
+__model_version__ = 4
 
 # Summary status from last known pair of states
 
@@ -64,6 +80,14 @@ PAIR_STATES = {
     ('created', 'created'): 'conflicted',
 }
 
+# Pair states still to be synchronized, as an explicit list so that the
+# queries of the pending states can use the indexes
+PENDING_STATES = tuple(sorted(set(PAIR_STATES.values()) - {'synchronized'}))
+
+# States of a side of the pair that turn to 'deleted' when the document
+# disappears from that side
+LIVE_STATES = ('unknown', 'created', 'modified', 'synchronized')
+
 
 class DeviceConfig(Base):
     """Holds Nuxeo Drive configuration parameters
@@ -88,9 +112,13 @@ class ServerBinding(Base):
     remote_token = Column(String)
     last_sync_date = Column(Integer)
     last_root_definitions = Column(String)
+    # Settings of the HTTP connection pool, None for the controller defaults
+    max_idle_connections = Column(Integer)
+    connection_idle_timeout = Column(Integer)
 
     def __init__(self, local_folder, server_url, remote_user,
-                 remote_password=None, remote_token=None):
+                 remote_password=None, remote_token=None,
+                 max_idle_connections=None, connection_idle_timeout=None):
         self.local_folder = local_folder
         self.server_url = server_url
         self.remote_user = remote_user
@@ -98,6 +126,8 @@ class ServerBinding(Base):
         # auth
         self.remote_password = remote_password
         self.remote_token = remote_token
+        self.max_idle_connections = max_idle_connections
+        self.connection_idle_timeout = connection_idle_timeout
 
     def invalidate_credentials(self):
         """Ensure that all stored credentials are zeroed."""
@@ -112,6 +142,21 @@ class ServerBinding(Base):
 class LastKnownState(Base):
     """Aggregate state aggregated from last collected events."""
     __tablename__ = 'last_known_states'
+    __table_args__ = (
+        # Composite indexes for the queries of the synchronizer, which
+        # filter the states of a bound folder
+        Index('ix_last_known_states_folder_local_path',
+              'local_folder', 'local_path'),
+        Index('ix_last_known_states_folder_local_parent_path',
+              'local_folder', 'local_parent_path', 'local_name'),
+        Index('ix_last_known_states_folder_remote_ref',
+              'local_folder', 'remote_ref'),
+        Index('ix_last_known_states_folder_remote_parent_ref',
+              'local_folder', 'remote_parent_ref'),
+        # For the pending list, sorted by local path
+        Index('ix_last_known_states_folder_pair_state',
+              'local_folder', 'pair_state', 'local_path'),
+    )
 
     id = Column(Integer, Sequence('state_id_seq'), primary_key=True)
 
@@ -130,15 +175,20 @@ class LastKnownState(Base):
     remote_digest = Column(String, index=True)
 
     # Path from root using unix separator, '/' for the root it-self.
-    local_path = Column(String, index=True)
+    # The previous values of the attributes the folder status depends on
+    # are always loaded to track their changes.
+    local_path = column_property(Column(String, index=True),
+                                 active_history=True)
 
     # Remote reference (instead of path based lookup)
-    remote_ref = Column(String, index=True)
+    remote_ref = column_property(Column(String, index=True),
+                                 active_history=True)
 
     # Parent path from root / ref for fast children queries,
     # can be None for the root it-self.
     local_parent_path = Column(String, index=True)
-    remote_parent_ref = Column(String, index=True)
+    remote_parent_ref = column_property(Column(String, index=True),
+                                        active_history=True)
     remote_parent_path = Column(String)  # for ordering only
 
     # Names for fast alignment queries
@@ -150,7 +200,8 @@ class LastKnownState(Base):
     # Last known state based on event log
     local_state = Column(String)
     remote_state = Column(String)
-    pair_state = Column(String, index=True)
+    pair_state = column_property(Column(String, index=True),
+                                 active_history=True)
 
     # Track move operations to avoid losing history
     locally_moved_from = Column(String)
@@ -195,6 +246,39 @@ class LastKnownState(Base):
         if self.pair_state != pair_state:
             self.pair_state = pair_state
 
+    @classmethod
+    def local_subtree(cls, local_path):
+        """SQL criterion matching local_path and its descendants
+
+        The descendants are matched by a range on the path prefix, which
+        unlike LIKE is case sensitive and does not need any escaping.
+        """
+        if local_path == '/':
+            return cls.local_path != None
+        # '0' is the character following '/'
+        return or_(cls.local_path == local_path,
+                   and_(cls.local_path > local_path + '/',
+                        cls.local_path < local_path + '0'))
+
+    @classmethod
+    def pair_state_expression(cls, local_state=None, remote_state=None):
+        """SQL expression of the pair state for bulk updates
+
+        Give either the new local_state or the new remote_state, the state
+        of the other side being read from the updated row.
+        """
+        if local_state is not None:
+            other = cls.remote_state
+            whens = [(other == r, p) for (l, r), p in PAIR_STATES.items()
+                     if l == local_state]
+        else:
+            other = cls.local_state
+            whens = [(other == l, p) for (l, r), p in PAIR_STATES.items()
+                     if r == remote_state]
+        if not whens:
+            return literal('unknown')
+        return case(sorted(whens, key=lambda w: w[1]), else_='unknown')
+
     def __repr__(self):
         return ("LastKnownState<local_folder=%r, local_path=%r, "
                 "remote_name=%r, local_state=%r, remote_state=%r>") % (
@@ -217,11 +301,16 @@ class LastKnownState(Base):
         self.update_local(local_info)
         return local_info
 
+    def needs_local_digest(self, local_info):
+        """Return True if update_local would hash the file of local_info"""
+        return (self.local_digest is None
+                or self.last_local_updated is None
+                or local_info.last_modification_time > self.last_local_updated)
+
     def update_local(self, local_info):
         """Update the state from pre-fetched local filesystem info."""
         if local_info is None:
-            if self.local_state in ('unknown', 'created', 'modified',
-                                    'synchronized'):
+            if self.local_state in LIVE_STATES:
                 # the file use to exist, it has been deleted
                 self.update_state(local_state='deleted')
             return
@@ -248,14 +337,33 @@ class LastKnownState(Base):
                 self, self.local_folder, local_info.path))
 
         # Shall we recompute the digest from the current file?
-        update_digest = self.local_digest == None
+        modified = (self.last_local_updated is not None
+                    and local_info.last_modification_time
+                    > self.last_local_updated)
+        update_digest = (self.local_digest == None
+                         or self.last_local_updated is None or modified)
+
+        if update_digest:
+            try:
+                self.local_digest = local_info.get_digest()
+            except (IOError, WindowsError):
+                # This can fail when another process is writing the same file
+                # (or when the scan digest budget is exhausted) let's postpone
+                # digest computation in that case
+                log.debug("Delaying local digest computation for %r"
+                          " due to possible concurrent file access.",
+                          local_info.filepath)
+                if modified:
+                    # Keep the previous time stamp so that the modification
+                    # is detected again, with its digest, by the next scan:
+                    # the stale digest must not be compared to the remote one
+                    return
 
         if self.last_local_updated is None:
             self.last_local_updated = local_info.last_modification_time
             self.folderish = local_info.folderish
-            update_digest = True
 
-        elif local_info.last_modification_time > self.last_local_updated:
+        elif modified:
             self.last_local_updated = local_info.last_modification_time
             self.folderish = local_info.folderish
             if not self.folderish:
@@ -263,17 +371,6 @@ class LastKnownState(Base):
                 # children are added under Linux? Is this the same under OSX
                 # and Windows?
                 local_state = 'modified'
-            update_digest = True
-
-        if update_digest:
-            try:
-                self.local_digest = local_info.get_digest()
-            except (IOError, WindowsError):
-                # This can fail when another process is writing the same file
-                # let's postpone digest computation in that case
-                log.debug("Delaying local digest computation for %r"
-                          " due to possible concurrent file access.",
-                          local_info.filepath)
 
         # XXX: shall we store local_folderish and remote_folderish to
         # detect such kind of conflicts instead?
@@ -293,8 +390,7 @@ class LastKnownState(Base):
     def update_remote(self, remote_info):
         """Update the state from the pre-fetched remote server info."""
         if remote_info is None:
-            if self.remote_state in ('unknown', 'created', 'modified',
-                                     'synchronized'):
+            if self.remote_state in LIVE_STATES:
                 self.update_state(remote_state='deleted')
             return
 
@@ -328,6 +424,914 @@ class LastKnownState(Base):
         return os.path.join(self.local_folder, relative_path)
 
 
+class LocalDigest(Base):
+    """Digest of a local file along with the OS metadata of its content"""
+    __tablename__ = 'local_digests'
+
+    local_folder = Column(String, ForeignKey('server_bindings.local_folder'),
+                          primary_key=True)
+    server_binding = relationship(
+        'ServerBinding',
+        backref=backref("local_digests", cascade="all, delete-orphan"))
+
+    # Path from root using unix separator, as for LastKnownState
+    local_path = Column(String, primary_key=True)
+
+    # The digest is valid as long as these attributes are unchanged
+    inode = Column(Integer)
+    size = Column(Integer)
+    mtime_ns = Column(Integer)
+    digest_func = Column(String)
+
+    digest = Column(String)
+
+
+class DigestCache(object):
+    """Persistent cache of the digests of the files of a bound folder
+
+    A digest is reused as long as the inode, size and modification time of
+    the file are unchanged. As in git, racy entries are not cached: a file
+    modified shortly before its digest was recorded could be modified again
+    without any visible change of its modification time.
+
+    The entries are loaded at once and updates are buffered in memory until
+    the next flush so that the cache can be read and updated without issuing
+    any query (and from any thread).
+    """
+
+    # SQLite limits the number of variables per query
+    flush_chunk_size = 500
+
+    # Coarsest modification time resolution of the supported file systems
+    # (FAT), in nanoseconds
+    racy_delay_ns = 2000000000
+
+    def __init__(self, local_folder):
+        self.local_folder = local_folder
+        self._entries = {}
+        self._updated = set()
+        self._deleted = set()
+        self._loaded = False
+        self._lock = Lock()
+
+    def load(self, session):
+        """Load the persisted entries, if not already done"""
+        if self._loaded:
+            return
+        rows = session.query(
+            LocalDigest.local_path, LocalDigest.inode, LocalDigest.size,
+            LocalDigest.mtime_ns, LocalDigest.digest_func,
+            LocalDigest.digest,
+        ).filter(LocalDigest.local_folder == self.local_folder).all()
+        with self._lock:
+            for path, inode, size, mtime_ns, digest_func, digest in rows:
+                if path in self._updated or path in self._deleted:
+                    continue
+                self._entries[path] = ((inode, size, mtime_ns, digest_func),
+                                       digest)
+            self._loaded = True
+
+    def get(self, path, key):
+        """Return the cached digest of path or None if key has changed"""
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is None or entry[0] != key:
+            return None
+        return entry[1]
+
+    def set(self, path, key, digest, recorded_ns=None):
+        """Cache the digest of path unless its key was recorded too early
+
+        recorded_ns is the time, taken before the stat call that produced
+        key, at which the digest is known to match the content.
+        """
+        if recorded_ns is None:
+            recorded_ns = int(time.time() * 1000000000)
+        if key[2] > recorded_ns - self.racy_delay_ns:
+            # Racy entry: drop any previous digest rather than trusting it
+            self.forget(path)
+            return
+        with self._lock:
+            self._entries[path] = (key, digest)
+            self._updated.add(path)
+            self._deleted.discard(path)
+
+    def forget(self, path, recursive=False):
+        """Drop the entry of a deleted file, and its descendants if asked"""
+        with self._lock:
+            paths = [path]
+            if recursive:
+                prefix = path.rstrip('/') + '/'
+                paths.extend(p for p in self._entries
+                             if p.startswith(prefix))
+            for p in paths:
+                if self._entries.pop(p, None) is not None:
+                    self._deleted.add(p)
+                self._updated.discard(p)
+
+    def flush(self, session):
+        """Write the buffered updates, return True if any"""
+        with self._lock:
+            updated = [(p,) + self._entries[p] for p in self._updated]
+            deleted = list(self._deleted)
+            self._updated.clear()
+            self._deleted.clear()
+        if updated:
+            table = LocalDigest.__table__
+            session.execute(table.insert().prefix_with('OR REPLACE'), [
+                dict(local_folder=self.local_folder, local_path=path,
+                     inode=key[0], size=key[1], mtime_ns=key[2],
+                     digest_func=key[3], digest=digest)
+                for path, key, digest in updated])
+        for i in range(0, len(deleted), self.flush_chunk_size):
+            chunk = deleted[i:i + self.flush_chunk_size]
+            session.query(LocalDigest).filter(
+                LocalDigest.local_folder == self.local_folder,
+                LocalDigest.local_path.in_(chunk),
+            ).delete(synchronize_session=False)
+        return bool(updated or deleted)
+
+
+class FolderStatus(Base):
+    """Number of the descendants of a local folder not synchronized
+
+    The counters are maintained on each flush of the states so that the
+    status of a folder can be read without loading its descendants. The
+    remote documents not yet created locally are counted in the folder of
+    their remote parent, their own descendants are not.
+    """
+    __tablename__ = 'folder_status'
+
+    local_folder = Column(String, ForeignKey('server_bindings.local_folder'),
+                          primary_key=True)
+    server_binding = relationship(
+        'ServerBinding',
+        backref=backref("folder_status", cascade="all, delete-orphan"))
+
+    # Path from root using unix separator, as for LastKnownState
+    local_path = Column(String, primary_key=True)
+
+    pending = Column(Integer, default=0)
+
+    # SQLite limits the number of variables per query
+    chunk_size = 500
+
+    @classmethod
+    def get_pending(cls, session, local_folder, local_paths):
+        """Map local folder paths to their number of pending descendants"""
+        pending = {}
+        for chunk in _chunks(local_paths, cls.chunk_size):
+            pending.update(session.query(cls.local_path, cls.pending).filter(
+                cls.local_folder == local_folder,
+                cls.local_path.in_(chunk),
+            ).all())
+        return pending
+
+
+# Attributes of a state the status of its ancestors depends on
+StatusRow = namedtuple('StatusRow', [
+    'local_folder',
+    'local_path',
+    'remote_ref',
+    'remote_parent_ref',
+    'pair_state',
+    'folderish',
+])
+
+
+def _chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _local_ancestors(local_path, inclusive=False):
+    """List the ancestors of a local path up to the root"""
+    ancestors = [local_path] if inclusive else []
+    while local_path != '/':
+        local_path = local_path.rsplit('/', 1)[0] or '/'
+        ancestors.append(local_path)
+    return ancestors
+
+
+def update_folder_status(session, old_rows, new_rows):
+    """Update the folder counters from the changes of some states
+
+    old_rows and new_rows map the ids of the changed states to their
+    StatusRow before and after the change, a state missing from old_rows
+    (resp. new_rows) being created (resp. deleted). The other states are
+    read from the database.
+    """
+    states = LastKnownState.__table__
+    # Local paths of the remote parents before and after the change
+    old_paths, new_paths = {}, {}
+    for rows, paths in ((old_rows, old_paths), (new_rows, new_paths)):
+        for row in rows.values():
+            if row.folderish and row.remote_ref is not None:
+                paths.setdefault((row.local_folder, row.remote_ref),
+                                 row.local_path)
+    for key in new_paths.keys():
+        old_paths.setdefault(key, None)
+    for key in old_paths.keys():
+        new_paths.setdefault(key, None)
+
+    # The unchanged parents are the same before and after
+    missing_refs = defaultdict(set)
+    for row in old_rows.values() + new_rows.values():
+        if (row.local_path is None and row.remote_parent_ref is not None
+                and (row.local_folder, row.remote_parent_ref)
+                not in old_paths):
+            missing_refs[row.local_folder].add(row.remote_parent_ref)
+    for local_folder, refs in missing_refs.items():
+        for chunk in _chunks(refs, FolderStatus.chunk_size):
+            rows = session.execute(select(
+                [states.c.remote_ref, states.c.local_path],
+            ).where(and_(
+                states.c.local_folder == local_folder,
+                states.c.remote_ref.in_(chunk),
+            )).order_by(states.c.id))
+            for remote_ref, local_path in rows:
+                key = (local_folder, remote_ref)
+                if key not in old_paths:
+                    old_paths[key] = new_paths[key] = local_path
+
+    deltas = defaultdict(int)
+
+    def count(row, paths, delta):
+        if row is None or row.pair_state == 'synchronized':
+            return
+        if row.local_path is not None:
+            ancestors = _local_ancestors(row.local_path)
+        else:
+            parent_path = paths.get((row.local_folder,
+                                     row.remote_parent_ref))
+            if parent_path is None:
+                # Only counted through its remote parent
+                return
+            ancestors = _local_ancestors(parent_path, inclusive=True)
+        for local_path in ancestors:
+            deltas[(row.local_folder, local_path)] += delta
+
+    for state_id in set(old_rows) | set(new_rows):
+        count(old_rows.get(state_id), old_paths, -1)
+        count(new_rows.get(state_id), new_paths, 1)
+
+    # The unchanged remote children of the parents created, deleted or
+    # bound to a local folder are counted in another folder
+    moved_refs = defaultdict(set)
+    for (local_folder, remote_ref), new_path in new_paths.items():
+        if old_paths[(local_folder, remote_ref)] != new_path:
+            moved_refs[local_folder].add(remote_ref)
+    changed = defaultdict(int)
+    for row in new_rows.values():
+        if row.local_path is None and row.pair_state != 'synchronized':
+            changed[(row.local_folder, row.remote_parent_ref)] += 1
+    for local_folder, refs in moved_refs.items():
+        for chunk in _chunks(refs, FolderStatus.chunk_size):
+            counts = session.execute(select(
+                [states.c.remote_parent_ref, func.count()],
+            ).where(and_(
+                states.c.local_folder == local_folder,
+                states.c.local_path == None,
+                states.c.pair_state != 'synchronized',
+                states.c.remote_parent_ref.in_(chunk),
+            )).group_by(states.c.remote_parent_ref)).fetchall()
+            for remote_ref, n_children in counts:
+                key = (local_folder, remote_ref)
+                n_children -= changed[key]
+                for path, delta in ((old_paths[key], -n_children),
+                                    (new_paths[key], n_children)):
+                    if path is None:
+                        continue
+                    for local_path in _local_ancestors(path, inclusive=True):
+                        deltas[(local_folder, local_path)] += delta
+
+    _apply_folder_status_deltas(session, deltas)
+
+
+def _apply_folder_status_deltas(session, deltas):
+    deltas = [(key, delta) for key, delta in deltas.items() if delta]
+    if not deltas:
+        return
+    table = FolderStatus.__table__
+    match = and_(table.c.local_folder == bindparam('b_local_folder'),
+                 table.c.local_path == bindparam('b_local_path'))
+    session.execute(table.insert().prefix_with('OR IGNORE'), [
+        dict(local_folder=f, local_path=p, pending=0)
+        for (f, p), _ in deltas])
+    session.execute(
+        table.update().where(match).values(
+            pending=table.c.pending + bindparam('b_delta')),
+        [dict(b_local_folder=f, b_local_path=p, b_delta=delta)
+         for (f, p), delta in deltas])
+    # Drop the counters back to zero
+    decreased = [dict(b_local_folder=f, b_local_path=p)
+                 for (f, p), delta in deltas if delta < 0]
+    if decreased:
+        session.execute(table.delete().where(
+            and_(match, table.c.pending <= 0)), decreased)
+
+
+def rebuild_folder_status(session, local_folder=None):
+    """Compute the folder counters from scratch"""
+    criteria = []
+    status = session.query(FolderStatus)
+    if local_folder is not None:
+        criteria.append(LastKnownState.local_folder == local_folder)
+        status = status.filter(FolderStatus.local_folder == local_folder)
+    status.delete(synchronize_session=False)
+    update_folder_status(session, {}, _query_status_rows(session, *criteria))
+
+
+def _query_status_rows(session, *criteria):
+    """Map the ids of the states matching criteria to their StatusRow"""
+    rows = session.query(LastKnownState.id, *[
+        getattr(LastKnownState, name) for name in StatusRow._fields]).filter(
+            *criteria).all()
+    return dict((row[0], StatusRow(*row[1:])) for row in rows)
+
+
+def _get_status_row(state, old=False):
+    if not old:
+        return StatusRow(*[getattr(state, name)
+                           for name in StatusRow._fields])
+    attrs = inspect(state).attrs
+    values = []
+    for name in StatusRow._fields:
+        history = attrs[name].history
+        if history.deleted:
+            values.append(history.deleted[0])
+        elif history.added:
+            # Was not set
+            values.append(None)
+        elif history.unchanged:
+            values.append(history.unchanged[0])
+        else:
+            values.append(getattr(state, name))
+    return StatusRow(*values)
+
+
+def _before_flush(session, flush_context, instances):
+    # Read the previous version of the states while they can still be
+    # loaded from the database
+    old_rows = {}
+    for state in list(session.dirty) + list(session.deleted):
+        if isinstance(state, LastKnownState):
+            old_rows[state] = _get_status_row(state, old=True)
+    session.info['folder_status_rows'] = old_rows
+
+
+def _after_flush(session, flush_context):
+    old_rows = session.info.pop('folder_status_rows', {})
+    # The counters of the unbound folders are deleted along with them
+    unbound = set(b.local_folder for b in session.deleted
+                  if isinstance(b, ServerBinding))
+    old_by_id, new_by_id = {}, {}
+    for state in list(session.new) + list(session.dirty):
+        if not isinstance(state, LastKnownState):
+            continue
+        new_row = _get_status_row(state)
+        old_row = old_rows.get(state)
+        if new_row != old_row and new_row.local_folder not in unbound:
+            if old_row is not None:
+                old_by_id[state.id] = old_row
+            new_by_id[state.id] = new_row
+    for state in session.deleted:
+        old_row = old_rows.get(state)
+        if old_row is not None and old_row.local_folder not in unbound:
+            old_by_id[state.id] = old_row
+    update_folder_status(session, old_by_id, new_by_id)
+
+
+def track_folder_status(maker):
+    """Maintain the folder counters in the sessions built with maker"""
+    event.listen(maker, 'before_flush', _before_flush)
+    event.listen(maker, 'after_flush', _after_flush)
+
+
+def _bulk_change(session, criteria, change):
+    old_rows = _query_status_rows(session, *criteria)
+    if not old_rows:
+        return 0
+    indexes = _get_state_indexes(session)
+    if indexes is not None:
+        indexes.bulk_local_folders = set(
+            row.local_folder for row in old_rows.values())
+    try:
+        count = change(session.query(LastKnownState).filter(*criteria))
+    finally:
+        if indexes is not None:
+            indexes.bulk_local_folders = None
+    new_rows = {}
+    for chunk in _chunks(old_rows, FolderStatus.chunk_size):
+        new_rows.update(_query_status_rows(
+            session, LastKnownState.id.in_(chunk)))
+    update_folder_status(session, old_rows, new_rows)
+    return count
+
+
+def delete_states(session, *criteria):
+    """Delete the states matching criteria with a single statement"""
+    return _bulk_change(session, criteria, lambda query: query.delete(
+        synchronize_session='fetch'))
+
+
+def update_states(session, values, *criteria):
+    """Update the states matching criteria with a single statement"""
+    return _bulk_change(session, criteria, lambda query: query.update(
+        values, synchronize_session='fetch'))
+
+
+# Column values of a new state, see insert_states
+StateRow = namedtuple('StateRow', [
+    'local_folder',
+    'local_path',
+    'local_parent_path',
+    'local_name',
+    'last_local_updated',
+    'local_digest',
+    'remote_ref',
+    'remote_parent_ref',
+    'remote_parent_path',
+    'remote_name',
+    'last_remote_updated',
+    'remote_digest',
+    'folderish',
+    'local_state',
+    'remote_state',
+])
+
+
+def local_state_row(local_folder, local_info):
+    """Row of a new state known locally only, as built by update_local"""
+    local_parent_path, local_name = local_info.path.rsplit('/', 1)
+    try:
+        local_digest = local_info.get_digest()
+    except (IOError, WindowsError):
+        log.debug("Delaying local digest computation for %r"
+                  " due to possible concurrent file access.",
+                  local_info.filepath)
+        local_digest = None
+    return StateRow(
+        local_folder, local_info.path, local_parent_path or '/', local_name,
+        local_info.last_modification_time, local_digest,
+        None, None, None, None, None, None,
+        local_info.folderish, 'unknown', 'unknown')
+
+
+def remote_state_row(local_folder, remote_info):
+    """Row of a new state known remotely only, as built by update_remote"""
+    suffix_len = len(remote_info.uid) + 1
+    return StateRow(
+        local_folder, None, None, None, None, None,
+        remote_info.uid, remote_info.parent_uid,
+        remote_info.path[:-suffix_len], remote_info.name,
+        remote_info.last_modification_time, remote_info.get_digest(),
+        remote_info.folderish, 'unknown', 'unknown')
+
+
+def insert_states(session, rows):
+    """Insert new states in bulk, bypassing the unit of work
+
+    rows are StateRow tuples of states known on one side only, hence that
+    cannot be aligned. Their pair states are derived from the local and
+    remote states. The inserted states are not loaded in the session.
+    """
+    if not rows:
+        return
+    values, status_rows = [], {}
+    for i, row in enumerate(rows):
+        pair_state = PAIR_STATES.get((row.local_state, row.remote_state),
+                                     'unknown')
+        row_values = dict(zip(StateRow._fields, row))
+        row_values['pair_state'] = pair_state
+        values.append(row_values)
+        status_rows[i] = StatusRow(row.local_folder, row.local_path,
+                                   row.remote_ref, row.remote_parent_ref,
+                                   pair_state, row.folderish)
+    session.execute(LastKnownState.__table__.insert(), values)
+    update_folder_status(session, {}, status_rows)
+    # The ids of the new states are not known: load the indexes again
+    indexes = _get_state_indexes(session)
+    if indexes is not None:
+        indexes.invalidate(set(row.local_folder for row in rows))
+
+
+class StateVersion(Base):
+    """Number of the commits that changed the states of a bound folder
+
+    Checked by the sessions before trusting their StateIndex of the bound
+    folder, see StateIndexes. The versions are kept when a folder is unbound
+    so that they are never reused.
+    """
+    __tablename__ = 'state_versions'
+
+    local_folder = Column(String, primary_key=True)
+    version = Column(Integer, default=0)
+
+
+def _get_state_versions(session, local_folders):
+    """Map bound folders to their StateVersion, 0 if never changed"""
+    table = StateVersion.__table__
+    versions = dict((local_folder, 0) for local_folder in local_folders)
+    for chunk in _chunks(versions, FolderStatus.chunk_size):
+        versions.update(session.execute(select(
+            [table.c.local_folder, table.c.version],
+        ).where(table.c.local_folder.in_(chunk))).fetchall())
+    return versions
+
+
+class StateRecord(object):
+    """Compact copy of the attributes of a state looked up in a StateIndex"""
+
+    __slots__ = (
+        'id',
+        'local_path',
+        'local_parent_path',
+        'local_name',
+        'local_digest',
+        'remote_ref',
+        'folderish',
+        'local_state',
+    )
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "StateRecord<id=%r, local_path=%r, remote_ref=%r>" % (
+            self.id, self.local_path, self.remote_ref)
+
+
+def _map_add(mapping, key, state_id):
+    # A single id is stored as is, a set is only used for duplicated keys
+    ids = mapping.get(key)
+    if ids is None:
+        mapping[key] = state_id
+    elif isinstance(ids, set):
+        ids.add(state_id)
+    elif ids != state_id:
+        mapping[key] = set([ids, state_id])
+
+
+def _map_remove(mapping, key, state_id):
+    ids = mapping.get(key)
+    if isinstance(ids, set):
+        ids.discard(state_id)
+        if len(ids) == 1:
+            mapping[key] = ids.pop()
+    elif ids == state_id:
+        del mapping[key]
+
+
+def _map_get(mapping, key):
+    ids = mapping.get(key)
+    if ids is None:
+        return []
+    if isinstance(ids, set):
+        return sorted(ids)
+    return [ids]
+
+
+class StateIndex(object):
+    """In-memory index of the states of a bound folder
+
+    Map the local paths, remote refs, local parent paths, folder names and
+    file digests of the states to their ids so that the small lookups of
+    the synchronizer do not issue any query. The index is loaded at once
+    and kept up to date by the session tracking it: it reflects its
+    flushed changes, see track_state_index.
+    """
+
+    def __init__(self, local_folder):
+        self.local_folder = local_folder
+        # StateVersion of the folder the records are up to date with
+        self.version = None
+        self._records = {}
+        self._by_path = {}
+        self._by_remote_ref = {}
+        self._children = {}
+        # Folders by name and files by digest for the move detection
+        self._by_name = {}
+        self._by_digest = {}
+        self._lock = Lock()
+
+    def load(self, session):
+        # Read first: a concurrent commit makes the index look outdated
+        self.version = _get_state_versions(
+            session, [self.local_folder])[self.local_folder]
+        rows = session.query(*[
+            getattr(LastKnownState, name) for name in StateRecord.__slots__
+        ]).filter(LastKnownState.local_folder == self.local_folder).all()
+        self.put([StateRecord(*row) for row in rows])
+
+    def __len__(self):
+        return len(self._records)
+
+    def put(self, records):
+        """Add or replace the records of some states"""
+        with self._lock:
+            for record in records:
+                self._remove(record.id)
+                self._records[record.id] = record
+                for mapping, key in self._get_keys(record):
+                    _map_add(mapping, key, record.id)
+
+    def remove(self, state_ids):
+        """Remove the records of some states, return the number removed"""
+        with self._lock:
+            return sum(self._remove(state_id) for state_id in state_ids)
+
+    def _remove(self, state_id):
+        record = self._records.pop(state_id, None)
+        if record is None:
+            return False
+        for mapping, key in self._get_keys(record):
+            _map_remove(mapping, key, state_id)
+        return True
+
+    def _get_keys(self, record):
+        # Unknown keys are not indexed: as in SQL, None matches nothing
+        if record.remote_ref is not None:
+            yield self._by_remote_ref, record.remote_ref
+        if record.local_path is None:
+            return
+        yield self._by_path, record.local_path
+        if record.local_parent_path is not None:
+            yield self._children, record.local_parent_path
+        if record.folderish:
+            if record.local_name is not None:
+                yield self._by_name, record.local_name
+        elif record.local_digest is not None:
+            yield self._by_digest, record.local_digest
+
+    def _get_records(self, mapping, key):
+        with self._lock:
+            return [self._records[i] for i in _map_get(mapping, key)]
+
+    def get_by_path(self, local_path):
+        """Record of the state of a local path, None if unknown"""
+        records = self._get_records(self._by_path, local_path)
+        return records[0] if records else None
+
+    def get_by_remote_ref(self, remote_ref):
+        """Record of the state of a remote document, None if unknown"""
+        records = self._get_records(self._by_remote_ref, remote_ref)
+        return records[0] if records else None
+
+    def get_children(self, local_path):
+        """Records of the states of the children of a local folder"""
+        return self._get_records(self._children, local_path)
+
+    def find_folders(self, local_name):
+        """Records of the local folders named local_name"""
+        return self._get_records(self._by_name, local_name)
+
+    def find_files(self, local_digest):
+        """Records of the local files of digest local_digest"""
+        if local_digest is None:
+            return []
+        return self._get_records(self._by_digest, local_digest)
+
+
+class StateIndexes(object):
+    """StateIndex of each bound folder used by a session
+
+    The indexes are loaded on first use and reflect the changes flushed by
+    the session, and only them: the indexes of the bound folders changed by
+    a transaction that is rolled back or closed without commit are dropped.
+    The commits increase the StateVersion of the bound folders they change.
+    Before trusting its indexes, the session checks the versions of their
+    folders if another session of the process, or another connection as
+    told by the SQLite data_version, has committed in the mean time.
+    """
+
+    # Number of the commits of the states by the sessions of the process
+    commits = 0
+    _commits_lock = Lock()
+
+    def __init__(self):
+        self._indexes = {}
+        # Bound folders changed by the transaction, None for all of them
+        self._changed = set()
+        # Set while the states of these folders are changed in bulk
+        self.bulk_local_folders = None
+        # (data_version, commits) when the versions were last checked
+        self._checked = None
+        self._has_data_version = True
+
+    def get(self, session, local_folder):
+        # As an autoflushing query would, see the changes of the session
+        session.flush()
+        self._check_versions(session)
+        index = self._indexes.get(local_folder)
+        if index is None:
+            index = StateIndex(local_folder)
+            index.load(session)
+            self._indexes[local_folder] = index
+        return index
+
+    def _check_versions(self, session):
+        """Drop the indexes of the folders changed by other sessions"""
+        checked = (self._get_data_version(session), StateIndexes.commits)
+        if checked == self._checked and checked[0] is not None:
+            return
+        self._checked = checked
+        if not self._indexes:
+            return
+        versions = _get_state_versions(session, self._indexes.keys())
+        for local_folder, version in versions.items():
+            if self._indexes[local_folder].version != version:
+                log.debug("Dropping the outdated state index of %s",
+                          local_folder)
+                del self._indexes[local_folder]
+
+    def _get_data_version(self, session):
+        """SQLite data_version of the connection, None if not available"""
+        if not self._has_data_version:
+            return None
+        try:
+            # Unlike a PRAGMA statement, a query does not make the sqlite3
+            # module commit the ongoing transaction first
+            return session.execute(
+                'SELECT data_version FROM pragma_data_version()').scalar()
+        except OperationalError:
+            # SQLite older than 3.16: check the versions each time
+            self._has_data_version = False
+            return None
+
+    def invalidate(self, local_folders=None):
+        """Drop the indexes of some bound folders changed by the session
+
+        All of them if local_folders is None.
+        """
+        if local_folders is None:
+            self._indexes.clear()
+            self._changed.add(None)
+            return
+        for local_folder in local_folders:
+            self._indexes.pop(local_folder, None)
+        self._changed.update(local_folders)
+
+    def forget(self, local_folder):
+        """Drop the index of a bound folder, to be loaded again if used"""
+        self._indexes.pop(local_folder, None)
+
+    def after_flush(self, session, flush_context):
+        changed = defaultdict(list)
+        deleted = defaultdict(list)
+        for state in list(session.new) + list(session.dirty):
+            if isinstance(state, LastKnownState):
+                changed[state.local_folder].append(StateRecord(*[
+                    getattr(state, name) for name in StateRecord.__slots__]))
+        for state in session.deleted:
+            if isinstance(state, LastKnownState):
+                deleted[state.local_folder].append(state.id)
+            elif isinstance(state, ServerBinding):
+                self.forget(state.local_folder)
+        self._changed.update(changed)
+        self._changed.update(deleted)
+        for local_folder, records in changed.items():
+            if local_folder in self._indexes:
+                self._indexes[local_folder].put(records)
+        for local_folder, state_ids in deleted.items():
+            if local_folder in self._indexes:
+                self._indexes[local_folder].remove(state_ids)
+
+    def after_bulk_update(self, update_context):
+        if update_context.primary_table is not LastKnownState.__table__:
+            return
+        session = update_context.query.session
+        state_ids = self._get_matched_ids(update_context)
+        if state_ids is None:
+            return
+        states = LastKnownState.__table__
+        columns = [states.c[name] for name in StateRecord.__slots__]
+        records = defaultdict(list)
+        for chunk in _chunks(state_ids, FolderStatus.chunk_size):
+            rows = session.execute(select(
+                [states.c.local_folder] + columns,
+            ).where(states.c.id.in_(chunk)))
+            for row in rows:
+                records[row[0]].append(StateRecord(*row[1:]))
+        self._changed.update(records)
+        for local_folder, folder_records in records.items():
+            if local_folder in self._indexes:
+                self._indexes[local_folder].put(folder_records)
+
+    def after_bulk_delete(self, delete_context):
+        if delete_context.primary_table is not LastKnownState.__table__:
+            return
+        state_ids = self._get_matched_ids(delete_context)
+        if state_ids is None:
+            return
+        for index in self._indexes.values():
+            index.remove(state_ids)
+        # The bound folders of the deleted states are only known when they
+        # are deleted with delete_states
+        self._changed.update(self.bulk_local_folders
+                             if self.bulk_local_folders is not None
+                             else [None])
+
+    def _get_matched_ids(self, context):
+        matched_rows = getattr(context, 'matched_rows', None)
+        if matched_rows is None:
+            # Not synchronized with 'fetch': the changed states are unknown
+            self.invalidate()
+            return None
+        return [row[0] for row in matched_rows]
+
+    def before_commit(self, session):
+        # Count the changes flushed by the commit as well
+        session.flush()
+        if not self._changed:
+            return
+        table = StateVersion.__table__
+        local_folders = [f for f in self._changed if f is not None]
+        if local_folders:
+            session.execute(table.insert().prefix_with('OR IGNORE'), [
+                dict(local_folder=f, version=0) for f in local_folders])
+        if None in self._changed:
+            session.execute(table.update().values(version=table.c.version + 1))
+            local_folders = self._indexes.keys()
+        else:
+            session.execute(table.update().where(
+                table.c.local_folder == bindparam('b_local_folder'),
+            ).values(version=table.c.version + 1), [
+                dict(b_local_folder=f) for f in local_folders])
+        # Blindly: the commits of others since the load are still detected
+        for local_folder in local_folders:
+            if local_folder in self._indexes:
+                self._indexes[local_folder].version += 1
+
+    def after_commit(self, session):
+        if self._changed:
+            self._changed.clear()
+            with StateIndexes._commits_lock:
+                StateIndexes.commits += 1
+
+    def after_transaction_end(self, session, transaction):
+        if session.transaction is None and self._changed:
+            # Rolled back or closed without commit
+            changed, self._changed = self._changed, set()
+            if None in changed:
+                self._indexes.clear()
+            for local_folder in changed:
+                self._indexes.pop(local_folder, None)
+
+
+def _get_state_indexes(session):
+    """StateIndexes of a session, None if the session is not tracked"""
+    if not session.info.get('track_state_index'):
+        return None
+    indexes = session.info.get('state_indexes')
+    if indexes is None:
+        indexes = session.info['state_indexes'] = StateIndexes()
+    return indexes
+
+
+def _state_index_listener(name, get_session=None):
+    def listener(target, *args):
+        session = target if get_session is None else get_session(target)
+        indexes = _get_state_indexes(session)
+        if indexes is not None:
+            getattr(indexes, name)(target, *args)
+    return listener
+
+
+def track_state_index(maker):
+    """Maintain the StateIndex of the bound folders in sessions of maker"""
+    maker.configure(info={'track_state_index': True})
+    for name in ('after_flush', 'before_commit', 'after_commit',
+                 'after_transaction_end'):
+        event.listen(maker, name, _state_index_listener(name))
+    for name in ('after_bulk_update', 'after_bulk_delete'):
+        event.listen(maker, name, _state_index_listener(
+            name, get_session=lambda context: context.query.session))
+
+
+def get_state_index(session, local_folder):
+    """Return the StateIndex of a bound folder
+
+    An index is loaded for each call if the session is not tracked.
+    """
+    indexes = _get_state_indexes(session)
+    if indexes is None:
+        session.flush()
+        index = StateIndex(local_folder)
+        index.load(session)
+        return index
+    return indexes.get(session, local_folder)
+
+
+def forget_state_index(session, local_folder):
+    """Drop the StateIndex of a bound folder loaded by a session, if any"""
+    indexes = _get_state_indexes(session)
+    if indexes is not None:
+        indexes.forget(local_folder)
+
+
 class FileEvent(Base):
     __tablename__ = 'fileevents'
 
@@ -344,6 +1348,103 @@ class FileEvent(Base):
             utc_time = datetime.utcnow()
 
 
+# Number of seconds to wait for the database lock held by another thread
+SQLITE_BUSY_TIMEOUT = 60
+
+
+def is_database_locked(exception):
+    """Check whether the lock of the database could not be acquired"""
+    return (isinstance(exception, OperationalError)
+            and 'database is locked' in str(exception))
+
+# Pragmas applied to each new connection. With the write-ahead log the GUI
+# and the command line read the states while a synchronization thread
+# writes, and commits only fsync at checkpoints in the NORMAL mode.
+SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    # Negative sizes are in KiB
+    ('cache_size', -16 * 1024),
+    ('mmap_size', 64 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+            if name == 'journal_mode':
+                mode = cursor.fetchone()[0]
+                if mode.lower() != value.lower():
+                    # e.g. on network file systems without shared memory
+                    log.debug("Could not set the journal mode to %s,"
+                              " using %s", value, mode)
+    finally:
+        cursor.close()
+
+
+def get_model_version(connectable):
+    """Return the model version stored as the SQLite user version
+
+    The databases created before it was recorded have a user version of 0
+    and are of version 1.
+    """
+    return max(connectable.execute('PRAGMA user_version').scalar(), 1)
+
+
+def _add_composite_indexes(connection):
+    # create_all does not add the new indexes to the existing tables
+    table = LastKnownState.__table__
+    existing = set(index['name'] for index
+                   in inspect(connection).get_indexes(table.name))
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(connection)
+
+
+def _count_pending_descendants(connection):
+    session = sessionmaker(bind=connection)()
+    try:
+        rebuild_folder_status(session)
+        session.flush()
+    finally:
+        session.close()
+
+
+def _add_connection_pool_settings(connection):
+    # create_all does not add the new columns to the existing tables
+    table = ServerBinding.__table__
+    existing = set(column['name'] for column
+                   in inspect(connection).get_columns(table.name))
+    for name in ('max_idle_connections', 'connection_idle_timeout'):
+        if name not in existing:
+            connection.execute('ALTER TABLE %s ADD COLUMN %s INTEGER' % (
+                table.name, name))
+
+
+# Upgrade steps of the schema: MIGRATIONS[n] upgrades a database of version
+# n - 1 to version n. A step interrupted before recording the new version
+# is run again at the next start hence must be idempotent.
+MIGRATIONS = {
+    2: _add_composite_indexes,
+    3: _count_pending_descendants,
+    4: _add_connection_pool_settings,
+}
+
+
+def migrate_db(engine):
+    """Upgrade a database created by a previous version, step by step"""
+    version = get_model_version(engine)
+    for target in range(version + 1, __model_version__ + 1):
+        log.info("Upgrading the database from version %d to %d",
+                 target - 1, target)
+        with engine.begin() as connection:
+            MIGRATIONS[target](connection)
+            connection.execute('PRAGMA user_version = %d' % target)
+
+
 def init_db(nxdrive_home, echo=False, scoped_sessions=True, poolclass=None):
     """Return an engine and session maker configured for using nxdrive_home
 
@@ -361,12 +1462,23 @@ def init_db(nxdrive_home, echo=False, scoped_sessions=True, poolclass=None):
     # SQLite cannot share connections across threads hence it's safer to
     # enforce this at the connection pool level
     poolclass = SingletonThreadPool if poolclass is None else poolclass
+    # Each server binding is synchronized by its own thread: wait for the
+    # write lock held by another thread rather than failing right away
     engine = create_engine('sqlite:///' + dbfile, echo=echo,
-                           poolclass=poolclass)
+                           poolclass=poolclass,
+                           connect_args={'timeout': SQLITE_BUSY_TIMEOUT})
+    event.listen(engine, 'connect', _set_sqlite_pragmas)
 
     # Ensure that the tables are properly initialized
+    new_db = not engine.has_table(ServerBinding.__tablename__)
     Base.metadata.create_all(engine)
+    if new_db:
+        engine.execute('PRAGMA user_version = %d' % __model_version__)
+    else:
+        migrate_db(engine)
     maker = sessionmaker(bind=engine)
+    track_folder_status(maker)
+    track_state_index(maker)
     if scoped_sessions:
         maker = scoped_session(maker)
     return engine, maker
\ No newline at end of file
@@ -0,0 +1,219 @@
+"""Poll the remote change summaries in the background.
+
+The synchronization loop used to fetch the remote change summary, scan the
+local folders and synchronize the pending pairs in strict sequence. A poller
+fetches the change summaries of a server binding on its own schedule so that
+a slow local scan does not delay the detection of the remote changes, and
+the reverse.
+
+Like the workers, the poller only performs I/O: the summaries are applied to
+the state database by the synchronization thread.
+"""
+
+import sys
+import urllib2
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
+from threading import Event
+from threading import Lock
+from threading import Thread
+from time import time
+
+
+def get_retry_after(exception):
+    """Return the delay in seconds requested by the server, if any
+
+    The delay is read from the Retry-After header of HTTP errors (typically
+    503 Service Unavailable or 429 Too Many Requests), either as a number of
+    seconds or as an HTTP date.
+    """
+    if not isinstance(exception, urllib2.HTTPError):
+        return None
+    headers = exception.info()
+    value = headers.get('Retry-After') if headers is not None else None
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - time())
+
+
+class PollScheduler(object):
+    """Compute the delay before the next poll
+
+    Poll again right away while there is some activity. Once idle, the delay
+    starts at base_delay and is multiplied by backoff at each idle poll up to
+    max_delay. The delay grows up to offline_max_delay while the server
+    cannot be reached. A delay requested by the server (e.g. with a
+    Retry-After header) is honored if longer, up to max_hint.
+    """
+
+    def __init__(self, base_delay, max_delay, offline_max_delay,
+                 backoff=2, max_hint=3600):
+        self.base_delay = base_delay
+        self.max_delay = max(max_delay, base_delay)
+        self.offline_max_delay = max(offline_max_delay, base_delay)
+        self.backoff = backoff
+        self.max_hint = max_hint
+        self._idle_loops = 0
+        self._offline_loops = 0
+
+    def next_delay(self, n_synchronized=0, offline=False, hint=None):
+        """Return the number of seconds to wait before the next poll"""
+        if offline:
+            self._idle_loops = 0
+            self._offline_loops += 1
+            delay = self._backoff(self._offline_loops, self.offline_max_delay)
+        else:
+            self._offline_loops = 0
+            if n_synchronized > 0:
+                self._idle_loops = 0
+                delay = 0
+            else:
+                self._idle_loops += 1
+                delay = self._backoff(self._idle_loops, self.max_delay)
+        if hint is not None:
+            delay = max(delay, min(hint, self.max_hint))
+        return delay
+
+    def _backoff(self, n_loops, max_delay):
+        # Do not compute huge powers after a long idle period
+        if n_loops > 64:
+            return max_delay
+        return min(self.base_delay * self.backoff ** (n_loops - 1),
+                   max_delay)
+
+
+class RemotePoller(object):
+    """Fetch the change summaries of a server binding in a daemon thread
+
+    fetch(last_sync_date, last_root_definitions) returns the change summary
+    and the checkpoint data (sync date, root definitions) to fetch the next
+    one from. The delay between two polls is given by scheduler from the
+    number of changes and the errors of the last poll.
+
+    At most one result is queued: the next poll happens once the previous
+    result has been consumed with get_results. If on_result is not None, it
+    is called by the polling thread each time a new result is available.
+    """
+
+    def __init__(self, fetch, checkpoint, scheduler, on_result=None,
+                 name='RemotePoller'):
+        self._fetch = fetch
+        self._checkpoint = checkpoint
+        self._scheduler = scheduler
+        self._on_result = on_result
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._results = []
+        self._generation = 0
+        self._poll_requested = True
+        self._next_poll = None
+        self._stopped = False
+        self._thread = Thread(target=self._run, name=name)
+        self._thread.setDaemon(True)
+
+    def start(self, last_result=None):
+        """Start polling
+
+        last_result is the (summary, checkpoint, exc_info) of a poll
+        performed by the caller, if any, to schedule the first poll from.
+        """
+        if last_result is not None:
+            self._poll_requested = False
+            self._next_poll = time() + self._next_delay(*last_result)
+        self._thread.start()
+
+    def stop(self):
+        """Stop polling, without waiting for the poll in progress if any"""
+        self._stopped = True
+        self._wakeup.set()
+
+    def poll_now(self):
+        """Poll as soon as the queued result, if any, is consumed"""
+        with self._lock:
+            self._poll_requested = True
+        self._wakeup.set()
+
+    def reset(self, checkpoint):
+        """Poll again from checkpoint, discarding the results in flight
+
+        To be called when a result could not be applied: the next polls would
+        otherwise miss its changes.
+        """
+        with self._lock:
+            self._generation += 1
+            self._checkpoint = checkpoint
+            self._results = []
+            self._poll_requested = True
+        self._wakeup.set()
+
+    def has_results(self):
+        with self._lock:
+            return len(self._results) > 0
+
+    def get_results(self):
+        """Return the list of the (summary, checkpoint, exc_info) fetched
+
+        exc_info is the exception info of the error raised by fetch, if any,
+        summary and checkpoint being None in that case.
+        """
+        with self._lock:
+            results, self._results = self._results, []
+        if results:
+            self._wakeup.set()
+        return results
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._results:
+                    timeout = None
+                elif self._poll_requested:
+                    timeout = 0
+                else:
+                    timeout = self._next_poll - time()
+            if timeout is None or timeout > 0:
+                self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            if self._stopped:
+                return
+
+            with self._lock:
+                if self._results or (not self._poll_requested
+                                     and time() < self._next_poll):
+                    continue
+                self._poll_requested = False
+                generation = self._generation
+                checkpoint = self._checkpoint
+
+            try:
+                summary, new_checkpoint = self._fetch(*checkpoint)
+                exc_info = None
+            except Exception:
+                summary, new_checkpoint = None, None
+                exc_info = sys.exc_info()
+            with self._lock:
+                if generation != self._generation:
+                    # Reset while polling: poll again from the new checkpoint
+                    continue
+                if exc_info is None:
+                    self._checkpoint = new_checkpoint
+                self._results.append((summary, new_checkpoint, exc_info))
+                self._next_poll = time() + self._next_delay(
+                    summary, new_checkpoint, exc_info)
+            if self._on_result is not None:
+                self._on_result()
+
+    def _next_delay(self, summary, checkpoint, exc_info):
+        if exc_info is not None:
+            return self._scheduler.next_delay(
+                offline=True, hint=get_retry_after(exc_info[1]))
+        n_changes = len(summary['fileSystemChanges'])
+        if summary['hasTooManyChanges']:
+            n_changes += 1
+        return self._scheduler.next_delay(n_changes)
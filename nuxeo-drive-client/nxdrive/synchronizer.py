@@ -1,22 +1,48 @@
 """Handle synchronization logic."""
 import re
 import os.path
+import sys
+from collections import deque
+from collections import namedtuple
 from time import time
-from time import sleep
+from threading import Event
+from threading import Lock
+from threading import Thread
+from threading import local
 from datetime import datetime
 import urllib2
 import socket
 import httplib
 
-from sqlalchemy import not_, or_
+from sqlalchemy import and_, not_, or_
+from sqlalchemy import inspect
 import psutil
 
 from nxdrive.client import DEDUPED_BASENAME_PATTERN
 from nxdrive.client import safe_filename
 from nxdrive.client import NotFound
 from nxdrive.client import Unauthorized
+from nxdrive.client import LocalClient
 from nxdrive.model import ServerBinding
 from nxdrive.model import LastKnownState
+from nxdrive.model import DigestCache
+from nxdrive.model import LIVE_STATES
+from nxdrive.model import delete_states
+from nxdrive.model import forget_state_index
+from nxdrive.model import get_state_index
+from nxdrive.model import insert_states
+from nxdrive.model import is_database_locked
+from nxdrive.model import local_state_row
+from nxdrive.model import remote_state_row
+from nxdrive.model import update_states
+from nxdrive.local_watcher import LocalWatcher
+from nxdrive.local_watcher import get_local_watcher
+from nxdrive.remote_poller import PollScheduler
+from nxdrive.remote_poller import RemotePoller
+from nxdrive.remote_poller import get_retry_after
+from nxdrive.workers import DigestPool
+from nxdrive.workers import TreeWalker
+from nxdrive.workers import WorkerPool
 from nxdrive.logging_config import get_logger
 from nxdrive.utils import safe_long_path
 
@@ -37,6 +63,19 @@ POSSIBLE_NETWORK_ERROR_TYPES = (
 log = get_logger(__name__)
 
 
+# Plain snapshot of the server binding attributes required to build remote
+# clients: unlike ORM instances, it can be shared with worker threads
+ServerBindingInfo = namedtuple('ServerBindingInfo', [
+    'local_folder',
+    'server_url',
+    'remote_user',
+    'remote_password',
+    'remote_token',
+    'max_idle_connections',
+    'connection_idle_timeout',
+])
+
+
 def _log_offline(exception, context):
     if isinstance(exception, urllib2.HTTPError):
         msg = ("Client offline in %s: HTTP error with code %d"
@@ -79,9 +118,16 @@ def jaccard_index(set_1, set_2):
 
 
 def _local_children_names(doc_pair, session):
-    return set([child.local_name
-            for child in session.query(LastKnownState).filter_by(
-                local_parent_path=doc_pair.local_path).all()])
+    index = get_state_index(session, doc_pair.local_folder)
+    return set(child.local_name
+               for child in index.get_children(doc_pair.local_path))
+
+
+def _load_indexed_state(session, record):
+    """Load the state of a StateIndex record, from the session if present"""
+    if record is None:
+        return None
+    return session.query(LastKnownState).get(record.id)
 
 
 def rerank_local_rename_or_move_candidates(doc_pair, candidates, session):
@@ -141,14 +187,245 @@ def find_first_name_match(name, possible_pairs):
     return None
 
 
+def _is_in_subtrees(local_path, roots):
+    """Check whether local_path is one of roots or below one of them"""
+    while local_path not in roots:
+        if local_path == '/':
+            return False
+        local_path = local_path.rsplit('/', 1)[0] or '/'
+    return True
+
+
+class LocalScanCache(object):
+    """In-memory index of the states of a bound folder for local scans
+
+    Full scans preload all the states of the binding with a single query.
+    Otherwise states are lazily loaded with one query per scanned folder. The
+    scan updates the index when aligning, creating or deleting states so that
+    it stays consistent with the session without flushing it.
+    """
+
+    def __init__(self, session, local_folder, preload=False):
+        self._session = session
+        self._local_folder = local_folder
+        # local_parent_path -> {local_path: state}
+        self._children = {}
+        # remote_parent_ref -> [states not yet bound to any local file]
+        self._unbound = {}
+        self._complete = preload
+        if preload:
+            states = session.query(LastKnownState).filter_by(
+                local_folder=local_folder).all()
+            for state in states:
+                if state.local_path is None:
+                    self._unbound.setdefault(
+                        state.remote_parent_ref, []).append(state)
+                elif state.local_parent_path is not None:
+                    self._children.setdefault(
+                        state.local_parent_path, {})[state.local_path] = state
+
+    def get_children(self, local_path):
+        """Map the local paths of the children of a folder to their states"""
+        children = self._children.get(local_path)
+        if children is None:
+            if self._complete:
+                children = {}
+            else:
+                states = self._session.query(LastKnownState).filter_by(
+                    local_folder=self._local_folder,
+                    local_parent_path=local_path).all()
+                children = dict((s.local_path, s) for s in states)
+            self._children[local_path] = children
+        return children
+
+    def get_unbound_children(self, remote_parent_ref):
+        """States of remote children not yet bound to any local file"""
+        unbound = self._unbound.get(remote_parent_ref)
+        if unbound is None:
+            if self._complete:
+                unbound = []
+            else:
+                unbound = self._session.query(LastKnownState).filter_by(
+                    local_folder=self._local_folder,
+                    local_path=None,
+                    remote_parent_ref=remote_parent_ref).all()
+            self._unbound[remote_parent_ref] = unbound
+        return unbound
+
+    def add(self, state):
+        """Register a state that has just been bound to a local file"""
+        unbound = self._unbound.get(state.remote_parent_ref)
+        if unbound is not None and state in unbound:
+            unbound.remove(state)
+        children = self.get_children(state.local_parent_path)
+        children[state.local_path] = state
+
+    def remove(self, state):
+        """Unregister a state that is about to be deleted"""
+        if state.local_path is not None:
+            children = self._children.get(state.local_parent_path)
+            if children is not None:
+                children.pop(state.local_path, None)
+        else:
+            unbound = self._unbound.get(state.remote_parent_ref)
+            if unbound is not None and state in unbound:
+                unbound.remove(state)
+
+    def remove_unbound_subtree(self, state):
+        """Unregister the states that are about to be deleted with state
+
+        These are the states of state and its local descendants that are not
+        bound to any remote document.
+        """
+        if state.remote_ref is None:
+            self.remove(state)
+        folders = [state.local_path]
+        while folders:
+            children = self._children.get(folders.pop(), {})
+            for local_path, child in children.items():
+                if child.remote_ref is None:
+                    del children[local_path]
+                folders.append(local_path)
+
+
+class SyncThreadState(local):
+    """State of the synchronization running in the current thread
+
+    Each server binding being synchronized by its own thread in the loop,
+    the transfers in flight and the uncommitted scan progress are tracked
+    per thread.
+    """
+
+    def __init__(self):
+        self.transfer_pool = None
+        self.transfers = []
+        # Number of states changed by the ongoing scan since the last commit
+        self.scanned = 0
+        # Counters of the concurrent transfers
+        self.queued_transfers = 0
+        self.transferred = 0
+
+
+class BindingWorker(object):
+    """Thread running the stages of the synchronization loop for a binding
+
+    The exception info of the unexpected error that stopped the thread, if
+    any, is kept in exc_info. on_exit is called once the thread is done.
+    """
+
+    def __init__(self, synchronizer, local_folder, max_loops=None,
+                 delay=None, on_exit=None):
+        self.local_folder = local_folder
+        self.wakeup = Event()
+        self.exc_info = None
+        self._synchronizer = synchronizer
+        self._max_loops = max_loops
+        self._delay = delay
+        self._on_exit = on_exit
+        self._stopped = False
+        self._thread = Thread(
+            target=self._run,
+            name='BindingWorker-%s' % os.path.basename(local_folder))
+        self._thread.setDaemon(True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Ask the thread to stop once the ongoing stage is done"""
+        self._stopped = True
+        self.wakeup.set()
+
+    def is_stopped(self):
+        return self._stopped
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            self._synchronizer._synchronize_binding(
+                self, max_loops=self._max_loops, delay=self._delay)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            if self._on_exit is not None:
+                self._on_exit()
+
+
+class BindingSchedule(object):
+    """Schedule of the stages of the synchronization loop for a binding"""
+
+    def __init__(self, binding_info, poll_delay, local_scheduler,
+                 synchronize_scheduler, wakeup=None):
+        self.binding_info = binding_info
+        self.poll_delay = poll_delay
+        # Set when a remote poll completes
+        self.wakeup = wakeup if wakeup is not None else Event()
+        self.local_scheduler = local_scheduler
+        self.synchronize_scheduler = synchronize_scheduler
+        self.poller = None
+        self.next_local_scan = 0
+        self.next_synchronize = 0
+        # More pending pairs left by the last synchronization
+        self.more_pending = False
+        # Last synchronization failed: wait for next_synchronize whatever
+        # the changes found in the mean time
+        self.synchronize_failed = False
+        # Last remote poll or synchronization failed
+        self.offline = False
+
+    def next_run(self):
+        """Time of the next stage that is due"""
+        if self.poller is None or self.poller.has_results():
+            return 0
+        if self.offline:
+            return self.next_local_scan
+        return min(self.next_local_scan, self.next_synchronize)
+
+    def stop(self):
+        if self.poller is not None:
+            self.poller.stop()
+
+
 class Synchronizer(object):
     """Handle synchronization operations between the client FS and Nuxeo"""
 
-    # delay in seconds that ensures that two consecutive scans won't happen
-    # too closely from one another.
-    # TODO: make this a value returned by the server so that it can tell the
-    # client to slow down when the server cannot keep up with the load
+    # delay in seconds that ensures that two consecutive polls of the remote
+    # changes won't happen too closely from one another. The delay is doubled
+    # at each poll without changes, up to max_delay, or up to
+    # offline_max_delay while the server cannot be reached. The server can
+    # ask the client to slow down with a Retry-After header.
     delay = 10
+    max_delay = 120
+    offline_max_delay = 600
+
+    # The remote changes of each server binding are polled by a background
+    # thread while the local folders are scanned and the pending pairs
+    # synchronized on their own schedule by the synchronization thread.
+    # The local folders are scanned every local_scan_delay seconds, up to
+    # max_local_scan_delay seconds while no local change is found.
+    local_scan_delay = 2
+    max_local_scan_delay = 10
+
+    # Delay in seconds before running the stages of a binding again when the
+    # database is still locked by another thread after SQLITE_BUSY_TIMEOUT,
+    # doubled at each consecutive failure up to max_locked_delay
+    locked_delay = 1
+    max_locked_delay = 60
+
+    # Maximum delay in seconds between two synchronizations of the pending
+    # pairs of a binding, which otherwise happen as soon as some local or
+    # remote changes are detected. After a network error, the delay backs
+    # off up to offline_max_delay, or as long as asked by the server.
+    synchronize_delay = 10
+
+    # Maximum number of seconds between two checks of the stop requests
+    # while sleeping between two iterations of the loop
+    stop_check_period = 1
 
     # Number of consecutive sync operations to perform without refreshing
     # the internal state DB
@@ -163,9 +440,59 @@ class Synchronizer(object):
     # to a fixed cooldown period
     error_skip_period = 300  # 5 minutes
 
+    # Number of threads listing the local folders in parallel during full
+    # local scans, 0 to scan sequentially
+    local_scan_workers = 0
+
+    # Number of concurrent GetChildren requests sent during full remote scans,
+    # 0 to scan sequentially. Also used to fetch the changed remote documents
+    # when the server cannot fetch them in batches.
+    remote_scan_workers = 0
+
+    # SQLite limits the number of variables per query
+    max_in_clause_size = 500
+
+    # Number of states inserted per statement when scanning a folder none of
+    # the children of which are known yet, e.g. right after binding. 0 to
+    # create the states one by one.
+    ingest_chunk_size = 1000
+
+    # Number of states created or updated by a scan between two commits so
+    # that the other bindings are not locked out of the database for the
+    # whole scan, 0 to commit once the scan is done
+    scan_commit_size = 1000
+
+    # Maximum number of seconds the fs items fetched while synchronizing a
+    # document pair are reused instead of being fetched again
+    fs_item_cache_ttl = 5
+
+    # Number of threads uploading and downloading the files of the pending
+    # pairs concurrently, 0 to transfer them one at a time. The cap applies
+    # to all the bindings synchronized by the loop.
+    transfer_workers = 0
+
+    # Number of threads hashing the new or modified local files found by a
+    # scan, 0 to compute the digests in the scanning thread
+    digest_workers = 0
+
+    # Maximum number of bytes hashed by the digest workers in a single scan,
+    # the digests of the other files being postponed. None for no limit.
+    scan_digest_budget = 512 * 1024 ** 2
+
     def __init__(self, controller):
         self._controller = controller
         self._frontend = None
+        self._local_watchers = {}
+        self._digest_caches = {}
+        # Walkers of the ongoing parallel remote scans, by local folder
+        self._remote_scan_walkers = {}
+        self._sync_state = SyncThreadState()
+        # Transfer pool shared by the bindings synchronized by the loop
+        self._shared_transfer_pool = None
+        # Held by the inline transfers, without transfer workers
+        self._transfer_lock = Lock()
+        # Set by the binding workers to wake the loop up when done
+        self._loop_wakeup = Event()
 
     def register_frontend(self, frontend):
         self._frontend = frontend
@@ -173,28 +500,192 @@ class Synchronizer(object):
     def get_session(self):
         return self._controller.get_session()
 
+    def _get_digest_cache(self, local_folder, session):
+        """Return the loaded digest cache of a bound local folder"""
+        cache = self._digest_caches.get(local_folder)
+        if cache is None:
+            cache = DigestCache(local_folder)
+            self._digest_caches[local_folder] = cache
+        cache.load(session)
+        return cache
+
+    def _flush_digest_cache(self, local_folder, session):
+        """Write the new digests in the session, return True if any"""
+        cache = self._digest_caches.get(local_folder)
+        if cache is None:
+            return False
+        return cache.flush(session)
+
+    def forget_digest_cache(self, local_folder):
+        """Drop the cached digests of a folder that is no longer bound"""
+        self._digest_caches.pop(local_folder, None)
+
+    def get_local_client(self, local_folder, session=None):
+        """Local client reusing the cached digests of unchanged files"""
+        session = self.get_session() if session is None else session
+        return LocalClient(local_folder, digest_cache=self._get_digest_cache(
+            local_folder, session))
+
     def _delete_with_descendant_states(self, session, doc_pair,
         keep_root=False):
         """Delete the metadata of the descendants of deleted doc"""
-        # delete local and remote descendants first
-        if doc_pair.local_path is not None:
-            local_children = session.query(LastKnownState).filter_by(
-                local_folder=doc_pair.local_folder,
-                local_parent_path=doc_pair.local_path).all()
-            for child in local_children:
-                self._delete_with_descendant_states(session, child)
-
-        if doc_pair.remote_ref is not None:
-            remote_children = session.query(LastKnownState).filter_by(
-                local_folder=doc_pair.local_folder,
-                remote_parent_ref=doc_pair.remote_ref).all()
-            for child in remote_children:
-                self._delete_with_descendant_states(session, child)
-
+        self._delete_states(session, self._get_descendant_ids(
+            session, doc_pair))
         # delete parent folder in the end
         if not keep_root:
             session.delete(doc_pair)
 
+    def _get_descendant_ids(self, session, doc_pair, local=True,
+                            remote=True):
+        """Collect the ids of the local and / or remote descendants of doc
+
+        Instead of querying the children of each descendant, the local
+        descendants are matched all at once by local path prefix and the
+        remote ones level by level with IN clauses on their parent refs.
+        """
+        local_folder = doc_pair.local_folder
+        columns = (LastKnownState.id, LastKnownState.local_path,
+                   LastKnownState.remote_ref)
+        ids = set([doc_pair.id])
+        scanned_paths = set()
+        local_paths, remote_refs = [], []
+        if local and doc_pair.local_path is not None:
+            local_paths.append(doc_pair.local_path)
+        if remote and doc_pair.remote_ref is not None:
+            remote_refs.append(doc_pair.remote_ref)
+
+        while local_paths or remote_refs:
+            rows = []
+            for local_path in local_paths:
+                if _is_in_subtrees(local_path, scanned_paths):
+                    continue
+                scanned_paths.add(local_path)
+                rows.extend(session.query(*columns).filter(
+                    LastKnownState.local_folder == local_folder,
+                    LastKnownState.local_subtree(local_path)).all())
+            for chunk in self._in_chunks(remote_refs):
+                rows.extend(session.query(*columns).filter(
+                    LastKnownState.local_folder == local_folder,
+                    LastKnownState.remote_parent_ref.in_(chunk)).all())
+
+            local_paths, remote_refs = [], []
+            for id_, local_path, remote_ref in rows:
+                if id_ in ids:
+                    continue
+                ids.add(id_)
+                if local and local_path is not None:
+                    local_paths.append(local_path)
+                if remote and remote_ref is not None:
+                    remote_refs.append(remote_ref)
+
+        ids.discard(doc_pair.id)
+        return ids
+
+    def _delete_states(self, session, ids):
+        """Delete the states of the given ids in bulk"""
+        for chunk in self._in_chunks(list(ids)):
+            delete_states(session, LastKnownState.id.in_(chunk))
+
+    def _in_chunks(self, items):
+        """Split items in chunks small enough for IN clauses"""
+        for i in range(0, len(items), self.max_in_clause_size):
+            yield items[i:i + self.max_in_clause_size]
+
+    def _has_no_known_children(self, session, doc_pair):
+        """Check that no state is bound to any child of a folder yet"""
+        children = [LastKnownState.remote_parent_ref == doc_pair.remote_ref]
+        if doc_pair.local_path is not None:
+            children.append(
+                LastKnownState.local_parent_path == doc_pair.local_path)
+        return session.query(LastKnownState.id).filter(
+            LastKnownState.local_folder == doc_pair.local_folder,
+            or_(*children)).first() is None
+
+    def _ingest_subtree(self, session, doc_pair, children_info,
+                        get_children_info, make_row, get_key, digests=None,
+                        get_known_keys=None):
+        """Create the states of the new descendants of a folder in bulk
+
+        None of the children of doc_pair being known, there is nothing to
+        align them with: the rows of the whole subtree are built from the
+        listings and inserted by chunks of ingest_chunk_size instead of
+        going through the unit of work state by state. The folders are
+        listed breadth first, as prefetched by the tree walkers.
+
+        get_known_keys(keys), if provided, returns the keys of the listed
+        children that already have a state, e.g. documents moved into the
+        new folders. They are left out, along with their descendants, and
+        their infos returned for the caller to align them one by one.
+        """
+        # The parent must be in the database to update the folder counters
+        session.flush()
+        rows, n_rows = [], 0
+        folders = deque()
+        known = []
+        while True:
+            if get_known_keys is not None and children_info:
+                known_keys = get_known_keys(
+                    [get_key(child_info) for child_info in children_info])
+                if known_keys:
+                    known.extend(c for c in children_info
+                                 if get_key(c) in known_keys)
+                    children_info = [c for c in children_info
+                                     if get_key(c) not in known_keys]
+            if digests is not None:
+                for child_info in children_info:
+                    digests.submit(child_info)
+            for child_info in children_info:
+                rows.append(make_row(doc_pair.local_folder, child_info))
+                if child_info.folderish:
+                    folders.append(get_key(child_info))
+                if len(rows) >= self.ingest_chunk_size:
+                    insert_states(session, rows)
+                    n_rows += len(rows)
+                    self._commit_scan_progress(session, len(rows))
+                    rows = []
+            if not folders:
+                break
+            try:
+                children_info = get_children_info(folders.popleft())
+            except OSError:
+                # Local folder deleted in the mean time, the next scan will
+                # take care of it
+                children_info = []
+        insert_states(session, rows)
+        n_rows += len(rows)
+        log.debug("Created %d new states under %r in bulk", n_rows, doc_pair)
+        return known
+
+    def _commit_scan_progress(self, session, n_states=1):
+        """Commit the ongoing scan every scan_commit_size changed states
+
+        The states loaded by the scan are not expired by the commit: they
+        are only changed by the thread of the binding.
+        """
+        if self.scan_commit_size <= 0:
+            return
+        state = self._sync_state
+        state.scanned += n_states
+        if state.scanned < self.scan_commit_size:
+            return
+        state.scanned = 0
+        expire_on_commit = session.expire_on_commit
+        session.expire_on_commit = False
+        try:
+            session.commit()
+        finally:
+            session.expire_on_commit = expire_on_commit
+
+    def _get_known_remote_refs(self, session, local_folder, remote_refs):
+        """Return the subset of remote_refs already bound to a state"""
+        known = set()
+        for chunk in self._in_chunks(remote_refs):
+            known.update(ref for ref, in session.query(
+                LastKnownState.remote_ref).filter(
+                    LastKnownState.local_folder == local_folder,
+                    LastKnownState.remote_ref.in_(chunk)))
+        return known
+
     def scan_local(self, server_binding_or_local_path, from_state=None,
                    session=None):
         """Recursively scan the bound local folder looking for updates"""
@@ -213,31 +704,162 @@ class Synchronizer(object):
                 local_path='/',
                 local_folder=server_binding.local_folder).one()
 
-        client = from_state.get_local_client()
+        client = self.get_local_client(from_state.local_folder, session)
         info = client.get_info('/')
-        # recursive update
-        self._scan_local_recursive(session, client, from_state, info)
+        # Load all the states at once instead of querying them file by file
+        cache = LocalScanCache(session, from_state.local_folder, preload=True)
+        pool = None
+        if self.local_scan_workers > 0:
+            # Prefetch the folder listings in worker threads, the walker
+            # being used as the local client by the recursive scan running
+            # in the current thread
+            pool = WorkerPool(self.local_scan_workers,
+                              name='LocalScanWorker')
+            client = TreeWalker(client.get_children_info, pool)
+            client.prefetch(info.path)
+        digest_pool, digests = self._start_digest_pool()
+        try:
+            # recursive update
+            self._scan_local_recursive(session, client, from_state, info,
+                                       cache, digests=digests)
+        finally:
+            if pool is not None:
+                pool.stop()
+                log.trace("Local scan of %s: %d folders prefetched, %d"
+                          " listed inline", from_state.local_folder,
+                          client.prefetched, client.listed_inline)
+            self._stop_digest_pool(digest_pool, digests,
+                                   from_state.local_folder)
+        self._flush_digest_cache(from_state.local_folder, session)
         session.commit()
 
-    def _mark_deleted_local_recursive(self, session, doc_pair):
-        """Update the metadata of the descendants of locally deleted doc"""
-        # delete descendants first
-        children = session.query(LastKnownState).filter_by(
-            local_folder=doc_pair.local_folder,
-            local_parent_path=doc_pair.local_path).all()
-        for child in children:
-            self._mark_deleted_local_recursive(session, child)
+    def _start_digest_pool(self):
+        """Start the workers hashing files during a scan, if enabled"""
+        if self.digest_workers <= 0:
+            return None, None
+        pool = WorkerPool(self.digest_workers, name='DigestWorker')
+        return pool, DigestPool(pool, byte_budget=self.scan_digest_budget)
 
-        # update the state of the parent it-self
-        if doc_pair.remote_ref is None:
-            # Unbound child metadata can be removed
-            session.delete(doc_pair)
-        else:
-            # mark it for remote deletion
-            doc_pair.update_local(None)
+    def _stop_digest_pool(self, pool, digests, local_folder):
+        if pool is None:
+            return
+        pool.stop()
+        log.trace("Hashed %d files (%d bytes) of %s in %d digest workers",
+                  digests.submitted, digests.submitted_bytes, local_folder,
+                  self.digest_workers)
+        if digests.postponed:
+            log.debug("Postponed the digest computation of %d files of %s"
+                      " as the scan budget of %d bytes is exhausted",
+                      digests.postponed, local_folder,
+                      self.scan_digest_budget)
+
+    def _mark_deleted_local_subtree(self, session, doc_pair, cache):
+        """Update the metadata of locally deleted doc and its descendants
+
+        The states are updated in bulk, matched by local path prefix.
+        """
+        cache.remove_unbound_subtree(doc_pair)
+        self._forget_digest(doc_pair, recursive=True)
+        in_subtree = and_(
+            LastKnownState.local_folder == doc_pair.local_folder,
+            LastKnownState.local_subtree(doc_pair.local_path))
+
+        # Unbound metadata can be removed
+        delete_states(session, in_subtree, LastKnownState.remote_ref == None)
+
+        # mark the others for remote deletion
+        update_states(session, {
+            LastKnownState.local_state: 'deleted',
+            LastKnownState.pair_state: LastKnownState.pair_state_expression(
+                local_state='deleted'),
+        }, in_subtree, LastKnownState.remote_ref != None,
+            LastKnownState.local_state.in_(LIVE_STATES))
+
+    def _forget_digest(self, doc_pair, recursive=False):
+        cache = self._digest_caches.get(doc_pair.local_folder)
+        if cache is not None and doc_pair.local_path is not None:
+            cache.forget(doc_pair.local_path, recursive=recursive)
+
+    def _get_local_watcher(self, server_binding):
+        """Return the started watcher of a bound local folder"""
+        local_folder = server_binding.local_folder
+        watcher = self._local_watchers.get(local_folder)
+        if watcher is None:
+            watcher = get_local_watcher(LocalClient(local_folder))
+            try:
+                watcher.start()
+            except OSError as e:
+                # Typically EMFILE when reaching fs.inotify.max_user_instances
+                log.warning("Cannot watch the file system events of %s,"
+                            " falling back to full scans: %s",
+                            local_folder, e)
+                watcher = LocalWatcher(watcher.client)
+            self._local_watchers[local_folder] = watcher
+        return watcher
+
+    def stop_local_watchers(self):
+        """Release the file system resources used to watch local folders"""
+        for watcher in self._local_watchers.values():
+            watcher.stop()
+        self._local_watchers.clear()
+
+    def _update_local_states(self, server_binding, session=None):
+        """Incrementally update the local states from file system events
+
+        Only the folders with recent activity are rescanned. Fallback to a
+        full local scan at startup, when file system events are not available
+        or when some events have been lost. Return False if no folder had to
+        be scanned.
+        """
+        session = self.get_session() if session is None else session
+        local_folder = server_binding.local_folder
+        watcher = self._get_local_watcher(server_binding)
+        dirty_paths = watcher.get_changes()
+        if dirty_paths is None:
+            log.trace("Full local scan of %s", local_folder)
+            self.scan_local(server_binding, session=session)
+            return True
 
-    def _scan_local_recursive(self, session, client, doc_pair, local_info):
-        """Recursively scan the bound local folder looking for updates"""
+        if not dirty_paths:
+            return False
+        log.trace("Rescanning %d local folders of %s", len(dirty_paths),
+                  local_folder)
+        client = self.get_local_client(local_folder, session)
+        cache = LocalScanCache(session, local_folder)
+        digest_pool, digests = self._start_digest_pool()
+        try:
+            # Parents first so that new sub folders are created before being
+            # rescanned
+            for path in sorted(dirty_paths):
+                doc_pair = session.query(LastKnownState).filter_by(
+                    local_folder=local_folder, local_path=path).first()
+                if doc_pair is None:
+                    # New folder: the rescan of one of its ancestors will
+                    # take care of it
+                    continue
+                local_info = client.get_info(path, raise_if_missing=False)
+                if local_info is None or not local_info.folderish:
+                    # Deleted or replaced folder: the rescan of the parent
+                    # folder will take care of it
+                    continue
+                self._scan_local_recursive(session, client, doc_pair,
+                                           local_info, cache,
+                                           recursive=False, digests=digests)
+        finally:
+            self._stop_digest_pool(digest_pool, digests, local_folder)
+        self._flush_digest_cache(local_folder, session)
+        session.commit()
+        return True
+
+    def _scan_local_recursive(self, session, client, doc_pair, local_info,
+                              cache, recursive=True, digests=None):
+        """Recursively scan the bound local folder looking for updates
+
+        If recursive is False, only the direct children of the folder are
+        refreshed, new sub folders being scanned recursively though. If a
+        digest pool is provided, the digests of the new and modified files
+        are computed ahead by its workers.
+        """
         if local_info is None:
             raise ValueError("Cannot bind %r to missing local info" %
                              doc_pair)
@@ -257,16 +879,29 @@ class Synchronizer(object):
             return
 
         children_path = set(c.path for c in children_info)
+        children_pairs = cache.get_children(local_info.path)
+        # Skip the pairs whose deletion has already been detected along with
+        # their descendants
+        deleted_pairs = [pair for path, pair in children_pairs.items()
+                         if path not in children_path
+                         and pair.local_state != 'deleted']
+        for deleted in deleted_pairs:
+            self._mark_deleted_local_subtree(session, deleted, cache)
+
+        if (self.ingest_chunk_size > 0 and children_info
+                and not children_pairs
+                and not cache.get_unbound_children(doc_pair.remote_ref)):
+            self._ingest_subtree(session, doc_pair, children_info,
+                                 client.get_children_info, local_state_row,
+                                 lambda info: info.path, digests=digests)
+            return
 
-        q = session.query(LastKnownState).filter_by(
-            local_folder=doc_pair.local_folder,
-            local_parent_path=local_info.path,
-        )
-        if len(children_path) > 0:
-            q = q.filter(not_(LastKnownState.local_path.in_(children_path)))
-
-        for deleted in q.all():
-            self._mark_deleted_local_recursive(session, deleted)
+        if digests is not None:
+            for child_info in children_info:
+                child_pair = children_pairs.get(child_info.path)
+                if (child_pair is None
+                        or child_pair.needs_local_digest(child_info)):
+                    digests.submit(child_info)
 
         # recursively update children
         for child_info in children_info:
@@ -274,9 +909,14 @@ class Synchronizer(object):
             # TODO: detect whether this is a __digit suffix name and relax the
             # alignment queries accordingly
             child_name = os.path.basename(child_info.path)
-            child_pair = session.query(LastKnownState).filter_by(
-                local_folder=doc_pair.local_folder,
-                local_path=child_info.path).first()
+            child_pair = children_pairs.get(child_info.path)
+            known_child = child_pair is not None
+
+            if child_pair is None:
+                unbound_pairs = [
+                    pair for pair in cache.get_unbound_children(
+                        doc_pair.remote_ref)
+                    if bool(pair.folderish) == child_info.folderish]
 
             if child_pair is None and not child_info.folderish:
                 # Try to find an existing remote doc that has not yet been
@@ -284,13 +924,8 @@ class Synchronizer(object):
                 # and digest
                 try:
                     child_digest = child_info.get_digest()
-                    possible_pairs = session.query(LastKnownState).filter_by(
-                        local_folder=doc_pair.local_folder,
-                        local_path=None,
-                        remote_parent_ref=doc_pair.remote_ref,
-                        folderish=child_info.folderish,
-                        remote_digest=child_digest,
-                    ).all()
+                    possible_pairs = [pair for pair in unbound_pairs
+                                      if pair.remote_digest == child_digest]
                     child_pair = find_first_name_match(
                         child_name, possible_pairs)
                     if child_pair is not None:
@@ -306,13 +941,7 @@ class Synchronizer(object):
 
             if child_pair is None:
                 # Previous attempt has failed: relax the digest constraint
-                possible_pairs = session.query(LastKnownState).filter_by(
-                    local_folder=doc_pair.local_folder,
-                    local_path=None,
-                    remote_parent_ref=doc_pair.remote_ref,
-                    folderish=child_info.folderish,
-                ).all()
-                child_pair = find_first_name_match(child_name, possible_pairs)
+                child_pair = find_first_name_match(child_name, unbound_pairs)
                 if child_pair is not None:
                     log.debug("Matched local %s with remote %s by name only",
                               child_info.path, child_pair.remote_name)
@@ -325,9 +954,15 @@ class Synchronizer(object):
                 log.debug("Detected a new non-alignable local file at %s",
                           child_pair.local_path)
 
-
-            self._scan_local_recursive(session, client, child_pair,
-                                       child_info)
+            if recursive or not known_child:
+                self._scan_local_recursive(session, client, child_pair,
+                                           child_info, cache,
+                                           digests=digests)
+            else:
+                child_pair.update_local(child_info)
+            if not known_child:
+                cache.add(child_pair)
+            self._commit_scan_progress(session)
 
     def scan_remote(self, server_binding_or_local_path, from_state=None,
                     session=None):
@@ -360,26 +995,81 @@ class Synchronizer(object):
             session.commit()
             return
 
-        # recursive update
-        self._scan_remote_recursive(session, client, from_state, remote_info)
+        pool = None
+        if self.remote_scan_workers > 0:
+            # Keep several GetChildren requests in flight, the walker being
+            # used as the remote client by the recursive scan running in the
+            # current thread
+            pool = WorkerPool(self.remote_scan_workers,
+                              name='RemoteScanWorker')
+            client = TreeWalker(self._get_remote_children_lister(
+                from_state.server_binding), pool,
+                get_key=lambda info: info.uid)
+            client.prefetch(remote_info.uid)
+            self._remote_scan_walkers[server_binding.local_folder] = client
+        try:
+            # recursive update
+            self._scan_remote_recursive(session, client, from_state,
+                                        remote_info)
+        finally:
+            if pool is not None:
+                pool.stop()
+                if self._remote_scan_walkers.get(
+                        server_binding.local_folder) is client:
+                    del self._remote_scan_walkers[server_binding.local_folder]
+                stats = client.get_stats()
+                log.debug("Remote scan of %s: %d items in %d folders"
+                          " listed in %.1fs (%.1f items/s)",
+                          server_binding.local_folder, stats['items'],
+                          stats['folders'], stats['elapsed'],
+                          stats['items_per_second'])
         session.commit()
 
-    def _mark_deleted_remote_recursive(self, session, doc_pair):
-        """Update the metadata of the descendants of remotely deleted doc"""
-        # delete descendants first
-        children = session.query(LastKnownState).filter_by(
-            local_folder=doc_pair.local_folder,
-            remote_parent_ref=doc_pair.remote_ref).all()
-        for child in children:
-            self._mark_deleted_remote_recursive(session, child)
+    def _make_binding_info(self, server_binding):
+        """Snapshot of a server binding that is safe to share with threads"""
+        return ServerBindingInfo(*[getattr(server_binding, field)
+                                   for field in ServerBindingInfo._fields])
 
-        # update the state of the parent it-self
-        if doc_pair.local_path is None:
-            # Unbound child metadata can be removed
-            session.delete(doc_pair)
-        else:
-            # schedule it for local deletion
-            doc_pair.update_remote(None)
+    def _get_remote_children_lister(self, server_binding):
+        """Function listing remote children with a thread local client"""
+        binding_info = self._make_binding_info(server_binding)
+
+        def list_children(fs_item_id):
+            client = self._controller.get_remote_fs_client(binding_info)
+            return client.get_children_info(fs_item_id)
+
+        return list_children
+
+    def get_remote_scan_progress(self, local_folder):
+        """Counters of the ongoing parallel remote scan of a binding
+
+        None if no such scan is running for the binding.
+        """
+        walker = self._remote_scan_walkers.get(local_folder)
+        return walker.get_stats() if walker is not None else None
+
+    def _mark_deleted_remote_subtree(self, session, doc_pair):
+        """Update the metadata of remotely deleted doc and its descendants
+
+        The states are updated in bulk, the descendants being collected level
+        by level from their remote parent refs.
+        """
+        ids = self._get_descendant_ids(session, doc_pair, local=False)
+        ids.add(doc_pair.id)
+        for chunk in self._in_chunks(list(ids)):
+            in_chunk = LastKnownState.id.in_(chunk)
+
+            # Unbound metadata can be removed
+            delete_states(session, in_chunk, LastKnownState.local_path == None)
+
+            # schedule the others for local deletion
+            update_states(session, {
+                LastKnownState.remote_state: 'deleted',
+                LastKnownState.pair_state:
+                    LastKnownState.pair_state_expression(
+                        remote_state='deleted'),
+            }, in_chunk, LastKnownState.local_path != None,
+                LastKnownState.remote_state.in_(LIVE_STATES))
 
     def _scan_remote_recursive(self, session, client, doc_pair, remote_info,
         force_recursion=True):
@@ -401,6 +1091,21 @@ class Synchronizer(object):
 
         # Detect recently deleted children
         children_info = client.get_children_info(remote_info.uid)
+        if (self.ingest_chunk_size > 0 and children_info
+                and self._has_no_known_children(session, doc_pair)):
+            moved = self._ingest_subtree(
+                session, doc_pair, children_info, client.get_children_info,
+                remote_state_row, lambda info: info.uid,
+                get_known_keys=lambda refs: self._get_known_remote_refs(
+                    session, doc_pair.local_folder, refs))
+            # The documents moved into the new folders are aligned as usual
+            for child_info in moved:
+                child_pair = session.query(LastKnownState).filter_by(
+                    local_folder=doc_pair.local_folder,
+                    remote_ref=child_info.uid).one()
+                self._scan_remote_recursive(session, client, child_pair,
+                                            child_info)
+            return
         children_refs = set(c.uid for c in children_info)
 
         q = session.query(LastKnownState).filter_by(
@@ -411,7 +1116,7 @@ class Synchronizer(object):
             q = q.filter(not_(LastKnownState.remote_ref.in_(children_refs)))
 
         for deleted in q.all():
-            self._mark_deleted_remote_recursive(session, deleted)
+            self._mark_deleted_remote_subtree(session, deleted)
 
         # Recursively update children
         for child_info in children_info:
@@ -430,6 +1135,7 @@ class Synchronizer(object):
             if new_pair or force_recursion:
                 self._scan_remote_recursive(session, client, child_pair,
                                         child_info)
+            self._commit_scan_progress(session)
 
     def _find_remote_child_match_or_create(self, parent_pair, child_info,
                                            session=None):
@@ -478,15 +1184,30 @@ class Synchronizer(object):
         session.add(child_pair)
         return child_pair, True
 
-    def synchronize_one(self, doc_pair, session=None):
-        """Refresh state and perform network transfer for a pair of documents."""
+    def synchronize_one(self, doc_pair, session=None, commit=True):
+        """Refresh state and perform network transfer for a pair of documents.
+
+        If commit is False, the changes are left in the session for the
+        caller to commit them along with the ones of other pairs.
+        """
         session = self.get_session() if session is None else session
         # Find a cached remote client for the server binding of the file to
         # synchronize
         remote_client = self.get_remote_fs_client(doc_pair.server_binding)
-        # local clients are cheap
-        local_client = doc_pair.get_local_client()
+        # local clients are cheap but share the digest cache of the binding
+        local_client = self.get_local_client(doc_pair.local_folder, session)
 
+        # Do not fetch the same fs items several times while synchronizing
+        # this pair
+        remote_client.enable_fs_item_cache(self.fs_item_cache_ttl)
+        try:
+            self._synchronize_one(doc_pair, session, local_client,
+                                  remote_client, commit)
+        finally:
+            remote_client.disable_fs_item_cache()
+
+    def _synchronize_one(self, doc_pair, session, local_client,
+                         remote_client, commit):
         # Update the status the collected info of this file to make sure
         # we won't perfom inconsistent operations
 
@@ -506,9 +1227,10 @@ class Synchronizer(object):
                 and doc_pair.local_path is None):
                 doc_pair.update_state(remote_state='created')
 
-        if len(session.dirty):
+        if commit and len(session.dirty):
             # Make refreshed state immediately available to other
             # processes as file transfer can take a long time
+            self._flush_digest_cache(doc_pair.local_folder, session)
             session.commit()
 
         # TODO: refactor blob access API to avoid loading content in memory
@@ -524,9 +1246,12 @@ class Synchronizer(object):
             sync_handler(doc_pair, session, local_client, remote_client,
                          local_info, remote_info)
 
+        if not commit:
+            return
         # Ensure that concurrent process can monitor the synchronization
         # progress
-        if len(session.dirty) != 0 or len(session.deleted) != 0:
+        flushed = self._flush_digest_cache(doc_pair.local_folder, session)
+        if flushed or len(session.dirty) != 0 or len(session.deleted) != 0:
             session.commit()
 
     def _synchronize_locally_modified(self, doc_pair, session,
@@ -534,33 +1259,78 @@ class Synchronizer(object):
         if doc_pair.remote_digest != doc_pair.local_digest:
             log.debug("Updating remote document '%s'.",
                       doc_pair.remote_name)
-            remote_client.update_content(
-                doc_pair.remote_ref,
-                local_client.get_content(doc_pair.local_path),
-                name=doc_pair.remote_name,
-            )
-            doc_pair.refresh_remote(remote_client)
-        doc_pair.update_state('synchronized', 'synchronized')
+
+            def uploaded(remote_info):
+                doc_pair.update_remote(remote_info)
+                doc_pair.update_state('synchronized', 'synchronized')
+
+            self._transfer(doc_pair, remote_client, None, self._upload,
+                           uploaded, local_client, doc_pair.local_path,
+                           doc_pair.remote_ref, doc_pair.remote_name)
+        else:
+            doc_pair.update_state('synchronized', 'synchronized')
+
+    def _upload(self, remote_client, local_client, local_path, remote_ref,
+                name):
+        """Transfer: upload new content, return the updated remote info"""
+        with local_client.get_content_stream(local_path) as content:
+            remote_client.update_content(remote_ref, content, name=name)
+        return remote_client.get_info(remote_ref, raise_if_missing=False)
 
     def _synchronize_remotely_modified(self, doc_pair, session,
         local_client, remote_client, local_info, remote_info):
         if doc_pair.remote_digest != doc_pair.local_digest != None:
             log.debug("Updating local file '%s'.",
                       doc_pair.get_local_abspath())
-            content = remote_client.get_content(doc_pair.remote_ref)
-            try:
-                local_client.update_content(doc_pair.local_path, content)
-                doc_pair.refresh_local(local_client)
+
+            def downloaded(local_info):
+                if local_info is None:
+                    log.debug("Delaying update for remotely modified "
+                              "content %r due to concurrent file access.",
+                              doc_pair)
+                    return
+                doc_pair.update_local(local_info)
                 doc_pair.update_state('synchronized', 'synchronized')
-            except (IOError, WindowsError):
-                log.debug("Delaying update for remotely modified "
-                          "content %r due to concurrent file access.",
-                          doc_pair)
+
+            self._transfer(doc_pair, remote_client, None, self._download,
+                           downloaded, local_client, doc_pair.local_path,
+                           doc_pair.remote_ref, remote_info)
         else:
             # digest agree, no need to transfer additional bytes over the
             # network
             doc_pair.update_state('synchronized', 'synchronized')
 
+    def _download(self, remote_client, local_client, local_path, remote_ref,
+                  remote_info, replace=True):
+        """Transfer: download remote content, return the new local info
+
+        The content is downloaded next to the file and replaces it once
+        complete. When replacing an existing file, return None if it cannot
+        be replaced because of a concurrent access.
+
+        Raise ValueError if the downloaded content does not match the remote
+        digest, the .part file is then dropped.
+        """
+        with local_client.open_part_file(local_path) as part:
+            remote_client.get_content(remote_ref, file_out=part,
+                                      fs_item_info=remote_info)
+            digest_algorithm = (remote_info.digest_algorithm
+                                if remote_info is not None else None)
+            if (digest_algorithm is not None
+                    and remote_info.digest is not None
+                    and digest_algorithm.lower() == part.digest_func
+                    and part.get_digest() != remote_info.digest):
+                part.abort()
+                raise ValueError(
+                    "Downloaded content of %s does not match the remote"
+                    " digest %s" % (local_path, remote_info.digest))
+            if not replace:
+                return part.commit()
+            try:
+                return part.commit()
+            except (IOError, WindowsError):
+                return None
+
     def _synchronize_locally_created(self, doc_pair, session,
         local_client, remote_client, local_info, remote_info):
         if self._detect_resolve_local_move(doc_pair, session,
@@ -569,10 +1339,9 @@ class Synchronizer(object):
         name = os.path.basename(doc_pair.local_path)
         # Find the parent pair to find the ref of the remote folder to
         # create the document
-        parent_pair = session.query(LastKnownState).filter_by(
-            local_folder=doc_pair.local_folder,
-            local_path=doc_pair.local_parent_path
-        ).first()
+        index = get_state_index(session, doc_pair.local_folder)
+        parent_pair = _load_indexed_state(
+            session, index.get_by_path(doc_pair.local_parent_path))
         if parent_pair is None or parent_pair.remote_ref is None:
             # Illegal state: report the error and let's wait for the
             # parent folder issue to get resolved first
@@ -581,28 +1350,39 @@ class Synchronizer(object):
                 "Parent folder of %s is not bound to a remote folder"
                 % doc_pair.get_local_abspath())
         parent_ref = parent_pair.remote_ref
+
+        def created(remote_info):
+            doc_pair.update_remote(remote_info)
+            doc_pair.update_state('synchronized', 'synchronized')
+
         if doc_pair.folderish:
             log.debug("Creating remote folder '%s' in folder '%s'",
                       name, parent_pair.remote_name)
             remote_ref = remote_client.make_folder(parent_ref, name)
+            created(remote_client.get_info(remote_ref))
         else:
             log.debug("Creating remote document '%s' in folder '%s'",
                       name, parent_pair.remote_name)
-            remote_ref = remote_client.make_file(
-                parent_ref, name,
-                content=local_client.get_content(doc_pair.local_path))
-        doc_pair.update_remote(remote_client.get_info(remote_ref))
-        doc_pair.update_state('synchronized', 'synchronized')
+            self._transfer(doc_pair, remote_client, None, self._upload_new,
+                           created, local_client, doc_pair.local_path,
+                           parent_ref, name)
+
+    def _upload_new(self, remote_client, local_client, local_path,
+                    parent_ref, name):
+        """Transfer: create a remote file, return its remote info"""
+        with local_client.get_content_stream(local_path) as content:
+            remote_ref = remote_client.make_file(parent_ref, name,
+                                                 content=content)
+        return remote_client.get_info(remote_ref)
 
     def _synchronize_remotely_created(self, doc_pair, session,
         local_client, remote_client, local_info, remote_info):
         name = remote_info.name
         # Find the parent pair to find the path of the local folder to
         # create the document into
-        parent_pair = session.query(LastKnownState).filter_by(
-            local_folder=doc_pair.local_folder,
-            remote_ref=remote_info.parent_uid,
-        ).first()
+        index = get_state_index(session, doc_pair.local_folder)
+        parent_pair = _load_indexed_state(
+            session, index.get_by_remote_ref(remote_info.parent_uid))
         if parent_pair is None:
             # Illegal state: report the error and let's wait for the
             # parent folder issue to get resolved first
@@ -616,18 +1396,27 @@ class Synchronizer(object):
                 "Parent folder of doc %r (%r) is not bound to a local"
                 " folder" % (name, doc_pair.remote_ref))
         local_parent_path = parent_pair.local_path
+
+        def created(local_info):
+            doc_pair.update_local(local_info)
+            doc_pair.update_state('synchronized', 'synchronized')
+
         if doc_pair.folderish:
             log.debug("Creating local folder '%s' in '%s'", name,
                       parent_pair.get_local_abspath())
             path = local_client.make_folder(local_parent_path, name)
+            created(local_client.get_info(path))
         else:
             log.debug("Creating local document '%s' in '%s'", name,
                       parent_pair.get_local_abspath())
-            path = local_client.make_file(
-                local_parent_path, name,
-                content=remote_client.get_content(doc_pair.remote_ref))
-        doc_pair.update_local(local_client.get_info(path))
-        doc_pair.update_state('synchronized', 'synchronized')
+            # The name is only deduplicated against the existing files: wait
+            # for the in flight download of a file with the same name
+            key = (doc_pair.local_folder, local_parent_path, name.lower())
+            self._wait_for_transfer(key)
+            path, _ = local_client.get_new_file(local_parent_path, name)
+            self._transfer(doc_pair, remote_client, key, self._download,
+                           created, local_client, path, doc_pair.remote_ref,
+                           remote_info, replace=False)
 
     def _synchronize_locally_deleted(self, doc_pair, session,
         local_client, remote_client, local_info, remote_info):
@@ -701,47 +1490,40 @@ class Synchronizer(object):
         Otherwise, return (None, None)
 
         """
-        filters = [
-            LastKnownState.local_folder == doc_pair.local_folder,
-            LastKnownState.folderish == doc_pair.folderish,
-        ]
-        if doc_pair.folderish:
-            # Detect either renaming or move but not both at the same time
-            # for folder to reduce the potential cost of reranking that
-            # needs to fetch the children of all potential candidates.
-            filters.append(or_(
-                LastKnownState.local_name == doc_pair.local_name,
-                LastKnownState.local_parent_path == doc_pair.local_parent_path
-            ))
-        else:
-            # File match is based on digest hence we can efficiently detect
-            # move and rename events or both at the same time.
-            filters.append(
-                LastKnownState.local_digest == doc_pair.local_digest)
-
         if doc_pair.pair_state == 'locally_deleted':
             source_doc_pair = doc_pair
             target_doc_pair = None
             # The creation detection might not have occurred yet for the
             # other pair state: let consider both pairs in states 'created'
             # and 'unknown'.
-            filters.extend((
-                LastKnownState.remote_ref == None,
-                or_(LastKnownState.local_state == 'created',
-                    LastKnownState.local_state == 'unknown'),
-            ))
+            is_candidate = lambda r: (r.remote_ref is None and r.local_state
+                                      in ('created', 'unknown'))
         elif doc_pair.pair_state == 'locally_created':
             source_doc_pair = None
             target_doc_pair = doc_pair
-            filters.append(LastKnownState.local_state == 'deleted')
+            is_candidate = lambda r: r.local_state == 'deleted'
         else:
             # Nothing to do
             return None, None
 
-        candidates = session.query(LastKnownState).filter(*filters).all()
-        if len(candidates) == 0:
+        index = get_state_index(session, doc_pair.local_folder)
+        if doc_pair.folderish:
+            # Detect either renaming or move but not both at the same time
+            # for folder to reduce the potential cost of reranking that
+            # needs to fetch the children of all potential candidates.
+            records = dict((r.id, r) for r in index.find_folders(
+                doc_pair.local_name) + index.get_children(
+                    doc_pair.local_parent_path) if r.folderish)
+            records = [records[i] for i in sorted(records)]
+        else:
+            # File match is based on digest hence we can efficiently detect
+            # move and rename events or both at the same time.
+            records = index.find_files(doc_pair.local_digest)
+        records = [r for r in records if is_candidate(r)]
+        if len(records) == 0:
             # No match found
             return None, None
+        candidates = [_load_indexed_state(session, r) for r in records]
 
         if len(candidates) > 1 or doc_pair.folderish:
             # Reranking is always required for folders as it also prunes false
@@ -803,10 +1585,9 @@ class Synchronizer(object):
 
             # Find the matching target parent folder, assuming it has already
             # been refreshed and matched in the past
-            parent_doc_pair = session.query(LastKnownState).filter_by(
-                local_folder=doc_pair.local_folder,
-                local_path=target_doc_pair.local_parent_path,
-            ).first()
+            index = get_state_index(session, doc_pair.local_folder)
+            parent_doc_pair = _load_indexed_state(
+                session, index.get_by_path(target_doc_pair.local_parent_path))
 
             if (parent_doc_pair is not None  and
                 parent_doc_pair.remote_ref is not None):
@@ -859,49 +1640,237 @@ class Synchronizer(object):
         return moved_or_renamed
 
     def synchronize(self, local_folder=None, limit=None):
-        """Synchronize one file at a time from the pending list."""
+        """Synchronize the pending pairs, one page of pending pairs at a time.
+
+        The pending list is only queried again once the page is exhausted or
+        when synchronizing a folder changes the set of pending descendants
+        (e.g. folder creation or deletion). Changes are committed once per
+        page.
+
+        If transfer_workers is not 0, the file transfers of the page run
+        concurrently on a pool of threads. The pool is shared by all the
+        bindings synchronized by the loop so as to cap the number of
+        concurrent transfers. Otherwise the transfers of all the bindings run
+        one at a time.
+        """
         synchronized = 0
         session = self.get_session()
+        state = self._sync_state
+        own_pool = False
+        if self._shared_transfer_pool is not None:
+            state.transfer_pool = self._shared_transfer_pool
+        elif self.transfer_workers > 0:
+            state.transfer_pool = WorkerPool(self.transfer_workers,
+                                             name='TransferWorker')
+            own_pool = True
+        try:
+            while (limit is None or synchronized < limit):
 
-        while (limit is None or synchronized < limit):
+                pending = self._controller.list_pending(
+                    local_folder=local_folder, limit=self.limit_pending,
+                    session=session, ignore_in_error=self.error_skip_period)
+
+                or_more = len(pending) == self.limit_pending
+                if len(pending) == 0:
+                    if self._frontend is not None:
+                        self._frontend.notify_pending(
+                            local_folder, 0, or_more=False)
+                    break
+
+                local_folders = set()
+                try:
+                    synchronized += self._synchronize_page(
+                        pending, session, local_folders, or_more,
+                        local_folder=local_folder,
+                        limit=None if limit is None
+                        else limit - synchronized)
+                except Exception as e:
+                    if is_database_locked(e):
+                        # The failed flush cannot be committed
+                        session.rollback()
+                    # Let the transfers in flight complete before leaving
+                    self._abort_transfers(session, local_folders)
+                    raise
+                self._commit_sync_progress(session, local_folders)
+        finally:
+            if own_pool:
+                state.transfer_pool.stop()
+            state.transfer_pool = None
 
-            pending = self._controller.list_pending(
-                local_folder=local_folder, limit=self.limit_pending,
-                session=session, ignore_in_error=self.error_skip_period)
+        return synchronized
 
-            or_more = len(pending) == self.limit_pending
+    def _synchronize_page(self, pending, session, local_folders, or_more,
+                          local_folder=None, limit=None):
+        """Synchronize a page of the pending list, return the number done"""
+        synchronized = 0
+        state = self._sync_state
+        transferred = state.transferred
+        max_in_flight = 2 * self.transfer_workers
+        for i, pair_state in enumerate(pending):
+            done = synchronized + state.transferred - transferred
+            if limit is not None and done + len(state.transfers) >= limit:
+                break
             if self._frontend is not None:
                 self._frontend.notify_pending(
-                    local_folder, len(pending), or_more=or_more)
+                    local_folder, len(pending) - i, or_more=or_more)
+            if not self._is_still_pending(pair_state, session):
+                # Deleted or synchronized along with another pair
+                continue
+            local_folders.add(pair_state.local_folder)
+            previous_state = pair_state.pair_state
+            if not self._is_transfer(pair_state):
+                # Folder operations, deletions and conflict resolutions can
+                # depend on the transfers in flight
+                self._collect_transfers(session, local_folders)
+            queued = state.queued_transfers
+            if (self._synchronize_pending(pair_state, session, local_folders)
+                    and state.queued_transfers == queued):
+                # Synchronized without any transfer in flight
+                synchronized += 1
+            self._collect_transfers(session, local_folders,
+                                    max_in_flight=max_in_flight)
+            if self._changes_pending_list(pair_state, previous_state):
+                break
+        self._collect_transfers(session, local_folders)
+        return synchronized + state.transferred - transferred
+
+    def _is_still_pending(self, pair_state, session):
+        if pair_state in session.deleted or pair_state not in session:
+            # Deleted, possibly in bulk along with an ancestor
+            return False
+        if not inspect(pair_state).persistent:
+            return False
+        return pair_state.pair_state != 'synchronized'
+
+    def _changes_pending_list(self, pair_state, previous_state):
+        """Check whether the pending list must be queried again
+
+        Synchronizing a folder creation, deletion or move can create or
+        delete the pairs of its descendants and change their ordering.
+        """
+        if not pair_state.folderish:
+            return False
+        return previous_state not in ('locally_modified', 'remotely_modified')
+
+    def _transfer(self, doc_pair, remote_client, key, func, callback, *args,
+                  **kwargs):
+        """Perform the network transfer of a sync handler
+
+        func(remote_client, *args, **kwargs) only performs I/O, without
+        accessing the session, and its result is passed to callback to update
+        the state of doc_pair. If a transfer pool is running, func is run by
+        a worker with its own remote client while callback is run later on
+        by the synchronization thread, otherwise both are run inline.
+
+        key identifies the transfers that cannot run concurrently, see
+        _wait_for_transfer.
+        """
+        state = self._sync_state
+        if state.transfer_pool is None:
+            # The bindings synchronized by the loop transfer one file at a
+            # time between them too
+            with self._transfer_lock:
+                result = func(remote_client, *args, **kwargs)
+            callback(result)
+            return
+        binding_info = self._make_binding_info(doc_pair.server_binding)
+
+        def run_transfer():
+            client = self._controller.get_remote_fs_client(binding_info)
+            return func(client, *args, **kwargs)
 
-            if len(pending) == 0:
+        future = state.transfer_pool.submit(run_transfer)
+        state.transfers.append((doc_pair, key, future, callback))
+        state.queued_transfers += 1
+
+    def _wait_for_transfer(self, key):
+        """Complete the transfers in flight up to the one matching key"""
+        if any(k == key for _, k, _, _ in self._sync_state.transfers):
+            # Progress is committed along with the rest of the page
+            self._collect_transfers(self.get_session(), set(),
+                                    stop_at_key=key)
+
+    def _collect_transfers(self, session, local_folders, max_in_flight=0,
+                           stop_at_key=None):
+        """Apply the results of the oldest transfers in flight
+
+        Wait until at most max_in_flight transfers are left, or until the
+        transfer identified by stop_at_key is collected.
+        """
+        state = self._sync_state
+        while len(state.transfers) > max_in_flight:
+            doc_pair, key, future, callback = state.transfers.pop(0)
+            local_folders.add(doc_pair.local_folder)
+            if self._run_or_blacklist(doc_pair, session, local_folders,
+                                      lambda: callback(future.result())):
+                state.transferred += 1
+            if stop_at_key is not None and key == stop_at_key:
                 break
 
-            # TODO: make it possible to catch unexpected exceptions here so as
-            # to black list the pair of document and ignore it for a while
-            # using a TTL for the blacklist token in the state DB
-            pair_state = pending[0]
+    def _abort_transfers(self, session, local_folders):
+        """Complete the transfers in flight, ignoring their errors"""
+        if not self._sync_state.transfers:
+            return
+        while self._sync_state.transfers:
             try:
-                self.synchronize_one(pair_state, session=session)
-                synchronized += 1
-            except POSSIBLE_NETWORK_ERROR_TYPES as e:
-                if getattr(e, 'code', None) == 500:
-                    # This is an unexpected: blacklist doc_pair for
-                    # a cooldown period
-                    log.error("Failed to sync %r", pair_state, exc_info=True)
-                    pair_state.last_sync_error_date = datetime.utcnow()
-                    session.commit()
-                else:
-                    # This is expected and should interrupt the sync process for
-                    # this local_folder and should be dealt with in the main loop
-                    raise e
-            except Exception as e:
-                # Unexpected exception: blacklist for a cooldown period
+                self._collect_transfers(session, local_folders)
+            except Exception:
+                log.debug("Error while completing the transfers in flight",
+                          exc_info=True)
+        self._commit_sync_progress(session, local_folders)
+
+    def _commit_sync_progress(self, session, local_folders):
+        for local_folder in local_folders:
+            self._flush_digest_cache(local_folder, session)
+        session.commit()
+
+    def _is_transfer(self, pair_state):
+        """Check whether a pending pair can be synchronized concurrently
+
+        Files whose pair state is unknown are only known on one side: they
+        are detected as created when refreshed.
+        """
+        return not pair_state.folderish and pair_state.pair_state in (
+            'unknown', 'locally_created', 'remotely_created',
+            'locally_modified', 'remotely_modified')
+
+    def _synchronize_pending(self, pair_state, session, local_folders):
+        """Synchronize a pair of the pending list, return True if done"""
+        return self._run_or_blacklist(
+            pair_state, session, local_folders,
+            lambda: self.synchronize_one(pair_state, session=session,
+                                         commit=False))
+
+    def _run_or_blacklist(self, pair_state, session, local_folders, func):
+        """Run a sync operation of a pair, return False if it failed"""
+        # TODO: make it possible to catch unexpected exceptions here so as
+        # to black list the pair of document and ignore it for a while
+        # using a TTL for the blacklist token in the state DB
+        try:
+            func()
+            return True
+        except POSSIBLE_NETWORK_ERROR_TYPES as e:
+            if getattr(e, 'code', None) == 500:
+                # This is an unexpected: blacklist doc_pair for
+                # a cooldown period
                 log.error("Failed to sync %r", pair_state, exc_info=True)
                 pair_state.last_sync_error_date = datetime.utcnow()
                 session.commit()
-
-        return synchronized
+            else:
+                # This is expected and should interrupt the sync process for
+                # this local_folder and should be dealt with in the main loop:
+                # keep the progress of the current page
+                self._commit_sync_progress(session, local_folders)
+                raise e
+        except Exception as e:
+            if is_database_locked(e):
+                # Not an error of the pair: the binding worker retries later
+                raise
+            # Unexpected exception: blacklist for a cooldown period
+            log.error("Failed to sync %r", pair_state, exc_info=True)
+            pair_state.last_sync_error_date = datetime.utcnow()
+            session.commit()
+        return False
 
     def _get_sync_pid_filepath(self, process_name="sync"):
         return os.path.join(self._controller.config_folder,
@@ -957,7 +1926,18 @@ class Synchronizer(object):
         return False
 
     def loop(self, max_loops=None, delay=None):
-        """Forever loop to scan / refresh states and perform sync"""
+        """Forever loop to scan / refresh states and perform sync
+
+        Each server binding is synchronized by its own BindingWorker thread
+        so that a slow or offline server does not delay the others. The loop
+        itself starts and stops the workers as bindings are added or removed
+        and handles the stop requests.
+
+        delay overrides the base delay between two remote polls and caps the
+        delays of the local scans and of the synchronizations, 0 running all
+        the stages at each iteration. If max_loops is not None, each binding
+        runs max_loops iterations of its stages.
+        """
 
         delay = delay if delay is not None else self.delay
 
@@ -979,53 +1959,55 @@ class Synchronizer(object):
         log.info("Starting synchronization (pid=%d)", pid)
         self.continue_synchronization = True
 
-        previous_time = time()
         session = self.get_session()
-        loop_count = 0
+        workers = {}
+        done = set()
+        if self.transfer_workers > 0:
+            self._shared_transfer_pool = WorkerPool(self.transfer_workers,
+                                                    name='TransferWorker')
         try:
             while True:
-                n_synchronized = 0
                 if self.should_stop_synchronization():
                     log.info("Stopping synchronization (pid=%d)", pid)
                     break
-                if (max_loops is not None and loop_count > max_loops):
-                    log.info("Stopping synchronization after %d loops",
-                             loop_count)
-                    break
 
                 bindings = session.query(ServerBinding).all()
                 if self._frontend is not None:
                     local_folders = [sb.local_folder for sb in bindings]
                     self._frontend.notify_local_folders(local_folders)
 
-                for sb in bindings:
-                    if not sb.has_invalid_credentials():
-                        n_synchronized += self.update_synchronize_server(
-                            sb, session=session)
-
-                # safety net to ensure that Nuxeo Drive won't eat all the CPU,
-                # disk and network resources of the machine scanning over an
-                # over the bound folders too often.
-                current_time = time()
-                spent = current_time - previous_time
-                sleep_time = delay - spent
-                if sleep_time > 0 and n_synchronized == 0:
-                    log.debug("Sleeping %0.3fs", sleep_time)
-                    sleep(sleep_time)
-                previous_time = time()
-                loop_count += 1
+                self._loop_wakeup.clear()
+                self._update_binding_workers(bindings, workers, done,
+                                             max_loops=max_loops, delay=delay)
+                if max_loops is not None and not workers:
+                    log.info("Stopping synchronization after %d loops",
+                             max_loops)
+                    break
 
                 # Force a commit here to refresh the visibility of any
                 # concurrent change in the database for instance if the use
                 # has updated the connection credentials for a server binding.
                 session.commit()
 
+                if self._sleep(self.stop_check_period):
+                    log.info("Stopping synchronization (pid=%d)", pid)
+                    break
+
         except KeyboardInterrupt:
             self.get_session().rollback()
             log.info("Interrupted synchronization on user's request.")
         except:
             self.get_session().rollback()
             raise
+        finally:
+            for worker in workers.values():
+                worker.stop()
+            for worker in workers.values():
+                worker.join()
+            if self._shared_transfer_pool is not None:
+                self._shared_transfer_pool.stop()
+                self._shared_transfer_pool = None
+            self.stop_local_watchers()
 
         # Clean pid file
         pid_filepath = self._get_sync_pid_filepath()
@@ -1042,12 +2024,16 @@ class Synchronizer(object):
 
     def _get_remote_changes(self, server_binding, session=None):
         """Fetch incremental change summary from the server"""
-        session = self.get_session() if session is None else session
-        remote_client = self.get_remote_fs_client(server_binding)
+        return self._fetch_remote_changes(
+            self.get_remote_fs_client(server_binding),
+            server_binding.last_sync_date,
+            server_binding.last_root_definitions)
 
+    def _fetch_remote_changes(self, remote_client, last_sync_date,
+                              last_root_definitions):
         summary = remote_client.get_changes(
-            last_sync_date=server_binding.last_sync_date,
-            last_root_definitions=server_binding.last_root_definitions)
+            last_sync_date=last_sync_date,
+            last_root_definitions=last_root_definitions)
 
         root_definitions = summary['activeSynchronizationRootDefinitions']
         sync_date = summary['syncDate']
@@ -1079,23 +2065,52 @@ class Synchronizer(object):
 
         client = self.get_remote_fs_client(server_binding)
 
+        # Fetch the info and the pairs of all the changed documents at once,
+        # a more recent version of a document superseding the older ones.
+        # Only the documents not embedded in their most recent change (e.g.
+        # deleted ones) are fetched from the server.
+        changed_refs = []
+        infos = {}
+        missing_refs = []
+        for change in sorted_changes:
+            remote_ref = change['fileSystemItemId']
+            if remote_ref in infos:
+                continue
+            changed_refs.append(remote_ref)
+            infos[remote_ref] = change.get('fileSystemItemInfo')
+            if infos[remote_ref] is None:
+                missing_refs.append(remote_ref)
+        if missing_refs:
+            infos.update(zip(missing_refs, self._get_remote_infos(
+                server_binding, client, missing_refs)))
+        doc_pairs = self._get_pairs_by_remote_ref(
+            session, changed_refs, local_folder=server_binding.local_folder)
+        parent_refs = set(info.parent_uid for info in infos.values()
+                          if info is not None)
+        parent_pairs_by_ref = self._get_pairs_by_remote_ref(
+            session, parent_refs, first=False)
+        # The prefetched pairs are outdated once pairs have been created or
+        # deleted while processing the changes: query them again if so
+        tree_changed = False
+
         # Scan events and update the inter
         refreshed = set()
         moved = []
-        for change in sorted_changes:
-            remote_ref = change['fileSystemItemId']
+        for remote_ref in changed_refs:
             if remote_ref in refreshed:
                 # A more recent version was already processed
                 continue
-            doc_pair = session.query(LastKnownState).filter_by(
-                local_folder=server_binding.local_folder,
-                remote_ref=remote_ref).first()
+            if tree_changed:
+                doc_pair = session.query(LastKnownState).filter_by(
+                    local_folder=server_binding.local_folder,
+                    remote_ref=remote_ref).first()
+            else:
+                doc_pair = doc_pairs.get(remote_ref)
             updated = False
             if doc_pair is not None:
                 if doc_pair.server_binding.server_url == s_url:
                     old_remote_parent_ref = doc_pair.remote_parent_ref
-                    new_info = client.get_info(
-                        remote_ref, raise_if_missing=False)
+                    new_info = infos[remote_ref]
                     if new_info is None:
                         log.debug("Mark doc_pair '%s' as deleted",
                                   doc_pair.remote_name)
@@ -1109,6 +2124,7 @@ class Synchronizer(object):
                                   doc_pair.remote_name)
                         self._scan_remote_recursive(session, client, doc_pair,
                             new_info, force_recursion=False)
+                        tree_changed = tree_changed or new_info.folderish
 
                     else:
                         # This document has been moved: make the
@@ -1119,20 +2135,22 @@ class Synchronizer(object):
                         doc_pair.update_state(remote_state='deleted')
                         moved.append(new_info)
 
-                    session.commit()
                     updated = True
                     refreshed.add(remote_ref)
 
             if not updated:
-                child_info = client.get_info(
-                    remote_ref, raise_if_missing=False)
+                child_info = infos[remote_ref]
                 if child_info is None:
                     # Document must have been deleted since: nothing to do
                     continue
 
                 created = False
-                parent_pairs = session.query(LastKnownState).filter_by(
-                    remote_ref=child_info.parent_uid).all()
+                if tree_changed:
+                    parent_pairs = session.query(LastKnownState).filter_by(
+                        remote_ref=child_info.parent_uid).all()
+                else:
+                    parent_pairs = parent_pairs_by_ref.get(
+                        child_info.parent_uid, [])
                 for parent_pair in parent_pairs:
                     if (parent_pair.server_binding.server_url != s_url):
                         continue
@@ -1142,6 +2160,7 @@ class Synchronizer(object):
                     if new_pair:
                         log.debug("Marked doc_pair '%s' as remote creation",
                                   child_pair.remote_name)
+                        tree_changed = tree_changed or child_pair.folderish
 
                     if child_pair.folderish and new_pair:
                         log.debug('Remote recursive scan of the content of %s',
@@ -1162,11 +2181,60 @@ class Synchronizer(object):
                     log.warning("Could not match changed document to a "
                                 "bound local folder: %r", child_info)
 
+        session.commit()
+
         # TODO: implement the detection of moved documents here
         # Sort the moved documents by path to start with the creation of parent
         # folders if needed
         # moved = sorted(moved, key=lambda m: m.path)
 
+    def _get_remote_infos(self, server_binding, client, remote_refs):
+        """Fetch the info of several remote documents, None if missing
+
+        If the server cannot fetch them in batches, concurrent requests are
+        sent by remote_scan_workers threads, if any.
+        """
+        if (len(remote_refs) < 2 or self.remote_scan_workers < 1
+                or client.can_batch_get_fs_items()):
+            return client.get_infos(remote_refs)
+        binding_info = self._make_binding_info(server_binding)
+
+        def get_info(remote_ref):
+            client = self._controller.get_remote_fs_client(binding_info)
+            return client.get_info(remote_ref, raise_if_missing=False)
+
+        pool = WorkerPool(min(self.remote_scan_workers, len(remote_refs)),
+                          name='RemoteInfoWorker')
+        try:
+            futures = [pool.submit(get_info, remote_ref)
+                       for remote_ref in remote_refs]
+            return [future.result() for future in futures]
+        finally:
+            pool.stop()
+
+    def _get_pairs_by_remote_ref(self, session, remote_refs,
+                                 local_folder=None, first=True):
+        """Query the pairs of several remote refs with IN clauses
+
+        Return a dict of the first pair by remote ref, or of the list of
+        pairs if first is False.
+        """
+        remote_refs = list(remote_refs)
+        pairs = {}
+        for i in range(0, len(remote_refs), self.max_in_clause_size):
+            chunk = remote_refs[i:i + self.max_in_clause_size]
+            query = session.query(LastKnownState).filter(
+                LastKnownState.remote_ref.in_(chunk))
+            if local_folder is not None:
+                query = query.filter(
+                    LastKnownState.local_folder == local_folder)
+            for pair in query.order_by(LastKnownState.id).all():
+                if first:
+                    pairs.setdefault(pair.remote_ref, pair)
+                else:
+                    pairs.setdefault(pair.remote_ref, []).append(pair)
+        return pairs
+
     def update_synchronize_server(self, server_binding, session=None,
                                   full_scan=False):
         """Do one pass of synchronization for given server binding."""
@@ -1174,40 +2242,15 @@ class Synchronizer(object):
         local_scan_is_done = False
         try:
             tick = time()
-            first_pass = server_binding.last_sync_date is None
             summary, checkpoint = self._get_remote_changes(
                 server_binding, session=session)
-
-            # Apparently we are online, otherwise an network related exception
-            # would have been raised and caught below
-            if self._frontend is not None:
-                self._frontend.notify_online(server_binding.local_folder)
-
-            if full_scan or summary['hasTooManyChanges'] or first_pass:
-                # Force remote full scan
-                log.debug("Remote full scan of %s. Reasons: "
-                          "forced: %r, too many changes: %r, first pass: %r",
-                          server_binding.local_folder, full_scan,
-                          summary['hasTooManyChanges'], first_pass)
-                self.scan_remote(server_binding, session=session)
-            else:
-                # Only update recently changed documents
-                self._update_remote_states(server_binding, summary,
-                                           session=session)
-                self._notify_pending(server_binding)
-
+            self._apply_remote_changes(server_binding, summary, checkpoint,
+                                       session=session, full_scan=full_scan)
             remote_refresh_duration = time() - tick
             tick = time()
 
-            # If we reach this point it means the the internal DB was
-            # successfully refreshed (no network disruption while collecting
-            # the change data): we can save the new time stamp to start again
-            # from this point next time
-            self._checkpoint(server_binding, checkpoint, session=session)
-
             # Scan local folders to detect changes
-            # XXX: OPTIM: use file system monitoring instead
-            self.scan_local(server_binding, session=session)
+            self._update_local_states(server_binding, session=session)
 
             local_scan_is_done = True
             local_refresh_duration = time() - tick
@@ -1238,9 +2281,276 @@ class Synchronizer(object):
                 # Scan the local folders now to update the local DB even
                 # if the netwrok is done so that the UI (e.g. windows shell
                 # extension can still be right)
-                self.scan_local(server_binding, session=session)
+                self._update_local_states(server_binding, session=session)
             return 0
 
+    def _apply_remote_changes(self, server_binding, summary, checkpoint,
+                              session=None, full_scan=False):
+        """Update the remote states from a change summary and save checkpoint
+        """
+        session = self.get_session() if session is None else session
+        first_pass = server_binding.last_sync_date is None
+
+        # Apparently we are online, otherwise an network related exception
+        # would have been raised when fetching the summary
+        if self._frontend is not None:
+            self._frontend.notify_online(server_binding.local_folder)
+
+        if full_scan or summary['hasTooManyChanges'] or first_pass:
+            # Force remote full scan
+            log.debug("Remote full scan of %s. Reasons: "
+                      "forced: %r, too many changes: %r, first pass: %r",
+                      server_binding.local_folder, full_scan,
+                      summary['hasTooManyChanges'], first_pass)
+            self.scan_remote(server_binding, session=session)
+        else:
+            # Only update recently changed documents
+            self._update_remote_states(server_binding, summary,
+                                       session=session)
+            self._notify_pending(server_binding)
+
+        # If we reach this point it means the the internal DB was
+        # successfully refreshed (no network disruption while collecting
+        # the change data): we can save the new time stamp to start again
+        # from this point next time
+        self._checkpoint(server_binding, checkpoint, session=session)
+
+    def _update_binding_workers(self, bindings, workers, done,
+                                max_loops=None, delay=None):
+        """Start the workers of the new bindings, forget the finished ones
+
+        The bindings whose worker has run its max_loops iterations are added
+        to done so as not to be started again. The unexpected errors of the
+        workers are raised again in the calling thread.
+        """
+        for local_folder, worker in workers.items():
+            if worker.is_alive():
+                continue
+            del workers[local_folder]
+            if worker.exc_info is not None:
+                exc_info = worker.exc_info
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if max_loops is not None:
+                done.add(local_folder)
+        for sb in bindings:
+            if (sb.local_folder in workers or sb.local_folder in done
+                    or sb.has_invalid_credentials()):
+                continue
+            worker = BindingWorker(self, sb.local_folder,
+                                   max_loops=max_loops, delay=delay,
+                                   on_exit=self._loop_wakeup.set)
+            workers[sb.local_folder] = worker
+            worker.start()
+
+    def _synchronize_binding(self, worker, max_loops=None, delay=None):
+        """Run the stages of the loop for the binding of a worker
+
+        Called by the worker thread, with its own session and remote
+        clients, until the worker is stopped, the binding removed or its
+        credentials invalidated. If the database stays locked by another
+        thread, the changes of the iteration are rolled back and the stages
+        run again after a growing delay, from the last checkpoint.
+        """
+        delay = delay if delay is not None else self.delay
+        session = self.get_session()
+        # The states may have been changed while no worker was running
+        forget_state_index(session, worker.local_folder)
+        schedule = None
+        loop_count = 0
+        locked_delay = self.locked_delay
+        try:
+            while not worker.is_stopped():
+                if (max_loops is not None and loop_count > max_loops):
+                    break
+                sb = session.query(ServerBinding).filter_by(
+                    local_folder=worker.local_folder).first()
+                if sb is None or sb.has_invalid_credentials():
+                    break
+                binding_info = self._make_binding_info(sb)
+                if (schedule is not None
+                        and schedule.binding_info != binding_info):
+                    # Start again with the updated credentials
+                    schedule.stop()
+                    schedule = None
+                if schedule is None:
+                    schedule = self._make_schedule(binding_info, delay,
+                                                   worker.wakeup)
+
+                worker.wakeup.clear()
+                try:
+                    n_synchronized = self._run_due_stages(sb, schedule,
+                                                          session=session)
+                    session.commit()
+                except Exception as e:
+                    if not is_database_locked(e):
+                        raise
+                    session.rollback()
+                    forget_state_index(session, worker.local_folder)
+                    # The remote changes applied in the mean time are lost:
+                    # poll them again from the last checkpoint
+                    schedule.stop()
+                    schedule = None
+                    log.debug("Database locked while synchronizing %s,"
+                              " retrying in %0.1fs", worker.local_folder,
+                              locked_delay)
+                    worker.wakeup.wait(locked_delay)
+                    locked_delay = min(2 * locked_delay,
+                                       self.max_locked_delay)
+                    loop_count += 1
+                    continue
+                locked_delay = self.locked_delay
+
+                # safety net to ensure that Nuxeo Drive won't eat all the CPU,
+                # disk and network resources of the machine scanning over an
+                # over the bound folders too often.
+                if n_synchronized == 0:
+                    sleep_time = schedule.next_run() - time()
+                    if sleep_time > 0:
+                        log.trace("Sleeping %0.3fs", sleep_time)
+                        worker.wakeup.wait(sleep_time)
+                loop_count += 1
+        except:
+            session.rollback()
+            raise
+        finally:
+            if schedule is not None:
+                schedule.stop()
+            forget_state_index(session, worker.local_folder)
+
+    def _make_schedule(self, binding_info, delay, wakeup=None):
+        max_delay = min(self.max_local_scan_delay, delay)
+        return BindingSchedule(
+            binding_info, delay,
+            PollScheduler(min(self.local_scan_delay, delay), max_delay,
+                          max_delay),
+            PollScheduler(min(self.synchronize_delay, delay),
+                          min(self.synchronize_delay, delay),
+                          self.offline_max_delay),
+            wakeup=wakeup)
+
+    def _start_remote_poller(self, server_binding, schedule,
+                             first_result=None):
+        """Poll the remote changes of a binding in the background
+
+        first_result is the result of the poll performed inline, if any.
+        """
+        binding_info = schedule.binding_info
+
+        def fetch(last_sync_date, last_root_definitions):
+            client = self._controller.get_remote_fs_client(binding_info)
+            try:
+                return self._fetch_remote_changes(
+                    client, last_sync_date, last_root_definitions)
+            except POSSIBLE_NETWORK_ERROR_TYPES:
+                self._controller.invalidate_client_cache(
+                    binding_info.server_url)
+                raise
+
+        poller = RemotePoller(
+            fetch, (server_binding.last_sync_date,
+                    server_binding.last_root_definitions),
+            PollScheduler(schedule.poll_delay, self.max_delay,
+                          self.offline_max_delay),
+            on_result=schedule.wakeup.set,
+            name='RemotePoller-%s' % os.path.basename(
+                server_binding.local_folder))
+        poller.start(first_result)
+        schedule.poller = poller
+
+    def _run_due_stages(self, server_binding, schedule, session=None):
+        """Run the stages of the loop that are due for a server binding
+
+        The remote changes polled in the background are applied first, then
+        the local folders are scanned if due or if some remote changes have
+        been applied, and the pending pairs are synchronized if due or if
+        some changes have been found. Return the number of synchronized
+        pairs.
+        """
+        session = self.get_session() if session is None else session
+        tick = time()
+        if schedule.poller is None:
+            # The first poll is performed inline so that the changes found
+            # at startup are applied before anything else
+            try:
+                summary, checkpoint = self._get_remote_changes(
+                    server_binding, session=session)
+                results = [(summary, checkpoint, None)]
+            except POSSIBLE_NETWORK_ERROR_TYPES:
+                results = [(None, None, sys.exc_info())]
+        else:
+            results = schedule.poller.get_results()
+
+        remote_changed = False
+        for summary, checkpoint, exc_info in results:
+            if exc_info is not None:
+                if not isinstance(exc_info[1], POSSIBLE_NETWORK_ERROR_TYPES):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                schedule.offline = True
+                self._handle_network_error(server_binding, exc_info[1])
+                continue
+            try:
+                self._apply_remote_changes(server_binding, summary,
+                                           checkpoint, session=session)
+            except POSSIBLE_NETWORK_ERROR_TYPES as e:
+                schedule.offline = True
+                self._handle_network_error(server_binding, e)
+                if schedule.poller is not None:
+                    # Fetch the changes again from the last checkpoint
+                    schedule.poller.reset(
+                        (server_binding.last_sync_date,
+                         server_binding.last_root_definitions))
+                results = []
+                break
+            schedule.offline = False
+            remote_changed = True
+        if schedule.poller is None:
+            self._start_remote_poller(server_binding, schedule,
+                                      results[0] if results else None)
+        remote_refresh_duration = time() - tick
+
+        tick = time()
+        local_changed = False
+        if remote_changed or tick >= schedule.next_local_scan:
+            local_changed = self._update_local_states(server_binding,
+                                                      session=session)
+            schedule.next_local_scan = (
+                time() + schedule.local_scheduler.next_delay(local_changed))
+        local_refresh_duration = time() - tick
+
+        tick = time()
+        n_synchronized = 0
+        synchronize_due = tick >= schedule.next_synchronize
+        if not schedule.synchronize_failed:
+            synchronize_due = (synchronize_due or remote_changed
+                               or local_changed or schedule.more_pending)
+        if not schedule.offline and synchronize_due:
+            try:
+                n_synchronized = self.synchronize(
+                    limit=self.max_sync_step,
+                    local_folder=server_binding.local_folder)
+            except POSSIBLE_NETWORK_ERROR_TYPES as e:
+                # Back off, or wait for as long as the server asked to
+                schedule.offline = True
+                schedule.synchronize_failed = True
+                self._handle_network_error(server_binding, e)
+                delay = schedule.synchronize_scheduler.next_delay(
+                    offline=True, hint=get_retry_after(e))
+            else:
+                schedule.synchronize_failed = False
+                schedule.more_pending = n_synchronized >= self.max_sync_step
+                delay = schedule.synchronize_scheduler.next_delay()
+            schedule.next_synchronize = time() + delay
+        synchronization_duration = time() - tick
+
+        if remote_changed or local_changed or n_synchronized:
+            log.debug("[%s] - [%s]: synchronized: %d, "
+                      "local: %0.3fs, remote: %0.3fs sync: %0.3fs",
+                      server_binding.local_folder,
+                      server_binding.server_url, n_synchronized,
+                      local_refresh_duration, remote_refresh_duration,
+                      synchronization_duration)
+        return n_synchronized
+
     def _notify_refreshing(self, server_binding):
         """Notify the frontend that a remote scan is happening"""
         if self._frontend is not None:
@@ -1263,6 +2573,22 @@ class Synchronizer(object):
                 or_more=reached_limit)
         return n_pending
 
+    def _sleep(self, duration):
+        """Sleep for duration seconds or until a binding worker is done
+
+        Return True if asked to stop meanwhile.
+        """
+        deadline = time() + duration
+        while True:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            self._loop_wakeup.wait(min(remaining, self.stop_check_period))
+            if self.should_stop_synchronization():
+                return True
+            if self._loop_wakeup.is_set():
+                return False
+
     def _handle_network_error(self, server_binding, e):
         _log_offline(e, "synchronization loop")
         log.trace("Traceback of ignored network error:",
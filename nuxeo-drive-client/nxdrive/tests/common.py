@@ -4,11 +4,19 @@ import unittest
 import tempfile
 import hashlib
 import shutil
+from datetime import datetime
+from datetime import timedelta
+from nose import with_setup
+from sqlalchemy import event
 
 from nxdrive.utils import safe_long_path
 from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.client import LocalClient
 from nxdrive.client import RemoteDocumentClient
 from nxdrive.client import RemoteFileSystemClient
+from nxdrive.client import RemoteFileInfo
+from nxdrive.client import NotFound
 from nxdrive.controller import Controller
 
 
@@ -161,3 +169,243 @@ class IntegrationTestCase(unittest.TestCase):
 
     def wait(self):
         self.root_remote_client.wait()
+
+
+class FakeRemoteFileSystemClient(object):
+    """In memory remote file system to test the scan logic without server
+
+    Share the same tree between the instances to simulate the clients of the
+    various threads. Assign the class to the remote_fs_client_factory
+    attribute of a controller to use it.
+    """
+
+    tree = None
+    contents = None
+    calls = None
+    # Ids of the changed items not yet returned by get_changes
+    changes = None
+
+    # Whether the server supports the GetFileSystemItems operation
+    batch_get = True
+
+    def __init__(self, server_url, user_id, device_id, **kwargs):
+        self.server_url = server_url
+        self.user_id = user_id
+        self.device_id = device_id
+        self._error = None
+
+    @classmethod
+    def reset(cls, root_name='Nuxeo Drive'):
+        cls.tree = {}
+        cls.contents = {}
+        cls.calls = []
+        cls.changes = []
+        cls.batch_get = True
+        root = RemoteFileInfo(
+            root_name, 'root', None, '/root', True, datetime(2013, 1, 1),
+            None, None, None, False, False, False, True)
+        cls.tree['root'] = root
+        return root.uid
+
+    @classmethod
+    def add(cls, parent_uid, name, folderish=False, content=None):
+        parent = cls.tree[parent_uid]
+        uid = '%s_%d' % (parent_uid, len(cls.tree))
+        digest = None if folderish else hashlib.md5(content or '').hexdigest()
+        cls.tree[uid] = RemoteFileInfo(
+            name, uid, parent_uid, parent.path + '/' + uid, folderish,
+            datetime(2013, 1, 1), digest, None if folderish else 'md5',
+            None, True, True, not folderish, folderish)
+        if not folderish:
+            cls.contents[uid] = content or ''
+        return uid
+
+    def make_raise(self, error):
+        self._error = error
+
+    def _record(self, operation, fs_item_id):
+        if self._error is not None:
+            raise self._error
+        self.calls.append((operation, fs_item_id))
+
+    def get_info(self, fs_item_id, raise_if_missing=True):
+        self._record('GetFileSystemItem', fs_item_id)
+        info = self.tree.get(fs_item_id)
+        if info is None and raise_if_missing:
+            raise NotFound("Could not find '%s'" % fs_item_id)
+        return info
+
+    def can_batch_get_fs_items(self):
+        return self.batch_get
+
+    def get_infos(self, fs_item_ids):
+        if not self.batch_get:
+            return [self.get_info(fs_item_id, raise_if_missing=False)
+                    for fs_item_id in fs_item_ids]
+        self._record('GetFileSystemItems', ','.join(fs_item_ids))
+        return [self.tree.get(fs_item_id) for fs_item_id in fs_item_ids]
+
+    def get_children_info(self, fs_item_id):
+        self._record('GetChildren', fs_item_id)
+        return sorted((info for info in self.tree.values()
+                       if info.parent_uid == fs_item_id),
+                      key=lambda info: info.name)
+
+    def get_content(self, fs_item_id, file_out=None, fs_item_info=None):
+        if fs_item_info is None:
+            fs_item_info = self.get_info(fs_item_id)
+        self._record('Download', fs_item_id)
+        content = self.contents[fs_item_id]
+        if file_out is None:
+            return content
+        file_out.write(content)
+
+    def make_folder(self, parent_id, name):
+        self._record('CreateFolder', parent_id)
+        return self.add(parent_id, name, folderish=True)
+
+    def make_file(self, parent_id, name, content):
+        self._record('CreateFile', parent_id)
+        if hasattr(content, 'read'):
+            content = content.read()
+        return self.add(parent_id, name, content=content)
+
+    def update_content(self, fs_item_id, content, name=None):
+        self._record('UpdateFile', fs_item_id)
+        if hasattr(content, 'read'):
+            content = content.read()
+        info = self.tree[fs_item_id]
+        self.contents[fs_item_id] = content
+        self.tree[fs_item_id] = info._replace(
+            name=name if name is not None else info.name,
+            digest=hashlib.md5(content).hexdigest(),
+            last_modification_time=(info.last_modification_time
+                                    + timedelta(seconds=1)))
+        return fs_item_id
+
+    def delete(self, fs_item_id):
+        self._record('Delete', fs_item_id)
+        prefix = self.tree[fs_item_id].path + '/'
+        for uid, info in self.tree.items():
+            if uid == fs_item_id or info.path.startswith(prefix):
+                del self.tree[uid]
+                self.contents.pop(uid, None)
+
+    def get_changes(self, last_sync_date=None, last_root_definitions=None):
+        self._record('GetChangeSummary', last_sync_date)
+        changes, self.changes[:] = list(self.changes), []
+        sync_date = (last_sync_date or 0) + 1
+        return {
+            'fileSystemChanges': [
+                {'fileSystemItemId': uid, 'eventDate': sync_date,
+                 'fileSystemItemInfo': None} for uid in changes],
+            'hasTooManyChanges': False,
+            'syncDate': sync_date,
+            'activeSynchronizationRootDefinitions': '',
+        }
+
+    def enable_fs_item_cache(self, ttl=None):
+        pass
+
+    def disable_fs_item_cache(self):
+        pass
+
+
+class Binding(object):
+    """Temporary local folder bound by the tests wrapped with with_binding
+
+    The attributes are set by setup_binding before each test and reset by
+    teardown_binding after it.
+    """
+
+    local_folder = None
+    conf_folder = None
+    local = None
+    ctl = None
+    sb = None
+
+
+binding = Binding()
+
+
+def setup_binding(client_factory=FakeRemoteFileSystemClient):
+    """Bind a temporary folder to a fake remote file system
+
+    The remote file system is reset. If client_factory is None, the folder
+    is bound without connecting to any server.
+    """
+    binding.local_folder = tempfile.mkdtemp('-nuxeo-drive-tests')
+    binding.conf_folder = tempfile.mkdtemp('-nuxeo-drive-conf')
+    binding.local = LocalClient(binding.local_folder)
+    binding.ctl = Controller(binding.conf_folder)
+    session = binding.ctl.get_session()
+    binding.sb = ServerBinding(binding.local_folder,
+                               'http://localhost:8080/nuxeo/',
+                               'Administrator',
+                               remote_password='Administrator')
+    session.add(binding.sb)
+    local_info = binding.local.get_info('/')
+    if client_factory is None:
+        session.add(LastKnownState(binding.local_folder,
+                                   local_info=local_info,
+                                   local_state='synchronized'))
+    else:
+        root = FakeRemoteFileSystemClient.reset()
+        binding.ctl.remote_fs_client_factory = client_factory
+        session.add(LastKnownState(
+            binding.local_folder, local_info=local_info,
+            remote_info=FakeRemoteFileSystemClient.tree[root],
+            local_state='synchronized', remote_state='synchronized'))
+    session.commit()
+
+
+def setup_local_binding():
+    """Bind a temporary folder without connecting to any server"""
+    setup_binding(client_factory=None)
+
+
+def teardown_binding():
+    binding.ctl.dispose()
+    for folder in (binding.local_folder, binding.conf_folder):
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+    binding.local_folder = binding.conf_folder = binding.local = None
+    binding.ctl = binding.sb = None
+
+
+with_binding = with_setup(setup_binding, teardown_binding)
+with_local_binding = with_setup(setup_local_binding, teardown_binding)
+
+
+class StatementRecorder(object):
+    """Record the SQL statements sent to the database of a controller
+
+    Each statement is recorded as a (statement, parameters, executemany)
+    tuple while the recorder is used as a context manager. The data version
+    checks issued before any use of a state index are left out.
+    """
+
+    def __init__(self, ctl):
+        self._engine = ctl._engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self._engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self._engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context,
+                executemany):
+        if 'pragma_data_version' not in statement:
+            self.statements.append((statement, parameters, executemany))
+
+    def get(self, keyword=None):
+        """Return the statements starting with keyword, all if None"""
+        return [s for s in self.statements
+                if keyword is None or s[0].lstrip().upper().startswith(
+                    keyword.upper())]
+
+    def count(self, keyword=None):
+        return len(self.get(keyword))
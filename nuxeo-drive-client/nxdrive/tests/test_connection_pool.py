@@ -0,0 +1,205 @@
+import socket
+import sys
+import time
+import urllib2
+from threading import Thread
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+from nxdrive.client.base_automation_client import MultipartBody
+from nxdrive.client.connection_pool import ConnectionPool
+from nxdrive.client.connection_pool import build_keep_alive_handlers
+from nxdrive.controller import Controller
+from nxdrive.tests.common import binding
+from nxdrive.tests.common import with_binding
+
+
+server = None
+server_thread = None
+connections = []
+requests = []
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients timing out close the connection before the reply is sent
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        connections.append(self.client_address)
+
+    def do_GET(self):
+        requests.append((self.command, self.path))
+        if self.path == '/missing':
+            self.reply("Not found", code=404)
+        elif self.path == '/no-reply':
+            # Close the connection before sending any byte of the response
+            self.close_connection = 1
+        else:
+            if self.path == '/slow':
+                time.sleep(0.5)
+            self.reply("Content of " + self.path)
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        body = self.rfile.read(length)
+        requests.append((self.command, self.path))
+        if self.path == '/no-reply':
+            self.close_connection = 1
+        else:
+            self.reply(body)
+
+    def reply(self, body, code=200):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.path == '/drop':
+            # Close the connection without notifying the client
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+def setup_server():
+    global server, server_thread
+    del connections[:]
+    del requests[:]
+    server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    server_thread = Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+
+def teardown_server():
+    server.shutdown()
+    server.server_close()
+    server_thread.join()
+
+
+with_server = with_setup(setup_server, teardown_server)
+
+
+def url(path):
+    return 'http://127.0.0.1:%d%s' % (server.server_port, path)
+
+
+@with_server
+def test_connection_reuse():
+    pool = ConnectionPool()
+    opener = urllib2.build_opener(*build_keep_alive_handlers(pool))
+    for i in range(5):
+        response = opener.open(url('/doc/%d' % i), timeout=5)
+        assert_equal(response.code, 200)
+        assert_equal(response.read(), 'Content of /doc/%d' % i)
+
+    # Streamed bodies are supported as well
+    body = MultipartBody(['head', 'body', 'tail'])
+    response = opener.open(urllib2.Request(url('/upload'), body), timeout=5)
+    assert_equal(response.read(), 'headbodytail')
+
+    # Errors do not prevent reusing the connection once read
+    with assert_raises(urllib2.HTTPError) as cm:
+        opener.open(url('/missing'), timeout=5)
+    assert_equal(cm.exception.code, 404)
+    assert_equal(cm.exception.read(), 'Not found')
+
+    # Another opener, as used by another thread, shares the same connection
+    other_opener = urllib2.build_opener(*build_keep_alive_handlers(pool))
+    assert_equal(other_opener.open(url('/other'), timeout=5).read(),
+                 'Content of /other')
+
+    assert_equal(len(connections), 1)
+    stats = pool.get_stats()
+    assert_equal(stats['created'], 1)
+    assert_equal(stats['reused'], 7)
+    assert_equal(stats['idle'], 1)
+    pool.close()
+
+
+@with_server
+def test_stale_connection_retry():
+    pool = ConnectionPool()
+    opener = urllib2.build_opener(*build_keep_alive_handlers(pool))
+    assert_equal(opener.open(url('/drop'), timeout=5).read(),
+                 'Content of /drop')
+
+    # The pooled connection has been closed by the server: the request is
+    # sent again on a new connection, rewinding the streamed body
+    body = MultipartBody(['some ', 'content'])
+    response = opener.open(urllib2.Request(url('/upload'), body), timeout=5)
+    assert_equal(response.read(), 'some content')
+    assert_equal(len(connections), 2)
+    assert_equal(pool.get_stats()['retried'], 1)
+
+    pool.close()
+    assert_equal(pool.get_stats()['idle'], 0)
+
+
+@with_server
+def test_no_retry_after_timeout():
+    pool = ConnectionPool()
+    opener = urllib2.build_opener(*build_keep_alive_handlers(pool))
+    assert_equal(opener.open(url('/doc'), timeout=5).read(), 'Content of /doc')
+
+    # The server may still be processing the request: it is not sent again
+    with assert_raises(urllib2.URLError) as cm:
+        opener.open(url('/slow'), timeout=0.1)
+    assert_true(isinstance(cm.exception.reason, socket.timeout))
+    assert_equal(requests.count(('GET', '/slow')), 1)
+    assert_equal(pool.get_stats()['retried'], 0)
+    pool.close()
+
+
+@with_server
+def test_no_retry_of_sent_post():
+    pool = ConnectionPool()
+    opener = urllib2.build_opener(*build_keep_alive_handlers(pool))
+    assert_equal(opener.open(url('/doc'), timeout=5).read(), 'Content of /doc')
+
+    # The connection is closed before any byte of the response: idempotent
+    # requests are sent again on a new connection, the other ones are not
+    with assert_raises(urllib2.URLError):
+        opener.open(url('/no-reply'), timeout=5)
+    assert_equal(requests.count(('GET', '/no-reply')), 2)
+    assert_equal(pool.get_stats()['retried'], 1)
+
+    assert_equal(opener.open(url('/doc'), timeout=5).read(), 'Content of /doc')
+    with assert_raises(urllib2.URLError):
+        opener.open(urllib2.Request(url('/no-reply'), 'content'), timeout=5)
+    assert_equal(requests.count(('POST', '/no-reply')), 1)
+    assert_equal(pool.get_stats()['retried'], 1)
+    pool.close()
+
+
+@with_binding
+def test_binding_settings():
+    ctl, sb = binding.ctl, binding.sb
+    pool = ctl.get_connection_pool(sb)
+    assert_equal((pool.max_idle, pool.idle_timeout),
+                 (Controller.max_idle_connections,
+                  Controller.connection_idle_timeout))
+
+    # The settings of the binding override the defaults, for all the
+    # clients of the binding
+    sb.max_idle_connections = 8
+    sb.connection_idle_timeout = 60
+    ctl.get_session().commit()
+    binding_info = ctl.synchronizer._make_binding_info(sb)
+    assert_true(ctl.get_connection_pool(binding_info) is pool)
+    assert_equal((pool.max_idle, pool.idle_timeout), (8, 60))
@@ -0,0 +1,141 @@
+from nose.tools import assert_equal
+from nose.tools import assert_true
+
+from nxdrive.client import LocalClient
+from nxdrive.controller import Controller
+from nxdrive.model import FolderStatus
+from nxdrive.model import rebuild_folder_status
+from nxdrive.tests.common import FakeRemoteFileSystemClient
+from nxdrive.tests.common import StatementRecorder
+from nxdrive.tests.common import binding
+from nxdrive.tests.common import with_binding
+
+
+def get_folder_status():
+    session = binding.ctl.get_session()
+    return sorted((s.local_path, s.pending)
+                  for s in session.query(FolderStatus).all())
+
+
+def check_folder_status():
+    """The incremental counters match the ones computed from scratch"""
+    session = binding.ctl.get_session()
+    session.commit()
+    status = get_folder_status()
+    rebuild_folder_status(session)
+    assert_equal(status, get_folder_status())
+    session.rollback()
+    return status
+
+
+def make_remote_tree():
+    folder = FakeRemoteFileSystemClient.add('root', 'Folder', folderish=True)
+    sub_folder = FakeRemoteFileSystemClient.add(folder, 'Sub Folder',
+                                                folderish=True)
+    FakeRemoteFileSystemClient.add(sub_folder, 'File.txt', content="Content")
+    other_folder = FakeRemoteFileSystemClient.add('root', 'Other Folder',
+                                                  folderish=True)
+    return folder, other_folder
+
+
+@with_binding
+def test_children_states():
+    folder, other_folder = make_remote_tree()
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    # The remote documents not created locally yet are counted in the
+    # folder of their first ancestor bound to a local folder
+    assert_equal(check_folder_status(), [(u'/', 2)])
+    assert_equal(binding.ctl.children_states(binding.local_folder), [])
+
+    syn.synchronize(limit=1)
+    assert_equal(check_folder_status(), [(u'/', 2), (u'/Folder', 1)])
+    assert_equal(binding.ctl.children_states(binding.local_folder),
+                 [(u'Folder', 'children_modified')])
+
+    syn.synchronize()
+    assert_equal(check_folder_status(), [])
+    assert_equal(binding.ctl.children_states(binding.local_folder), [
+        (u'Folder', 'synchronized'),
+        (u'Other Folder', 'synchronized'),
+    ])
+
+    # Remote deletions are counted until synchronized
+    del FakeRemoteFileSystemClient.tree[other_folder]
+    syn.scan_remote(binding.sb)
+    assert_equal(check_folder_status(), [(u'/', 1)])
+    syn.synchronize()
+    assert_equal(check_folder_status(), [])
+    assert_equal(binding.ctl.children_states(binding.local_folder),
+                 [(u'Folder', 'synchronized')])
+
+    # A change deep in the tree is reported on each ancestor, whatever the
+    # other descendants
+    local = LocalClient(binding.local_folder)
+    local.make_file('/Folder/Sub Folder', 'New.txt', content="New")
+    syn.scan_local(binding.sb)
+    assert_equal(check_folder_status(), [
+        (u'/', 1), (u'/Folder', 1), (u'/Folder/Sub Folder', 1)])
+    assert_equal(binding.ctl.children_states(binding.local_folder),
+                 [(u'Folder', 'children_modified')])
+    assert_equal(binding.ctl.children_states(binding.local_folder + '/Folder'),
+                 [(u'Sub Folder', 'children_modified')])
+    assert_equal(
+        binding.ctl.children_states(
+            binding.local_folder + '/Folder/Sub Folder'),
+        [(u'File.txt', 'synchronized'), (u'New.txt', 'unknown')])
+
+    # Local deletions too
+    local.delete('/Folder/Sub Folder')
+    syn.scan_local(binding.sb)
+    assert_equal(check_folder_status(), [
+        (u'/', 2), (u'/Folder', 2), (u'/Folder/Sub Folder', 1)])
+    assert_equal(binding.ctl.children_states(binding.local_folder + '/Folder'),
+                 [(u'Sub Folder', 'children_modified')])
+
+
+@with_binding
+def test_children_states_query_count():
+    for i in range(20):
+        folder = FakeRemoteFileSystemClient.add('root', 'Folder %d' % i,
+                                                folderish=True)
+        for j in range(3):
+            FakeRemoteFileSystemClient.add(folder, 'File %d.txt' % j,
+                                           content="Content %d" % j)
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    syn.synchronize()
+    LocalClient(binding.local_folder).make_file('/Folder 7', 'New.txt')
+    syn.scan_local(binding.sb)
+
+    with StatementRecorder(binding.ctl) as recorder:
+        states = binding.ctl.children_states(binding.local_folder)
+
+    # The binding, the folder, its children and the counters
+    assert_equal(recorder.count(), 4)
+    assert_equal(len(states), 20)
+    assert_equal([name for name, state in states
+                  if state != 'synchronized'], [u'Folder 7'])
+
+
+@with_binding
+def test_rebuild_folder_status():
+    make_remote_tree()
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    syn.synchronize(limit=1)
+    status = check_folder_status()
+    assert_true(len(status) > 0)
+
+    # The counters are computed when upgrading a database without them
+    binding.ctl.dispose()
+    binding.ctl._engine.execute('DROP TABLE folder_status')
+    binding.ctl._engine.execute('PRAGMA user_version = 2')
+    other_ctl = Controller(binding.conf_folder)
+    try:
+        assert_equal(sorted(
+            (s.local_path, s.pending)
+            for s in other_ctl.get_session().query(FolderStatus).all()),
+            status)
+    finally:
+        other_ctl.dispose()
@@ -144,6 +144,90 @@ def test_get_children_info():
     assert_equal(workspace_children[2].path, folder_2)
 
 
+@with_temp_folder
+def test_get_children_info_stat_calls():
+    for i in range(5):
+        lcclient.make_file(TEST_WORKSPACE, 'File %d.txt' % i)
+        lcclient.make_folder(TEST_WORKSPACE, 'Folder %d' % i)
+    lcclient.make_file(TEST_WORKSPACE, '.Ignored')
+
+    stat_calls = []
+    os_stat = os.stat
+
+    def counting_stat(path):
+        stat_calls.append(path)
+        return os_stat(path)
+
+    os.stat = counting_stat
+    try:
+        children = lcclient.get_children_info(TEST_WORKSPACE)
+    finally:
+        os.stat = os_stat
+
+    # At most one stat call per listed child
+    assert_equal(len(children), 10)
+    assert_true(len(stat_calls) <= 10)
+    for child in children:
+        info = lcclient.get_info(child.path)
+        assert_equal(child.name, info.name)
+        assert_equal(child.folderish, info.folderish)
+        assert_equal(child.last_modification_time, info.last_modification_time)
+
+
+@with_temp_folder
+def test_get_content_stream():
+    doc_1 = lcclient.make_file(TEST_WORKSPACE, 'Document 1.txt',
+                               content=SOME_TEXT_CONTENT)
+    with lcclient.get_content_stream(doc_1) as stream:
+        assert_equal(len(stream), len(SOME_TEXT_CONTENT))
+        assert_equal(stream.read(4), SOME_TEXT_CONTENT[:4])
+        assert_equal(stream.tell(), 4)
+        assert_equal(stream.read(), SOME_TEXT_CONTENT[4:])
+        stream.seek(0)
+        assert_equal(stream.read(), SOME_TEXT_CONTENT)
+    assert_raises(ValueError, stream.read)
+    assert_raises(IOError, lcclient.get_content_stream,
+                  TEST_WORKSPACE + '/Missing.txt')
+
+
+@with_temp_folder
+def test_part_file():
+    # New files are only visible once their content is complete
+    doc_1, os_path = lcclient.get_new_file(TEST_WORKSPACE, 'Document 1.txt')
+    assert_false(lcclient.exists(doc_1))
+    with lcclient.open_part_file(doc_1) as part:
+        part.write(SOME_TEXT_CONTENT[:5])
+        part.write(SOME_TEXT_CONTENT[5:])
+        assert_false(lcclient.exists(doc_1))
+        assert_true(os.path.exists(os_path + '.part'))
+        info = part.commit()
+    assert_equal(lcclient.get_content(doc_1), SOME_TEXT_CONTENT)
+    assert_false(os.path.exists(os_path + '.part'))
+    assert_equal(info.path, doc_1)
+    # The digest is computed while writing
+    assert_equal(info._digest, SOME_TEXT_DIGEST)
+    assert_equal(info.get_digest(), SOME_TEXT_DIGEST)
+
+    # Existing files are replaced on commit only
+    with lcclient.open_part_file(doc_1) as part:
+        part.write("Other content.")
+        assert_equal(lcclient.get_content(doc_1), SOME_TEXT_CONTENT)
+        part.commit()
+    assert_equal(lcclient.get_content(doc_1), "Other content.")
+
+    # Aborted downloads leave the file untouched
+    try:
+        with lcclient.open_part_file(doc_1) as part:
+            part.write("Partial")
+            raise IOError("Connection reset")
+    except IOError:
+        pass
+    assert_equal(lcclient.get_content(doc_1), "Other content.")
+    assert_false(os.path.exists(os_path + '.part'))
+    assert_equal([c.path for c in lcclient.get_children_info(TEST_WORKSPACE)],
+                 [doc_1])
+
+
 @with_temp_folder
 def test_deep_folders():
     # Check that local client can workaround the default windows MAX_PATH limit
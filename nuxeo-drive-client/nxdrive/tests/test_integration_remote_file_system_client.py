@@ -86,6 +86,40 @@ class TestIntegrationRemoteFileSystemClient(IntegrationTestCase):
         self.assertRaises(NotFound,
             remote_client.get_content, fs_item_id)
 
+        # An already fetched info spares the lookup of the download URL
+        fs_item_id = remote_client.make_file(self.workspace_id,
+            'Document 3.txt', "Content of doc 3.")
+        info = remote_client.get_info(fs_item_id)
+        self.assertEquals(remote_client.get_content(fs_item_id,
+            fs_item_info=info), "Content of doc 3.")
+
+    def test_fs_item_cache(self):
+        remote_client = self.remote_file_system_client_1
+        fs_item_id = remote_client.make_file(self.workspace_id,
+            'Document 1.txt', "Content of doc 1.")
+        remote_client.enable_fs_item_cache()
+        try:
+            info = remote_client.get_info(fs_item_id)
+            # Cached items do not hit the server any more
+            remote_client.make_raise(ValueError("Unexpected request"))
+            self.assertEquals(remote_client.get_info(fs_item_id), info)
+            self.assertEquals(remote_client.get_info(fs_item_id), info)
+            remote_client.make_raise(None)
+
+            # Updates performed with the client are reflected
+            remote_client.update_content(fs_item_id, "Updated content.")
+            info = remote_client.get_info(fs_item_id)
+            self.assertEquals(info.digest,
+                self._get_digest('md5', "Updated content."))
+            remote_client.rename(fs_item_id, 'Renamed.txt')
+            self.assertEquals(remote_client.get_info(fs_item_id).name,
+                'Renamed.txt')
+            remote_client.delete(fs_item_id)
+            self.assertIsNone(remote_client.get_info(fs_item_id,
+                raise_if_missing=False))
+        finally:
+            remote_client.disable_fs_item_cache()
+
     def test_get_children_info(self):
         remote_client = self.remote_file_system_client_1
 
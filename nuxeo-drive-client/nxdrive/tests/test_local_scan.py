@@ -0,0 +1,221 @@
+import os
+import time
+from nose.tools import assert_equal
+from nose.tools import assert_true
+from sqlalchemy import event
+
+from nxdrive.client import LocalClient
+from nxdrive.model import DigestCache
+from nxdrive.model import LastKnownState
+from nxdrive.model import LocalDigest
+from nxdrive.tests.common import StatementRecorder
+from nxdrive.tests.common import binding
+from nxdrive.tests.common import with_local_binding
+
+
+def make_tree(n_folders, n_files, prefix='Folder'):
+    for i in range(n_folders):
+        folder = binding.local.make_folder('/', '%s %02d' % (prefix, i))
+        for j in range(n_files):
+            binding.local.make_file(folder, 'File %02d.txt' % j,
+                                    content="Content %d %d" % (i, j))
+
+
+def age_files(seconds=10):
+    """Move the modification times of the files back in time"""
+    mtime = time.time() - seconds
+    for parent, _, names in os.walk(binding.local_folder):
+        for name in names:
+            os.utime(os.path.join(parent, name), (mtime, mtime))
+
+
+def count_scan_statements(keyword=None):
+    """Scan the binding and count the statements starting with keyword"""
+    with StatementRecorder(binding.ctl) as recorder:
+        binding.ctl.synchronizer.scan_local(binding.sb)
+    return recorder.count(keyword)
+
+
+def get_local_states():
+    session = binding.ctl.get_session()
+    states = session.query(LastKnownState).order_by(
+        LastKnownState.local_path).all()
+    return [(s.local_path, s.pair_state) for s in states]
+
+
+@with_local_binding
+def test_full_scan_query_count():
+    # The first scan also loads the persistent digest cache
+    binding.ctl.synchronizer.scan_local(binding.sb)
+    make_tree(2, 2)
+    n_small = count_scan_statements('SELECT')
+    states = get_local_states()
+    assert_equal(len(states), 7)
+    assert_equal(states[1], (u'/Folder 00', 'unknown'))
+
+    make_tree(10, 10, prefix='Other Folder')
+    n_large = count_scan_statements('SELECT')
+    assert_equal(len(get_local_states()), 117)
+
+    # The states are loaded at once: the number of queries does not depend
+    # on the number of files
+    assert_equal(n_small, n_large)
+
+
+@with_local_binding
+def test_full_scan_deletion():
+    make_tree(2, 2)
+    binding.ctl.synchronizer.scan_local(binding.sb)
+    binding.local.delete('/Folder 00')
+    binding.local.delete('/Folder 01/File 00.txt')
+    binding.ctl.synchronizer.scan_local(binding.sb)
+    paths = [path for path, _ in get_local_states()]
+    assert_equal(paths, [u'/', u'/Folder 01', u'/Folder 01/File 01.txt'])
+    assert_true(all(state is not None for _, state in get_local_states()))
+
+
+@with_local_binding
+def test_digest_cache():
+    make_tree(2, 2)
+    age_files()
+    binding.ctl.synchronizer.scan_local(binding.sb)
+    session = binding.ctl.get_session()
+    assert_equal(session.query(LocalDigest).count(), 4)
+
+    # Digests are reused from the database as long as the files are unchanged
+    cache = DigestCache(binding.local_folder)
+    cache.load(session)
+    client = LocalClient(binding.local_folder, digest_cache=cache)
+    info = client.get_info('/Folder 00/File 00.txt')
+    digest = info.get_digest()
+    assert_equal(digest, LocalClient(binding.local_folder).get_info(
+        '/Folder 00/File 00.txt').get_digest())
+    cache.set(info.path, info._get_cache_key(), 'fake digest')
+    assert_equal(client.get_info(info.path).get_digest(), 'fake digest')
+
+    # Updating the content invalidates the cached digest and the new one is
+    # not cached as long as the file could change without a new mtime
+    client.update_content(info.path, "Some other content.")
+    new_info = client.get_info(info.path)
+    new_digest = new_info.get_digest()
+    assert_true(new_digest not in (digest, 'fake digest'))
+    assert_equal(cache.get(info.path, new_info._get_cache_key()), None)
+    age_files()
+    new_info = client.get_info(info.path)
+    assert_equal(new_info.get_digest(), new_digest)
+    assert_equal(cache.get(info.path, new_info._get_cache_key()), new_digest)
+
+    # Deleted files are forgotten
+    client.delete('/Folder 01')
+    cache.flush(session)
+    session.commit()
+    paths = sorted(d.local_path for d in session.query(LocalDigest).all())
+    assert_equal(paths, [u'/Folder 00/File 00.txt', u'/Folder 00/File 01.txt'])
+
+
+def make_deep_tree(name, depth):
+    path = '/'
+    for i in range(depth):
+        path = binding.local.make_folder(path, name)
+        binding.local.make_file(path, 'File.txt', content="Content %d" % i)
+
+
+@with_local_binding
+def test_deep_tree_deletion():
+    make_deep_tree('Deep', 3)
+    make_deep_tree('Deeper', 30)
+    # Siblings sharing a prefix with the deleted folders
+    binding.local.make_folder('/', 'Deep-sibling')
+    binding.local.make_folder('/', 'Deep0')
+    binding.ctl.synchronizer.scan_local(binding.sb)
+
+    # Some of the folders are bound to remote documents
+    session = binding.ctl.get_session()
+    for path in (u'/Deep', u'/Deep/Deep', u'/Deeper'):
+        state = session.query(LastKnownState).filter_by(
+            local_path=path).one()
+        state.remote_ref = 'ref of ' + path
+        state.update_state('synchronized', 'synchronized')
+    session.commit()
+
+    binding.local.delete('/Deep')
+    n_small = count_scan_statements()
+    binding.local.delete('/Deeper')
+    n_large = count_scan_statements()
+
+    # The deleted trees are updated in bulk whatever their size
+    assert_equal(n_small, n_large)
+    states = get_local_states()[1:]
+    assert_equal(states, [
+        (u'/Deep', 'locally_deleted'),
+        (u'/Deep-sibling', 'unknown'),
+        (u'/Deep/Deep', 'locally_deleted'),
+        (u'/Deep0', 'unknown'),
+        (u'/Deeper', 'locally_deleted'),
+    ])
+
+
+def get_state_rows():
+    session = binding.ctl.get_session()
+    states = session.query(LastKnownState).order_by(
+        LastKnownState.local_path).all()
+    return [(s.local_path, s.local_parent_path, s.local_name, s.folderish,
+             s.local_digest, s.last_local_updated, s.local_state,
+             s.remote_state, s.pair_state) for s in states]
+
+
+@with_local_binding
+def test_initial_scan_ingest():
+    make_tree(3, 3)
+    make_deep_tree('Deep', 3)
+    syn = binding.ctl.synchronizer
+    syn.ingest_chunk_size = 4
+    with StatementRecorder(binding.ctl) as recorder:
+        syn.scan_local(binding.sb)
+    inserts = [len(parameters) if executemany else 1
+               for statement, parameters, executemany
+               in recorder.get('INSERT INTO last_known_states')]
+    # The new states are inserted by chunks
+    assert_equal(inserts, [4] * 4 + [2])
+    states = get_state_rows()
+    assert_equal(len(states), 19)
+    assert_equal(states[1][:4], (u'/Deep', u'/', u'Deep', 1))
+
+    # Same states as when created one by one
+    session = binding.ctl.get_session()
+    session.query(LastKnownState).filter(
+        LastKnownState.local_path != '/').delete()
+    session.commit()
+    syn.ingest_chunk_size = 0
+    syn.scan_local(binding.sb)
+    assert_equal(get_state_rows(), states)
+
+
+@with_local_binding
+def test_scan_commits():
+    make_tree(3, 3)
+    syn = binding.ctl.synchronizer
+    syn.ingest_chunk_size = 0
+    syn.scan_commit_size = 4
+    session = binding.ctl.get_session()
+    commits = []
+
+    def count_commit(session):
+        commits.append(session)
+
+    event.listen(session, 'after_commit', count_commit)
+    try:
+        # The 12 new states are committed by chunks, then at the end
+        syn.scan_local(binding.sb, session=session)
+        assert_equal(len(commits), 4)
+        assert_equal(len(get_local_states()), 13)
+
+        # The states loaded by the scan are not expired by the commits
+        syn.scan_commit_size = 0
+        n_queries = count_scan_statements('SELECT')
+        syn.scan_commit_size = 1
+        del commits[:]
+        assert_equal(count_scan_statements('SELECT'), n_queries)
+        assert_equal(len(commits), 13)
+    finally:
+        event.remove(session, 'after_commit', count_commit)
\ No newline at end of file
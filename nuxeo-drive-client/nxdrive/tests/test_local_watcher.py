@@ -0,0 +1,154 @@
+import errno
+import os
+import tempfile
+import shutil
+from nose import SkipTest
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_true
+
+from nxdrive.client import LocalClient
+from nxdrive import synchronizer
+from nxdrive.controller import Controller
+from nxdrive.local_watcher import InotifyWatcher
+from nxdrive.local_watcher import LocalWatcher
+from nxdrive.local_watcher import inotify_available
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+
+
+LOCAL_TEST_FOLDER = None
+lcclient = None
+
+
+def setup_temp_folder():
+    global lcclient, LOCAL_TEST_FOLDER
+    if not inotify_available():
+        raise SkipTest("inotify is not available on this platform")
+    LOCAL_TEST_FOLDER = tempfile.mkdtemp('-nuxeo-drive-tests')
+    lcclient = LocalClient(LOCAL_TEST_FOLDER)
+
+
+def teardown_temp_folder():
+    if LOCAL_TEST_FOLDER is not None and os.path.exists(LOCAL_TEST_FOLDER):
+        shutil.rmtree(LOCAL_TEST_FOLDER)
+
+
+with_temp_folder = with_setup(setup_temp_folder, teardown_temp_folder)
+
+
+@with_temp_folder
+def test_inotify_dirty_folders():
+    folder_1 = lcclient.make_folder('/', 'Folder 1')
+    watcher = InotifyWatcher(lcclient)
+    watcher.start()
+    try:
+        # Startup requires a full scan
+        assert_equal(watcher.get_changes(), None)
+        assert_equal(watcher.get_changes(), set())
+
+        lcclient.make_file(folder_1, 'File 1.txt', content="Some content.")
+        assert_equal(watcher.get_changes(), set([folder_1]))
+
+        # New sub folders get watched as well
+        folder_2 = lcclient.make_folder(folder_1, 'Folder 2')
+        assert_equal(watcher.get_changes(), set([folder_1]))
+        lcclient.make_file(folder_2, 'File 2.txt')
+        assert_equal(watcher.get_changes(), set([folder_2]))
+
+        # Ignored files do not trigger any rescan
+        lcclient.make_file(folder_2, '.hidden')
+        assert_equal(watcher.get_changes(), set())
+
+        # Moved folders are still watched under their new path
+        moved = lcclient.rename(folder_2, 'Folder 3').path
+        assert_equal(watcher.get_changes(), set([folder_1]))
+        lcclient.update_content(moved + '/File 2.txt', "Updated content.")
+        assert_equal(watcher.get_changes(), set([moved]))
+
+        lcclient.delete(moved)
+        assert_true(folder_1 in watcher.get_changes())
+    finally:
+        watcher.stop()
+
+    # A stopped watcher always asks for full scans
+    assert_equal(watcher.get_changes(), None)
+
+
+@with_temp_folder
+def test_incremental_local_scan():
+    conf_folder = tempfile.mkdtemp('-nuxeo-drive-conf')
+    ctl = Controller(conf_folder)
+    try:
+        session = ctl.get_session()
+        sb = ServerBinding(LOCAL_TEST_FOLDER, 'http://localhost:8080/nuxeo/',
+                           'Administrator', remote_password='Administrator')
+        session.add(sb)
+        session.add(LastKnownState(LOCAL_TEST_FOLDER,
+                                   local_info=lcclient.get_info('/'),
+                                   local_state='synchronized'))
+        session.commit()
+        folder_1 = lcclient.make_folder('/', 'Folder 1')
+        lcclient.make_file(folder_1, 'File 1.txt', content="Some content.")
+
+        def local_paths():
+            return sorted(s.local_path
+                          for s in session.query(LastKnownState).all())
+
+        syn = ctl.synchronizer
+        # First pass is a full scan
+        syn._update_local_states(sb, session=session)
+        assert_equal(local_paths(),
+                     ['/', '/Folder 1', '/Folder 1/File 1.txt'])
+
+        # Only the dirty folders are rescanned afterwards
+        folder_2 = lcclient.make_folder(folder_1, 'Folder 2')
+        lcclient.make_file(folder_2, 'File 2.txt')
+        lcclient.delete(folder_1 + '/File 1.txt')
+        syn._update_local_states(sb, session=session)
+        assert_equal(local_paths(), ['/', '/Folder 1', '/Folder 1/Folder 2',
+                                     '/Folder 1/Folder 2/File 2.txt'])
+    finally:
+        ctl.dispose()
+        shutil.rmtree(conf_folder)
+
+
+class FailingWatcher(LocalWatcher):
+
+    def start(self):
+        raise OSError(errno.EMFILE, os.strerror(errno.EMFILE))
+
+    def get_changes(self):
+        raise AssertionError("Not started")
+
+
+def test_watcher_start_failure():
+    local_folder = tempfile.mkdtemp('-nuxeo-drive-tests')
+    conf_folder = tempfile.mkdtemp('-nuxeo-drive-conf')
+    ctl = Controller(conf_folder)
+    get_local_watcher = synchronizer.get_local_watcher
+    synchronizer.get_local_watcher = FailingWatcher
+    try:
+        client = LocalClient(local_folder)
+        session = ctl.get_session()
+        sb = ServerBinding(local_folder, 'http://localhost:8080/nuxeo/',
+                           'Administrator', remote_password='Administrator')
+        session.add(sb)
+        session.add(LastKnownState(local_folder,
+                                   local_info=client.get_info('/'),
+                                   local_state='synchronized'))
+        session.commit()
+        client.make_file('/', 'File 1.txt', content="Some content.")
+
+        # Full scans each time instead of stopping the synchronization
+        syn = ctl.synchronizer
+        for i in range(2):
+            assert_true(syn._update_local_states(sb, session=session))
+        assert_equal(sorted(s.local_path
+                            for s in session.query(LastKnownState).all()),
+                     ['/', '/File 1.txt'])
+    finally:
+        synchronizer.get_local_watcher = get_local_watcher
+        ctl.dispose()
+        shutil.rmtree(local_folder)
+        shutil.rmtree(conf_folder)
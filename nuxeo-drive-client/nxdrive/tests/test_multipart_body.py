@@ -0,0 +1,77 @@
+import os
+import tempfile
+import urllib2
+from threading import Thread
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from nose.tools import assert_equal
+from nose.tools import assert_raises
+
+from nxdrive.client.base_automation_client import MultipartBody
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        body = self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_multipart_body():
+    f = tempfile.TemporaryFile()
+    try:
+        content = ''.join(chr(i % 256) for i in range(100000))
+        f.write('ignored prefix' + content)
+        f.seek(len('ignored prefix'))
+        body = MultipartBody(['--head\r\n', f, '\r\n--tail--'])
+        expected = '--head\r\n' + content + '\r\n--tail--'
+        assert_equal(len(body), len(expected))
+
+        chunks = []
+        while True:
+            chunk = body.read(8192)
+            if not chunk:
+                break
+            assert_equal(len(chunk) <= 8192, True)
+            chunks.append(chunk)
+        assert_equal(''.join(chunks), expected)
+
+        # The body can be rewound to send it again
+        body.seek(0)
+        assert_equal(body.read(), expected)
+        assert_raises(ValueError, body.seek, 10)
+
+        # Truncated files are detected
+        body.seek(0)
+        f.truncate(1000)
+        assert_raises(IOError, body.read)
+    finally:
+        f.close()
+
+
+def test_multipart_body_upload():
+    server = HTTPServer(('127.0.0.1', 0), EchoHandler)
+    thread = Thread(target=server.handle_request)
+    thread.start()
+    path = tempfile.mktemp('-nuxeo-drive-tests')
+    try:
+        content = os.urandom(3 * 1024 * 1024)
+        with open(path, 'wb') as f:
+            f.write(content)
+        with open(path, 'rb') as f:
+            body = MultipartBody(['head', f, 'tail'])
+            url = 'http://127.0.0.1:%d/' % server.server_port
+            response = urllib2.urlopen(urllib2.Request(url, body))
+            assert_equal(response.read(), 'head' + content + 'tail')
+    finally:
+        thread.join()
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,392 @@
+import os
+import sqlite3
+import time
+import tempfile
+import shutil
+import urllib2
+from email.utils import formatdate
+from threading import Event
+from threading import Lock
+from threading import Thread
+from threading import current_thread
+from nose.tools import assert_equal
+from nose.tools import assert_true
+from sqlalchemy.exc import OperationalError
+
+from nxdrive.client import LocalClient
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.remote_poller import get_retry_after
+from nxdrive.remote_poller import PollScheduler
+from nxdrive.remote_poller import RemotePoller
+from nxdrive.tests.common import FakeRemoteFileSystemClient
+from nxdrive.tests.common import binding
+from nxdrive.tests.common import with_binding
+
+
+def test_poll_scheduler():
+    scheduler = PollScheduler(10, 120, 600)
+    # Back off while idle
+    delays = [scheduler.next_delay() for _ in range(6)]
+    assert_equal(delays, [10, 20, 40, 80, 120, 120])
+
+    # Poll again right away after some activity
+    assert_equal(scheduler.next_delay(n_synchronized=3), 0)
+    assert_equal(scheduler.next_delay(), 10)
+
+    # Back off harder while offline
+    delays = [scheduler.next_delay(offline=True) for _ in range(8)]
+    assert_equal(delays, [10, 20, 40, 80, 160, 320, 600, 600])
+    assert_equal(scheduler.next_delay(), 10)
+
+    # Honor the delay requested by the server if longer
+    assert_equal(scheduler.next_delay(hint=300), 300)
+    assert_equal(scheduler.next_delay(hint=1), 40)
+    assert_equal(scheduler.next_delay(offline=True, hint=10 ** 6), 3600)
+
+    # No delay at all
+    scheduler = PollScheduler(0, 120, 600)
+    assert_equal([scheduler.next_delay() for _ in range(3)], [0, 0, 0])
+
+
+def make_http_error(headers):
+    return urllib2.HTTPError('http://localhost:8080/nuxeo/', 503,
+                             'Service Unavailable', headers, None)
+
+
+def test_get_retry_after():
+    assert_equal(get_retry_after(make_http_error({'Retry-After': '120'})),
+                  120)
+    delay = get_retry_after(make_http_error(
+        {'Retry-After': formatdate(time.time() + 60, usegmt=True)}))
+    assert_true(55 < delay <= 60)
+    assert_equal(get_retry_after(make_http_error(
+        {'Retry-After': formatdate(time.time() - 60, usegmt=True)})), 0)
+
+    assert_equal(get_retry_after(make_http_error({})), None)
+    assert_equal(get_retry_after(make_http_error(
+        {'Retry-After': 'tomorrow'})), None)
+    assert_equal(get_retry_after(ValueError('Not a network error')), None)
+
+
+def make_summary(n_changes=0):
+    return {'fileSystemChanges': [{}] * n_changes,
+            'hasTooManyChanges': False}
+
+
+class RecordingFetch(object):
+
+    def __init__(self, error=None):
+        self.checkpoints = []
+        self.threads = set()
+        self.error = error
+        self.polled = Event()
+
+    def __call__(self, last_sync_date, last_root_definitions):
+        self.checkpoints.append((last_sync_date, last_root_definitions))
+        self.threads.add(current_thread().name)
+        self.polled.set()
+        if self.error is not None:
+            raise self.error
+        sync_date = last_sync_date + 1
+        return make_summary(), (sync_date, 'roots')
+
+
+def wait_for_results(poller, timeout=5.0):
+    deadline = time.time() + timeout
+    while not poller.has_results():
+        assert_true(time.time() < deadline, "No poll result")
+        time.sleep(0.001)
+    return poller.get_results()
+
+
+def test_remote_poller():
+    fetch = RecordingFetch()
+    poller = RemotePoller(fetch, (0, ''), PollScheduler(0, 0, 0),
+                          name='TestPoller')
+    poller.start()
+    try:
+        results = wait_for_results(poller)
+        assert_equal(results, [(make_summary(), (1, 'roots'), None)])
+        assert_equal(fetch.threads, set(['TestPoller']))
+
+        # A single result is queued at a time
+        time.sleep(0.05)
+        assert_equal(len(fetch.checkpoints), 2)
+        assert_equal(len(poller.get_results()), 1)
+
+        # Each poll starts from the checkpoint of the previous one
+        wait_for_results(poller)
+        assert_equal(fetch.checkpoints[:3],
+                     [(0, ''), (1, 'roots'), (2, 'roots')])
+
+        # Poll again from a given checkpoint
+        poller.reset((10, 'other roots'))
+        assert_equal(wait_for_results(poller)[-1][1], (11, 'roots'))
+    finally:
+        poller.stop()
+
+
+def test_remote_poller_schedule():
+    fetch = RecordingFetch()
+    poller = RemotePoller(fetch, (0, ''), PollScheduler(60, 120, 600))
+    # The caller already polled
+    poller.start((make_summary(), (0, ''), None))
+    try:
+        time.sleep(0.05)
+        assert_equal(fetch.checkpoints, [])
+        poller.poll_now()
+        wait_for_results(poller)
+        assert_equal(fetch.checkpoints, [(0, '')])
+    finally:
+        poller.stop()
+
+
+def test_remote_poller_delays():
+    poller = RemotePoller(RecordingFetch(), (0, ''),
+                          PollScheduler(10, 120, 600))
+    # Poll again right away after some changes, back off while idle
+    assert_equal(poller._next_delay(make_summary(3), (1, ''), None), 0)
+    assert_equal([poller._next_delay(make_summary(), (1, ''), None)
+                  for _ in range(3)], [10, 20, 40])
+    summary = make_summary()
+    summary['hasTooManyChanges'] = True
+    assert_equal(poller._next_delay(summary, (1, ''), None), 0)
+
+    # Back off harder while offline, as long as asked by the server
+    error = urllib2.URLError('Connection refused')
+    exc_info = (urllib2.URLError, error, None)
+    assert_equal([poller._next_delay(None, None, exc_info)
+                  for _ in range(7)], [10, 20, 40, 80, 160, 320, 600])
+    error = make_http_error({'Retry-After': '900'})
+    exc_info = (urllib2.HTTPError, error, None)
+    assert_equal(poller._next_delay(None, None, exc_info), 900)
+
+
+def test_remote_poller_errors():
+    error = urllib2.HTTPError('http://localhost:8080/nuxeo/', 503,
+                              'Service Unavailable', {'Retry-After': '30'},
+                              None)
+    fetch = RecordingFetch(error=error)
+    scheduler = PollScheduler(0, 0, 0)
+    poller = RemotePoller(fetch, (0, ''), scheduler)
+    poller.start()
+    try:
+        results = wait_for_results(poller)
+        assert_equal(len(results), 1)
+        summary, checkpoint, exc_info = results[0]
+        assert_equal(summary, None)
+        assert_true(exc_info[1] is error)
+
+        # The Retry-After header is honored
+        fetch.polled.clear()
+        assert_true(not fetch.polled.wait(0.05))
+        assert_equal(len(fetch.checkpoints), 1)
+    finally:
+        poller.stop()
+
+
+@with_binding
+def test_loop_stages():
+    FakeRemoteFileSystemClient.add('root', 'Remote 1.txt',
+                                   content="Remote content 1")
+    local = LocalClient(binding.local_folder)
+    local.make_file('/', 'Local 1.txt', "Local content 1")
+    syn = binding.ctl.synchronizer
+
+    # The first poll is a full remote scan performed inline
+    syn.loop(delay=0, max_loops=1)
+    assert_equal(local.get_content('/Remote 1.txt'), "Remote content 1")
+    assert_equal(len(binding.ctl.list_pending()), 0)
+    uploaded = [uid for uid, info in FakeRemoteFileSystemClient.tree.items()
+                if info.name == 'Local 1.txt']
+    assert_equal(len(uploaded), 1)
+
+    # Then the remote changes are polled in the background
+    uid = FakeRemoteFileSystemClient.add('root', 'Remote 2.txt',
+                                         content="Remote content 2")
+    FakeRemoteFileSystemClient.changes.append(uid)
+    del FakeRemoteFileSystemClient.calls[:]
+    syn.loop(delay=0, max_loops=1)
+    assert_equal(local.get_content('/Remote 2.txt'), "Remote content 2")
+    polls = [op for op, _ in FakeRemoteFileSystemClient.calls
+             if op == 'GetChangeSummary']
+    assert_true(len(polls) >= 1)
+    session = binding.ctl.get_session()
+    sb = session.query(ServerBinding).one()
+    assert_true(sb.last_sync_date >= 2)
+
+
+@with_binding
+def test_loop_sleep():
+    syn = binding.ctl.synchronizer
+    syn.stop_check_period = 0.01
+    # The stop requests are checked while sleeping
+    stop_file = os.path.join(binding.conf_folder, 'stop_%d' % os.getpid())
+    open(stop_file, 'wb').close()
+    start = time.time()
+    assert_true(syn._sleep(60))
+    assert_true(time.time() - start < 5.0)
+    assert_true(not os.path.exists(stop_file))
+
+    # And the loop wakes up as soon as a binding worker is done
+    syn._loop_wakeup.set()
+    assert_true(not syn._sleep(60))
+    assert_true(time.time() - start < 5.0)
+
+
+SLOW_SERVER_URL = 'http://slow.example.com/nuxeo/'
+
+
+class BlockingClient(FakeRemoteFileSystemClient):
+    """Clients of SLOW_SERVER_URL hang until released"""
+
+    released = Event()
+    active = []
+    max_active = [0]
+    lock = Lock()
+
+    def get_changes(self, last_sync_date=None, last_root_definitions=None):
+        if self.server_url == SLOW_SERVER_URL:
+            self.released.wait(5.0)
+        return super(BlockingClient, self).get_changes(
+            last_sync_date=last_sync_date,
+            last_root_definitions=last_root_definitions)
+
+    def get_content(self, fs_item_id, file_out=None, fs_item_info=None):
+        with self.lock:
+            self.active.append(current_thread().name)
+            self.max_active[0] = max(self.max_active[0], len(self.active))
+        try:
+            # Make the transfers overlap
+            time.sleep(0.01)
+            return super(BlockingClient, self).get_content(
+                fs_item_id, file_out=file_out, fs_item_info=fs_item_info)
+        finally:
+            with self.lock:
+                self.active.remove(current_thread().name)
+
+
+@with_binding
+def test_loop_bindings():
+    binding.ctl.remote_fs_client_factory = BlockingClient
+    BlockingClient.released.clear()
+    BlockingClient.max_active[0] = 0
+    for i in range(4):
+        FakeRemoteFileSystemClient.add('root', 'File %d.txt' % i,
+                                       content="Content %d" % i)
+    slow_folder = tempfile.mkdtemp('-nuxeo-drive-tests')
+    try:
+        session = binding.ctl.get_session()
+        session.add(ServerBinding(slow_folder, SLOW_SERVER_URL,
+                                  'Administrator',
+                                  remote_password='Administrator'))
+        session.add(LastKnownState(
+            slow_folder, local_info=LocalClient(slow_folder).get_info('/'),
+            remote_info=FakeRemoteFileSystemClient.tree['root'],
+            local_state='synchronized', remote_state='synchronized'))
+        session.commit()
+
+        syn = binding.ctl.synchronizer
+        syn.transfer_workers = 2
+        loop = Thread(target=syn.loop, kwargs={'delay': 0, 'max_loops': 1})
+        loop.start()
+        try:
+            # The hanging server does not delay the other binding
+            local = LocalClient(binding.local_folder)
+            deadline = time.time() + 5.0
+            while not local.exists('/File 3.txt'):
+                assert_true(time.time() < deadline, "Binding not synced")
+                time.sleep(0.01)
+            assert_equal(os.listdir(slow_folder), [])
+        finally:
+            BlockingClient.released.set()
+            loop.join()
+
+        slow_local = LocalClient(slow_folder)
+        for i in range(4):
+            assert_equal(local.get_content('/File %d.txt' % i),
+                         "Content %d" % i)
+            assert_equal(slow_local.get_content('/File %d.txt' % i),
+                         "Content %d" % i)
+        # The transfers of all the bindings share the same pool
+        assert_true(BlockingClient.max_active[0] <= 2)
+    finally:
+        shutil.rmtree(slow_folder)
+
+
+@with_binding
+def test_loop_database_locked():
+    FakeRemoteFileSystemClient.add('root', 'Remote 1.txt',
+                                   content="Remote content 1")
+    syn = binding.ctl.synchronizer
+    syn.locked_delay = 0.01
+    run_due_stages = syn._run_due_stages
+    schedules = []
+
+    def locked_run_due_stages(server_binding, schedule, session=None):
+        schedules.append(schedule)
+        n_synchronized = run_due_stages(server_binding, schedule,
+                                        session=session)
+        if len(schedules) == 1:
+            raise OperationalError(
+                'UPDATE', {}, sqlite3.OperationalError('database is locked'))
+        return n_synchronized
+
+    syn._run_due_stages = locked_run_due_stages
+    # The worker backs off and runs the stages again from the last
+    # checkpoint instead of stopping the loop
+    syn.loop(delay=0, max_loops=1)
+    assert_equal(len(schedules), 2)
+    assert_true(schedules[0] is not schedules[1])
+    local = LocalClient(binding.local_folder)
+    assert_equal(local.get_content('/Remote 1.txt'), "Remote content 1")
+    assert_equal(len(binding.ctl.list_pending()), 0)
+
+
+class UnavailableClient(FakeRemoteFileSystemClient):
+    """The server asks to retry the downloads later"""
+
+    downloads = []
+
+    def get_content(self, fs_item_id, file_out=None, fs_item_info=None):
+        self.downloads.append(fs_item_id)
+        raise make_http_error({'Retry-After': '30'})
+
+
+@with_binding
+def test_loop_synchronize_error():
+    binding.ctl.remote_fs_client_factory = UnavailableClient
+    del UnavailableClient.downloads[:]
+    FakeRemoteFileSystemClient.add('root', 'Remote 1.txt',
+                                   content="Remote content 1")
+    syn = binding.ctl.synchronizer
+    session = binding.ctl.get_session()
+    sb = session.query(ServerBinding).one()
+    schedule = syn._make_schedule(syn._make_binding_info(sb), 0)
+    try:
+        syn._run_due_stages(sb, schedule, session=session)
+        assert_equal(len(UnavailableClient.downloads), 1)
+        assert_true(schedule.offline)
+        assert_true(schedule.next_synchronize > time.time() + 25)
+
+        # The changes found in the mean time do not trigger a new attempt
+        # before the delay asked by the server
+        uid = FakeRemoteFileSystemClient.add('root', 'Remote 2.txt',
+                                             content="Remote content 2")
+        FakeRemoteFileSystemClient.changes.append(uid)
+        schedule.poller.poll_now()
+        deadline = time.time() + 5.0
+        while not schedule.poller.has_results():
+            assert_true(time.time() < deadline, "No poll result")
+            time.sleep(0.001)
+        syn._run_due_stages(sb, schedule, session=session)
+        assert_true(not schedule.offline)
+        assert_equal(len(UnavailableClient.downloads), 1)
+
+        # Then the pending pairs are synchronized again
+        schedule.next_synchronize = 0
+        syn._run_due_stages(sb, schedule, session=session)
+        assert_equal(len(UnavailableClient.downloads), 2)
+    finally:
+        schedule.stop()
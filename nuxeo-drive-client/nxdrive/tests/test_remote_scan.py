@@ -0,0 +1,351 @@
+from threading import Event
+from threading import current_thread
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_true
+from sqlalchemy import event
+
+from nxdrive.client import LocalClient
+from nxdrive.model import FolderStatus
+from nxdrive.model import LastKnownState
+from nxdrive.model import delete_states
+from nxdrive.tests.common import FakeRemoteFileSystemClient
+from nxdrive.tests.common import StatementRecorder
+from nxdrive.tests.common import binding
+from nxdrive.tests.common import setup_binding
+from nxdrive.tests.common import teardown_binding
+
+
+class ThreadRecordingClient(FakeRemoteFileSystemClient):
+
+    threads = set()
+    # Set once a folder is listed by a remote scan worker
+    worker_listing = Event()
+    wait_for_workers = False
+
+    def get_children_info(self, fs_item_id):
+        name = current_thread().name
+        self.threads.add(name)
+        if name.startswith('RemoteScanWorker'):
+            self.worker_listing.set()
+        elif self.wait_for_workers and fs_item_id != 'root':
+            # The subfolders listed inline by the scanning thread wait for
+            # the workers to prefetch the other ones
+            self.worker_listing.wait(5.0)
+        return super(ThreadRecordingClient, self).get_children_info(
+            fs_item_id)
+
+    def get_info(self, fs_item_id, raise_if_missing=True):
+        self.threads.add(current_thread().name)
+        return super(ThreadRecordingClient, self).get_info(
+            fs_item_id, raise_if_missing=raise_if_missing)
+
+
+def setup_recording_binding():
+    """Bind a temporary folder to a fake remote file system"""
+    setup_binding(client_factory=ThreadRecordingClient)
+    ThreadRecordingClient.threads.clear()
+    ThreadRecordingClient.worker_listing.clear()
+    ThreadRecordingClient.wait_for_workers = False
+
+
+with_binding = with_setup(setup_recording_binding, teardown_binding)
+
+
+def make_remote_tree(parent='root', depth=3, width=3):
+    for i in range(width):
+        FakeRemoteFileSystemClient.add(parent, 'File %d.txt' % i,
+                                       content="Content %d" % i)
+        if depth > 1:
+            folder = FakeRemoteFileSystemClient.add(
+                parent, 'Folder %d' % i, folderish=True)
+            make_remote_tree(folder, depth - 1, width)
+
+
+def get_remote_states():
+    session = binding.ctl.get_session()
+    states = session.query(LastKnownState).order_by(
+        LastKnownState.remote_ref).all()
+    return [(s.remote_ref, s.remote_parent_ref, s.remote_name, s.pair_state)
+            for s in states]
+
+
+@with_binding
+def test_parallel_remote_scan():
+    make_remote_tree()
+    syn = binding.ctl.synchronizer
+    syn.remote_scan_workers = 4
+    ThreadRecordingClient.wait_for_workers = True
+
+    # The progress of the scan is reported for its binding only
+    progress = []
+    scan_remote_recursive = syn._scan_remote_recursive
+
+    def recording_scan_remote_recursive(*args, **kwargs):
+        progress.append((syn.get_remote_scan_progress(binding.local_folder),
+                         syn.get_remote_scan_progress('/other/folder')))
+        return scan_remote_recursive(*args, **kwargs)
+
+    syn._scan_remote_recursive = recording_scan_remote_recursive
+    try:
+        syn.scan_remote(binding.sb)
+    finally:
+        del syn._scan_remote_recursive
+    assert_true(progress[0][0] is not None)
+    assert_equal(progress[0][1], None)
+    states = get_remote_states()
+    assert_equal(len(states), len(FakeRemoteFileSystemClient.tree))
+    assert_equal(
+        sorted((ref, parent, name) for ref, parent, name, _ in states),
+        sorted((info.uid, info.parent_uid, info.name)
+               for info in FakeRemoteFileSystemClient.tree.values()))
+
+    # The folders are listed once, mostly by the workers
+    listed = [ref for op, ref in FakeRemoteFileSystemClient.calls
+              if op == 'GetChildren']
+    assert_equal(len(listed), 13)
+    assert_equal(len(set(listed)), 13)
+    assert_true(any(name.startswith('RemoteScanWorker')
+                    for name in ThreadRecordingClient.threads))
+    assert_equal(syn.get_remote_scan_progress(binding.local_folder), None)
+
+    # Same result as a sequential scan
+    syn.remote_scan_workers = 0
+    session = binding.ctl.get_session()
+    for state in session.query(LastKnownState).filter(
+            LastKnownState.remote_parent_ref != None).all():
+        session.delete(state)
+    session.commit()
+    syn.scan_remote(binding.sb)
+    assert_equal(get_remote_states(), states)
+
+
+def make_change_summary(remote_refs):
+    # Most recent changes last
+    return {'fileSystemChanges': [
+        {'fileSystemItemId': remote_ref, 'eventDate': i}
+        for i, remote_ref in enumerate(remote_refs)]}
+
+
+@with_binding
+def test_update_remote_states_batch():
+    make_remote_tree(depth=2)
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    remote = binding.ctl.get_remote_fs_client(binding.sb)
+    files = sorted(uid for uid, info in FakeRemoteFileSystemClient.tree.items()
+                   if not info.folderish)
+    for uid in files:
+        remote.update_content(uid, "Updated content of %s" % uid)
+    new_file = FakeRemoteFileSystemClient.add('root', 'New file.txt')
+    # Some documents are changed several times
+    summary = make_change_summary(files + files[:3] + [new_file, 'missing'])
+    del FakeRemoteFileSystemClient.calls[:]
+
+    with StatementRecorder(binding.ctl) as recorder:
+        syn._update_remote_states(binding.sb, summary)
+
+    # A single request fetches all the changed documents
+    assert_equal([op for op, _ in FakeRemoteFileSystemClient.calls],
+                 ['GetFileSystemItems'])
+    # The pairs of the changed documents and of their parents are fetched
+    # at once, the creation of the new pair needs a few more queries
+    assert_true(recorder.count('SELECT') < 10)
+    session = binding.ctl.get_session()
+    for uid in files:
+        pair = session.query(LastKnownState).filter_by(remote_ref=uid).one()
+        assert_equal(pair.remote_state, 'modified')
+    pair = session.query(LastKnownState).filter_by(remote_ref=new_file).one()
+    assert_equal(pair.remote_name, 'New file.txt')
+
+
+@with_binding
+def test_update_remote_states_fan_out():
+    make_remote_tree(depth=2)
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    FakeRemoteFileSystemClient.batch_get = False
+    remote = binding.ctl.get_remote_fs_client(binding.sb)
+    files = sorted(uid for uid, info in FakeRemoteFileSystemClient.tree.items()
+                   if not info.folderish)
+    for uid in files:
+        remote.update_content(uid, "Updated content of %s" % uid)
+    del FakeRemoteFileSystemClient.calls[:]
+    ThreadRecordingClient.threads.clear()
+
+    # Without batch support, the documents are fetched concurrently
+    syn.remote_scan_workers = 3
+    syn._update_remote_states(binding.sb, make_change_summary(files + files))
+    assert_equal(sorted(ref for op, ref in FakeRemoteFileSystemClient.calls
+                        if op == 'GetFileSystemItem'), files)
+    assert_true(any(name.startswith('RemoteInfoWorker')
+                    for name in ThreadRecordingClient.threads))
+    session = binding.ctl.get_session()
+    for uid in files:
+        pair = session.query(LastKnownState).filter_by(remote_ref=uid).one()
+        assert_equal(pair.remote_state, 'modified')
+
+
+@with_binding
+def test_update_remote_states_embedded_items():
+    make_remote_tree(depth=2)
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    remote = binding.ctl.get_remote_fs_client(binding.sb)
+    files = sorted(uid for uid, info in FakeRemoteFileSystemClient.tree.items()
+                   if not info.folderish)
+    for uid in files:
+        remote.update_content(uid, "Updated content of %s" % uid)
+    summary = make_change_summary(files + ['missing'])
+    for change in summary['fileSystemChanges'][:-1]:
+        change['fileSystemItemInfo'] = FakeRemoteFileSystemClient.tree[
+            change['fileSystemItemId']]
+    del FakeRemoteFileSystemClient.calls[:]
+
+    syn._update_remote_states(binding.sb, summary)
+
+    # Only the document missing from its change is fetched
+    assert_equal(FakeRemoteFileSystemClient.calls,
+                 [('GetFileSystemItems', 'missing')])
+    session = binding.ctl.get_session()
+    for uid in files:
+        pair = session.query(LastKnownState).filter_by(remote_ref=uid).one()
+        assert_equal(pair.remote_state, 'modified')
+
+
+@with_binding
+def test_remote_tree_deletion():
+    folder = FakeRemoteFileSystemClient.add('root', 'Folder', folderish=True)
+    make_remote_tree(folder, depth=3, width=3)
+    FakeRemoteFileSystemClient.add('root', 'Other.txt', content="Other")
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    assert_equal(syn.synchronize(), 53)
+    local = LocalClient(binding.local_folder)
+    assert_true(local.exists('/Folder/Folder 2/Folder 2/File 2.txt'))
+
+    # The descendants are collected with one query per tree level
+    session = binding.ctl.get_session()
+    pair = session.query(LastKnownState).filter_by(remote_ref=folder).one()
+    ids = syn._get_descendant_ids(session, pair, local=False)
+    assert_equal(len(ids), 51)
+    with StatementRecorder(binding.ctl) as recorder:
+        syn._get_descendant_ids(session, pair, local=False)
+    assert_equal(recorder.count('SELECT'), 4)
+
+    del FakeRemoteFileSystemClient.tree[folder]
+    syn.scan_remote(binding.sb)
+    states = get_remote_states()
+    deleted = [s for s in states if s[0].startswith(folder)]
+    assert_equal(len(deleted), 52)
+    assert_true(all(s[3] == 'remotely_deleted' for s in deleted))
+
+    assert_equal(syn.synchronize(), 1)
+    assert_true(not local.exists('/Folder'))
+    assert_equal([s[2] for s in get_remote_states()],
+                 [u'Nuxeo Drive', u'Other.txt'])
+
+
+def get_remote_state_rows():
+    session = binding.ctl.get_session()
+    states = session.query(LastKnownState).order_by(
+        LastKnownState.remote_ref).all()
+    return [(s.remote_ref, s.remote_parent_ref, s.remote_parent_path,
+             s.remote_name, s.folderish, s.remote_digest,
+             s.last_remote_updated, s.local_path, s.pair_state)
+            for s in states]
+
+
+def get_folder_status():
+    session = binding.ctl.get_session()
+    return sorted((s.local_path, s.pending)
+                  for s in session.query(FolderStatus).all())
+
+
+@with_binding
+def test_remote_scan_ingest():
+    make_remote_tree()
+    syn = binding.ctl.synchronizer
+    syn.ingest_chunk_size = 10
+    with StatementRecorder(binding.ctl) as bulk_recorder:
+        syn.scan_remote(binding.sb)
+    states = get_remote_state_rows()
+    assert_equal(len(states), len(FakeRemoteFileSystemClient.tree))
+    status = get_folder_status()
+    assert_equal(status, [(u'/', 6)])
+
+    # Same states and counters as when created one by one
+    session = binding.ctl.get_session()
+    delete_states(session, LastKnownState.remote_parent_ref != None)
+    session.commit()
+    syn.ingest_chunk_size = 0
+    with StatementRecorder(binding.ctl) as recorder:
+        syn.scan_remote(binding.sb)
+    assert_true(recorder.count('SELECT')
+                > 4 * bulk_recorder.count('SELECT'))
+    assert_equal(get_remote_state_rows(), states)
+    assert_equal(get_folder_status(), status)
+
+
+@with_binding
+def test_remote_scan_ingest_moved():
+    make_remote_tree(depth=2)
+    syn = binding.ctl.synchronizer
+    syn.ingest_chunk_size = 10
+    syn.scan_remote(binding.sb)
+    syn.synchronize()
+    session = binding.ctl.get_session()
+    n_states = session.query(LastKnownState).count()
+
+    # Known documents moved remotely into a new folder tree
+    tree = FakeRemoteFileSystemClient.tree
+    folder = FakeRemoteFileSystemClient.add('root', 'New Folder',
+                                            folderish=True)
+    subfolder = FakeRemoteFileSystemClient.add(folder, 'New Subfolder',
+                                               folderish=True)
+    moved = {}
+    for parent_uid, name in ((folder, 'File 0.txt'),
+                             (subfolder, 'Folder 1')):
+        uid = [uid for uid, info in tree.items()
+               if info.name == name and info.parent_uid == 'root'][0]
+        tree[uid] = tree[uid]._replace(
+            parent_uid=parent_uid, path=tree[parent_uid].path + '/' + uid)
+        moved[uid] = parent_uid
+    syn.scan_remote(binding.sb)
+
+    # The moved documents keep their state, along with their descendants
+    assert_equal(session.query(LastKnownState).count(), n_states + 2)
+    for uid, parent_uid in moved.items():
+        pair = session.query(LastKnownState).filter_by(remote_ref=uid).one()
+        assert_equal(pair.remote_parent_path, tree[parent_uid].path)
+    children = session.query(LastKnownState).filter(
+        LastKnownState.remote_parent_ref.in_(moved.keys())).count()
+    assert_equal(children, 3)
+
+
+
+@with_binding
+def test_remote_scan_commits():
+    make_remote_tree(depth=2)
+    syn = binding.ctl.synchronizer
+    syn.ingest_chunk_size = 4
+    syn.scan_commit_size = 4
+    session = binding.ctl.get_session()
+    commits = []
+
+    def count_commit(session):
+        commits.append(session)
+
+    event.listen(session, 'after_commit', count_commit)
+    try:
+        # Each chunk of the 15 new states is committed, then the last one
+        syn.scan_remote(binding.sb, session=session)
+        assert_equal(len(commits), 4)
+        assert_equal(len(get_remote_states()), 16)
+
+        # Along with the documents scanned one by one
+        del commits[:]
+        syn.scan_remote(binding.sb, session=session)
+        assert_equal(len(commits), 4)
+    finally:
+        event.remove(session, 'after_commit', count_commit)
\ No newline at end of file
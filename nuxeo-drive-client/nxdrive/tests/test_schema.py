@@ -0,0 +1,191 @@
+import os
+import re
+import sqlite3
+import tempfile
+import shutil
+from nose.tools import assert_equal
+from nose.tools import assert_true
+from sqlalchemy import inspect
+
+from nxdrive.client import LocalClient
+from nxdrive import model
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.model import __model_version__
+from nxdrive.model import init_db
+from nxdrive.tests.common import FakeRemoteFileSystemClient
+from nxdrive.tests.common import StatementRecorder
+from nxdrive.tests.common import binding
+from nxdrive.tests.common import with_binding
+
+
+def record_statements(func, *args, **kwargs):
+    """Record the queries of the states issued by func"""
+    with StatementRecorder(binding.ctl) as recorder:
+        func(*args, **kwargs)
+    return [(statement, parameters)
+            for statement, parameters, executemany in recorder.statements
+            if (not executemany and 'last_known_states' in statement
+                and statement.split()[0] in ('SELECT', 'UPDATE', 'DELETE'))]
+
+
+def sync_scenario():
+    folder = FakeRemoteFileSystemClient.add('root', 'Folder', folderish=True)
+    sub_folder = FakeRemoteFileSystemClient.add(folder, 'Sub Folder',
+                                                folderish=True)
+    FakeRemoteFileSystemClient.add(sub_folder, 'File.txt', content="Content")
+    other_folder = FakeRemoteFileSystemClient.add('root', 'Other Folder',
+                                                  folderish=True)
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    syn.synchronize()
+
+    local = LocalClient(binding.local_folder)
+    local.make_file('/Folder', 'New.txt', content="New")
+    local.delete('/Folder/Sub Folder')
+    syn.scan_local(binding.sb)
+    del FakeRemoteFileSystemClient.tree[other_folder]
+    syn.scan_remote(binding.sb)
+    syn.synchronize()
+
+    binding.ctl.children_states(binding.local_folder)
+    binding.ctl.list_pending()
+    binding.ctl.list_pending(local_folder=binding.local_folder)
+
+
+@with_binding
+def test_query_plans():
+    statements = record_statements(sync_scenario)
+    assert_true(len(statements) > 0)
+    connection = binding.ctl._engine.raw_connection()
+    try:
+        for statement, parameters in statements:
+            plan = connection.cursor().execute(
+                'EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            details = [row[-1] for row in plan]
+            # No full scan of the states, with or without covering index
+            assert_true(not any(re.match(r'SCAN (TABLE )?last_known_states',
+                                         detail) for detail in details),
+                        "%s\n%s" % (statement, details))
+    finally:
+        connection.close()
+
+
+@with_binding
+def test_pragmas():
+    engine = binding.ctl._engine
+    assert_equal(engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+    # NORMAL
+    assert_equal(engine.execute('PRAGMA synchronous').scalar(), 1)
+    # MEMORY
+    assert_equal(engine.execute('PRAGMA temp_store').scalar(), 2)
+    assert_equal(engine.execute('PRAGMA cache_size').scalar(), -16 * 1024)
+
+
+@with_binding
+def test_read_while_writing():
+    # A reader, e.g. the GUI, in the middle of a read transaction
+    reader = sqlite3.connect(os.path.join(binding.conf_folder, 'nxdrive.db'),
+                             isolation_level=None)
+    writer = binding.ctl._engine.raw_connection()
+    try:
+        reader.execute('BEGIN')
+        query = 'SELECT local_state FROM last_known_states'
+        assert_equal(reader.execute(query).fetchall(), [(u'synchronized',)])
+
+        # The writer commits without waiting for the reader
+        cursor = writer.cursor()
+        cursor.execute('PRAGMA busy_timeout = 0')
+        cursor.execute("UPDATE last_known_states SET local_state = 'modified'")
+        writer.commit()
+
+        # The reader sees the states of the beginning of its transaction
+        assert_equal(reader.execute(query).fetchall(), [(u'synchronized',)])
+        reader.execute('COMMIT')
+        assert_equal(reader.execute(query).fetchall(), [(u'modified',)])
+    finally:
+        writer.close()
+        reader.close()
+
+
+def test_migration():
+    conf_folder = tempfile.mkdtemp('-nuxeo-drive-conf')
+    try:
+        # Database of version 1: no composite index, no user version
+        engine, _ = init_db(conf_folder)
+        table = LastKnownState.__table__
+        composite = [index for index in table.indexes
+                     if len(index.columns) > 1]
+        assert_true(len(composite) > 0)
+        for index in composite:
+            index.drop(engine)
+        engine.execute('PRAGMA user_version = 0')
+        engine.dispose()
+
+        engine, _ = init_db(conf_folder)
+        try:
+            names = set(index['name'] for index
+                        in inspect(engine).get_indexes(table.name))
+            assert_true(all(index.name in names for index in composite))
+            assert_equal(engine.execute('PRAGMA user_version').scalar(),
+                         __model_version__)
+        finally:
+            engine.dispose()
+    finally:
+        shutil.rmtree(conf_folder)
+
+
+def test_migration_connection_pool_settings():
+    conf_folder = tempfile.mkdtemp('-nuxeo-drive-conf')
+    try:
+        # Database of version 3: no connection pool settings
+        engine, _ = init_db(conf_folder)
+        engine.execute("INSERT INTO server_bindings (local_folder)"
+                       " VALUES ('/some/folder')")
+        for name in ('max_idle_connections', 'connection_idle_timeout'):
+            engine.execute('ALTER TABLE server_bindings DROP COLUMN %s'
+                           % name)
+        engine.execute('PRAGMA user_version = 3')
+        engine.dispose()
+
+        engine, maker = init_db(conf_folder)
+        try:
+            sb = maker().query(ServerBinding).one()
+            assert_equal(sb.max_idle_connections, None)
+            assert_equal(sb.connection_idle_timeout, None)
+            assert_equal(model.get_model_version(engine), __model_version__)
+        finally:
+            maker.remove()
+            engine.dispose()
+    finally:
+        shutil.rmtree(conf_folder)
+
+
+def test_migration_steps():
+    conf_folder = tempfile.mkdtemp('-nuxeo-drive-conf')
+    steps = []
+    migrations = dict(model.MIGRATIONS)
+    model_version = model.__model_version__
+    try:
+        engine, _ = init_db(conf_folder)
+        # New databases are created at the current version
+        assert_equal(model.get_model_version(engine), model_version)
+        engine.execute('PRAGMA user_version = %d' % (model_version - 1))
+        engine.dispose()
+
+        for version in (model_version, model_version + 1):
+            model.MIGRATIONS[version] = (
+                lambda connection, version=version: steps.append(version))
+        model.__model_version__ = model_version + 1
+        engine, _ = init_db(conf_folder)
+        try:
+            # Only the missing steps are run, in order
+            assert_equal(steps, [model_version, model_version + 1])
+            assert_equal(model.get_model_version(engine), model_version + 1)
+        finally:
+            engine.dispose()
+    finally:
+        model.MIGRATIONS.clear()
+        model.MIGRATIONS.update(migrations)
+        model.__model_version__ = model_version
+        shutil.rmtree(conf_folder)
@@ -0,0 +1,231 @@
+from threading import Event
+from threading import Thread
+from nose.tools import assert_equal
+from nose.tools import assert_true
+
+from nxdrive.client import LocalClient
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import StateIndex
+from nxdrive.model import StateIndexes
+from nxdrive.model import StateRecord
+from nxdrive.model import delete_states
+from nxdrive.model import forget_state_index
+from nxdrive.model import get_state_index
+from nxdrive.tests.common import FakeRemoteFileSystemClient
+from nxdrive.tests.common import StatementRecorder
+from nxdrive.tests.common import binding
+from nxdrive.tests.common import with_binding
+
+
+def make_remote_tree():
+    for i in range(2):
+        folder = FakeRemoteFileSystemClient.add('root', 'Folder %d' % i,
+                                                folderish=True)
+        for j in range(3):
+            FakeRemoteFileSystemClient.add(folder, 'File %d.txt' % j,
+                                           content="Content %d %d" % (i, j))
+
+
+def dump_index(index):
+    records = sorted(tuple(getattr(r, name) for name in StateRecord.__slots__)
+                     for r in index._records.values())
+    maps = [index._by_path, index._by_remote_ref, index._children,
+            index._by_name, index._by_digest]
+    return records, maps
+
+
+def check_state_index():
+    """The index written through matches the one loaded from scratch"""
+    session = binding.ctl.get_session()
+    index = get_state_index(session, binding.local_folder)
+    loaded = StateIndex(binding.local_folder)
+    loaded.load(session)
+    assert_equal(dump_index(index), dump_index(loaded))
+    return index
+
+
+@with_binding
+def test_state_index_write_through():
+    make_remote_tree()
+    syn = binding.ctl.synchronizer
+    # Loaded before the remote states are created
+    index = check_state_index()
+    assert_equal(len(index), 1)
+    syn.scan_remote(binding.sb)
+    check_state_index()
+    syn.synchronize()
+    index = check_state_index()
+    assert_equal(len(index), 9)
+
+    local = LocalClient(binding.local_folder)
+    local.make_file('/Folder 0', 'New.txt', content="New")
+    local.delete('/Folder 1')
+    syn.scan_local(binding.sb)
+    check_state_index()
+
+    # Bulk changes
+    session = binding.ctl.get_session()
+    delete_states(session, LastKnownState.local_path == '/Folder 0/New.txt')
+    index = check_state_index()
+    assert_equal(index.get_by_path('/Folder 0/New.txt'), None)
+    session.commit()
+
+    # The changes rolled back are forgotten
+    state = session.query(LastKnownState).filter_by(
+        local_path='/Folder 0/File 0.txt').one()
+    state.local_path = '/Folder 0/Other.txt'
+    index = check_state_index()
+    assert_equal(index.get_by_path('/Folder 0/File 0.txt'), None)
+    session.rollback()
+    index = check_state_index()
+    assert_equal(index.get_by_path('/Folder 0/File 0.txt').id, state.id)
+
+    # Unbinding drops the index
+    binding.ctl.unbind_server(binding.local_folder)
+    assert_equal(len(check_state_index()), 0)
+
+
+@with_binding
+def test_state_index_lookups():
+    make_remote_tree()
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    syn.synchronize()
+    session = binding.ctl.get_session()
+    index = get_state_index(session, binding.local_folder)
+    folder = index.get_by_path('/Folder 0')
+    assert_equal(index.get_by_remote_ref(folder.remote_ref), folder)
+    assert_equal(sorted(r.local_name for r in index.get_children(
+        '/Folder 0')), [u'File 0.txt', u'File 1.txt', u'File 2.txt'])
+    assert_equal(index.find_folders('Folder 1'),
+                 [index.get_by_path('/Folder 1')])
+    digest = index.get_by_path('/Folder 1/File 2.txt').local_digest
+    assert_equal(index.find_files(digest),
+                 [index.get_by_path('/Folder 1/File 2.txt')])
+
+    # Local renaming of a file and of a folder
+    local = LocalClient(binding.local_folder)
+    local.rename('/Folder 0/File 1.txt', 'Renamed.txt')
+    local.rename('/Folder 1', 'Renamed Folder')
+    syn.scan_local(binding.sb)
+    check_state_index()
+    pairs = dict((s.local_path, s) for s in session.query(LastKnownState))
+    for source, target in (('/Folder 0/File 1.txt', '/Folder 0/Renamed.txt'),
+                           ('/Folder 1', '/Renamed Folder')):
+        source_pair = pairs[source]
+        assert_equal(source_pair.pair_state, 'locally_deleted')
+        with StatementRecorder(binding.ctl) as recorder:
+            detected = syn._detect_local_move_or_rename(
+                source_pair, session, None, None, None, None)
+        assert_equal(detected, (source_pair, pairs[target]))
+        # Dictionary lookups only, the candidate is already loaded
+        assert_equal(recorder.count('SELECT'), 0)
+
+
+@with_binding
+def test_state_index_no_digest():
+    make_remote_tree()
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    syn.synchronize()
+    session = binding.ctl.get_session()
+    state = session.query(LastKnownState).filter_by(
+        local_path='/Folder 0/File 0.txt').one()
+    state.local_digest = None
+    session.commit()
+
+    # A deleted and a created file without digest are not a move
+    local = LocalClient(binding.local_folder)
+    local.delete('/Folder 0/File 0.txt')
+    local.make_file('/Folder 1', 'New.txt', content="New")
+    syn.digest_workers = 2
+    syn.scan_digest_budget = 0
+    syn.scan_local(binding.sb)
+    index = check_state_index()
+    new = index.get_by_path('/Folder 1/New.txt')
+    assert_equal(new.local_digest, None)
+    assert_equal(index.find_files(None), [])
+    pairs = dict((s.local_path, s) for s in session.query(LastKnownState))
+    for path in ('/Folder 0/File 0.txt', '/Folder 1/New.txt'):
+        assert_equal(syn._detect_local_move_or_rename(
+            pairs[path], session, None, None, None, None), (None, None))
+
+
+@with_binding
+def test_state_index_other_sessions():
+    make_remote_tree()
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    syn.synchronize()
+    session = binding.ctl.get_session()
+    index = get_state_index(session, binding.local_folder)
+    state_id = index.get_by_path('/Folder 0/File 0.txt').id
+
+    # The changes flushed by another thread are only seen once committed
+    flushed, commit, done = Event(), Event(), Event()
+
+    def rename():
+        other_session = binding.ctl.get_session()
+        state = other_session.query(LastKnownState).get(state_id)
+        state.local_path = '/Folder 0/Renamed.txt'
+        other_session.flush()
+        flushed.set()
+        commit.wait(5.0)
+        other_session.commit()
+        done.set()
+
+    thread = Thread(target=rename)
+    thread.start()
+    try:
+        assert_true(flushed.wait(5.0))
+        index = get_state_index(session, binding.local_folder)
+        assert_equal(index.get_by_path('/Folder 0/File 0.txt').id, state_id)
+        assert_equal(index.get_by_path('/Folder 0/Renamed.txt'), None)
+    finally:
+        commit.set()
+        thread.join()
+    assert_true(done.is_set())
+    index = check_state_index()
+    assert_equal(index.get_by_path('/Folder 0/Renamed.txt').id, state_id)
+
+    # Dropped when a binding worker starts or stops, loaded again on use
+    forget_state_index(session, binding.local_folder)
+    assert_true(get_state_index(session, binding.local_folder) is not index)
+
+
+@with_binding
+def test_state_index_other_process():
+    make_remote_tree()
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    syn.synchronize()
+    session = binding.ctl.get_session()
+    index = get_state_index(session, binding.local_folder)
+    last = max(index._records.values(), key=lambda record: record.id)
+
+    # Another process deletes the last state and creates a new one that
+    # reuses its id
+    other = Controller(binding.conf_folder)
+    commits = StateIndexes.commits
+    try:
+        other_session = other.get_session()
+        other_session.delete(other_session.query(LastKnownState).get(last.id))
+        other_session.commit()
+        other_session.add(LastKnownState(
+            binding.local_folder,
+            local_info=LocalClient(binding.local_folder).get_info('/Folder 0'),
+            local_state='synchronized'))
+        other_session.commit()
+        reused = other_session.query(LastKnownState).filter_by(
+            local_path='/Folder 0').filter(
+                LastKnownState.remote_ref == None).one()
+        assert_equal(reused.id, last.id)
+    finally:
+        other.dispose()
+        # Only the SQLite data version tells about the commits of others
+        StateIndexes.commits = commits
+    index = check_state_index()
+    assert_equal(index.get_by_path(last.local_path), None)
+    new = [r for r in index.get_children('/') if r.remote_ref is None]
+    assert_equal([r.id for r in new], [last.id])
@@ -0,0 +1,209 @@
+import os
+import time
+from threading import Lock
+from threading import Thread
+from threading import current_thread
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_true
+
+from nxdrive.client import LocalClient
+from nxdrive.model import LastKnownState
+from nxdrive.tests.common import FakeRemoteFileSystemClient
+from nxdrive.tests.common import binding
+from nxdrive.tests.common import setup_binding
+from nxdrive.tests.common import teardown_binding
+
+
+queries = []
+
+
+def setup_counting_binding():
+    """Bind a temporary folder and count the queries of the pending list"""
+    setup_binding()
+    del queries[:]
+    list_pending = binding.ctl.list_pending
+
+    def counting_list_pending(*args, **kwargs):
+        pending = list_pending(*args, **kwargs)
+        queries.append(len(pending))
+        return pending
+
+    binding.ctl.list_pending = counting_list_pending
+
+
+with_binding = with_setup(setup_counting_binding, teardown_binding)
+
+
+@with_binding
+def test_synchronize_pending_page():
+    for i in range(10):
+        FakeRemoteFileSystemClient.add('root', 'File %d.txt' % i,
+                                       content="Content %d" % i)
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    assert_equal(syn.synchronize(), 10)
+
+    # A single page for all the files, then a check that nothing is left
+    assert_equal(queries, [10, 0])
+    local = LocalClient(binding.local_folder)
+    assert_equal(local.get_content('/File 3.txt'), "Content 3")
+    assert_equal(len(binding.ctl.list_pending()), 0)
+
+
+@with_binding
+def test_synchronize_pending_limit():
+    for i in range(10):
+        FakeRemoteFileSystemClient.add('root', 'File %d.txt' % i)
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    syn.limit_pending = 4
+    assert_equal(syn.synchronize(limit=6), 6)
+    assert_equal(queries, [4, 4])
+    assert_equal(len(binding.ctl.list_pending()), 4)
+
+
+@with_binding
+def test_synchronize_pending_folders():
+    for i in range(2):
+        folder = FakeRemoteFileSystemClient.add('root', 'Folder %d' % i,
+                                                folderish=True)
+        for j in range(3):
+            FakeRemoteFileSystemClient.add(folder, 'File %d.txt' % j,
+                                           content="Content %d" % j)
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    assert_equal(syn.synchronize(), 8)
+
+    # The pending list is queried again after each folder creation
+    assert_equal(queries, [8, 7, 6, 0])
+    local = LocalClient(binding.local_folder)
+    assert_equal(local.get_content('/Folder 1/File 2.txt'), "Content 2")
+    assert_equal(len(binding.ctl.list_pending()), 0)
+
+
+
+class SlowDownloadClient(FakeRemoteFileSystemClient):
+
+    threads = set()
+
+    def get_content(self, fs_item_id, file_out=None, fs_item_info=None):
+        self.threads.add(current_thread().name)
+        # Make the transfers overlap
+        time.sleep(0.01)
+        return super(SlowDownloadClient, self).get_content(
+            fs_item_id, file_out=file_out, fs_item_info=fs_item_info)
+
+
+def get_remote_content(name):
+    uids = [uid for uid, info in FakeRemoteFileSystemClient.tree.items()
+            if info.name == name]
+    assert_equal(len(uids), 1)
+    return FakeRemoteFileSystemClient.contents[uids[0]]
+
+
+@with_binding
+def test_concurrent_transfers():
+    binding.ctl.remote_fs_client_factory = SlowDownloadClient
+    SlowDownloadClient.threads.clear()
+    for i in range(6):
+        FakeRemoteFileSystemClient.add('root', 'Remote %d.txt' % i,
+                                       content="Remote content %d" % i)
+    folder = FakeRemoteFileSystemClient.add('root', 'Folder', folderish=True)
+    FakeRemoteFileSystemClient.add(folder, 'Nested.txt',
+                                   content="Nested content")
+    # Downloads to the same local name are not run concurrently
+    FakeRemoteFileSystemClient.add('root', 'Remote 5.txt',
+                                   content="Duplicated name")
+    local = LocalClient(binding.local_folder)
+    for i in range(4):
+        local.make_file('/', 'Local %d.txt' % i, "Local content %d" % i)
+
+    syn = binding.ctl.synchronizer
+    syn.transfer_workers = 3
+    syn.scan_local(binding.sb)
+    syn.scan_remote(binding.sb)
+    assert_equal(syn.synchronize(), 13)
+    assert_equal(len(binding.ctl.list_pending()), 0)
+    assert_true(any(name.startswith('TransferWorker')
+                    for name in SlowDownloadClient.threads))
+
+    for i in range(5):
+        assert_equal(local.get_content('/Remote %d.txt' % i),
+                     "Remote content %d" % i)
+    assert_equal(local.get_content('/Folder/Nested.txt'), "Nested content")
+    duplicates = [local.get_content('/' + name)
+                  for name in os.listdir(binding.local_folder)
+                  if name.startswith('Remote 5')]
+    assert_equal(sorted(duplicates), ["Duplicated name", "Remote content 5"])
+    for i in range(4):
+        assert_equal(get_remote_content('Local %d.txt' % i),
+                     "Local content %d" % i)
+
+    # Updates on both sides
+    remote_uid = [uid for uid, info in FakeRemoteFileSystemClient.tree.items()
+                  if info.name == 'Remote 0.txt'][0]
+    remote = binding.ctl.get_remote_fs_client(binding.sb)
+    remote.update_content(remote_uid, "Updated remotely")
+    time.sleep(1)
+    local.update_content('/Local 0.txt', "Updated locally")
+    syn.scan_local(binding.sb)
+    syn.scan_remote(binding.sb)
+    assert_equal(syn.synchronize(), 2)
+    assert_equal(local.get_content('/Remote 0.txt'), "Updated remotely")
+    assert_equal(get_remote_content('Local 0.txt'), "Updated locally")
+
+
+@with_binding
+def test_inline_transfers():
+    syn = binding.ctl.synchronizer
+    lock = Lock()
+    active, max_active, results = [], [0], []
+
+    def transfer(remote_client, i):
+        with lock:
+            active.append(i)
+            max_active[0] = max(max_active[0], len(active))
+        # Make the transfers overlap
+        time.sleep(0.01)
+        with lock:
+            active.remove(i)
+        return i
+
+    # Without transfer workers, the bindings synchronized by their own
+    # threads transfer one file at a time
+    threads = [Thread(target=syn._transfer,
+                      args=(None, None, i, transfer, results.append, i))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equal(sorted(results), range(4))
+    assert_equal(max_active[0], 1)
+
+
+class TruncatedDownloadClient(FakeRemoteFileSystemClient):
+
+    def get_content(self, fs_item_id, file_out=None, fs_item_info=None):
+        # The connection is closed before the end of the body
+        content = self.contents[fs_item_id]
+        file_out.write(content[:len(content) // 2])
+
+
+@with_binding
+def test_truncated_download():
+    binding.ctl.remote_fs_client_factory = TruncatedDownloadClient
+    FakeRemoteFileSystemClient.add('root', 'Remote.txt',
+                                   content="Remote content")
+    syn = binding.ctl.synchronizer
+    syn.scan_remote(binding.sb)
+    syn.synchronize()
+
+    # Nothing is written and the pair is left to synchronize again later
+    assert_equal(os.listdir(binding.local_folder), [])
+    session = binding.ctl.get_session()
+    pair = session.query(LastKnownState).filter_by(
+        remote_name='Remote.txt').one()
+    assert_equal(pair.pair_state, 'remotely_created')
+    assert_true(pair.last_sync_error_date is not None)
@@ -0,0 +1,222 @@
+import os
+import time
+import hashlib
+import tempfile
+import shutil
+from threading import Event
+from nose import with_setup
+from nose.tools import assert_equal
+from nose.tools import assert_false
+from nose.tools import assert_raises
+from nose.tools import assert_true
+
+from nxdrive.client import LocalClient
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.workers import DigestPool
+from nxdrive.workers import DigestPostponed
+from nxdrive.workers import Future
+from nxdrive.workers import TreeWalker
+from nxdrive.workers import WorkerPool
+from nxdrive.tests.common import FakeRemoteFileSystemClient
+from nxdrive.tests.common import binding
+from nxdrive.tests.common import with_binding
+
+
+LOCAL_TEST_FOLDER = None
+lcclient = None
+
+
+def setup_temp_folder():
+    global lcclient, LOCAL_TEST_FOLDER
+    LOCAL_TEST_FOLDER = tempfile.mkdtemp('-nuxeo-drive-tests')
+    lcclient = LocalClient(LOCAL_TEST_FOLDER)
+
+
+def teardown_temp_folder():
+    if os.path.exists(LOCAL_TEST_FOLDER):
+        shutil.rmtree(LOCAL_TEST_FOLDER)
+
+
+with_temp_folder = with_setup(setup_temp_folder, teardown_temp_folder)
+
+
+def make_tree(parent='/', depth=3, width=3):
+    for i in range(width):
+        lcclient.make_file(parent, 'File %d.txt' % i, content="Content %d" % i)
+        if depth > 1:
+            folder = lcclient.make_folder(parent, 'Folder %d' % i)
+            make_tree(folder, depth - 1, width)
+
+
+def walk(client, path='/'):
+    paths = []
+    for child in client.get_children_info(path):
+        paths.append(child.path)
+        if child.folderish:
+            paths.extend(walk(client, child.path))
+    return paths
+
+
+def test_future():
+    future = Future(lambda x: x * 2, 21)
+    assert_false(future.done())
+    assert_true(future.run())
+    # A task is only executed once
+    assert_false(future.run())
+    assert_true(future.done())
+    assert_equal(future.result(), 42)
+
+    def fail():
+        raise OSError("Cannot list folder")
+
+    future = Future(fail)
+    future.run()
+    assert_raises(OSError, future.result)
+
+
+def test_worker_pool():
+    pool = WorkerPool(4, max_queued=10)
+    try:
+        futures = [pool.submit(pow, i, 2) for i in range(20)]
+        assert_equal([f.result() for f in futures],
+                     [i ** 2 for i in range(20)])
+    finally:
+        pool.stop()
+
+
+def test_worker_pool_full_queue():
+    started, blocked = Event(), Event()
+
+    def block():
+        started.set()
+        blocked.wait()
+
+    pool = WorkerPool(1, max_queued=1)
+    try:
+        pool.submit(block)
+        started.wait()
+        assert_true(pool.put(Future(int), block=False))
+        assert_false(pool.put(Future(int), block=False))
+    finally:
+        blocked.set()
+        pool.stop()
+
+
+@with_temp_folder
+def test_tree_walker():
+    make_tree()
+    expected = walk(lcclient)
+    assert_equal(len(expected), 51)
+
+    for max_prefetched in (1, 1000):
+        pool = WorkerPool(4)
+        try:
+            walker = TreeWalker(lcclient.get_children_info, pool,
+                                max_prefetched=max_prefetched)
+            walker.prefetch('/')
+            assert_equal(walk(walker), expected)
+            assert_equal(walker.prefetched + walker.listed_inline, 13)
+        finally:
+            pool.stop()
+
+
+@with_temp_folder
+def test_digest_pool():
+    for i in range(4):
+        lcclient.make_file('/', 'File %d.txt' % i, content="0123456789")
+    infos = lcclient.get_children_info('/')
+
+    pool = WorkerPool(2)
+    try:
+        digests = DigestPool(pool, byte_budget=25)
+        for info in infos:
+            digests.submit(info)
+        assert_equal(digests.submitted, 2)
+        assert_equal(digests.submitted_bytes, 20)
+        assert_equal(digests.postponed, 2)
+
+        expected = hashlib.md5("0123456789").hexdigest()
+        assert_equal(infos[0].get_digest(), expected)
+        assert_equal(infos[1].get_digest(), expected)
+        # Files beyond the byte budget are handled as if they were being
+        # written by another process
+        assert_raises(DigestPostponed, infos[2].get_digest)
+        assert_true(isinstance(DigestPostponed(), IOError))
+    finally:
+        pool.stop()
+
+
+@with_temp_folder
+def test_parallel_local_scan():
+    make_tree()
+    conf_folder = tempfile.mkdtemp('-nuxeo-drive-conf')
+    ctl = Controller(conf_folder)
+    try:
+        session = ctl.get_session()
+        sb = ServerBinding(LOCAL_TEST_FOLDER, 'http://localhost:8080/nuxeo/',
+                           'Administrator', remote_password='Administrator')
+        session.add(sb)
+        session.add(LastKnownState(LOCAL_TEST_FOLDER,
+                                   local_info=lcclient.get_info('/'),
+                                   local_state='synchronized'))
+        session.commit()
+
+        ctl.synchronizer.local_scan_workers = 4
+        ctl.synchronizer.digest_workers = 2
+        ctl.synchronizer.scan_local(sb, session=session)
+        states = session.query(LastKnownState).all()
+        paths = sorted(s.local_path for s in states)
+        assert_equal(paths, sorted(['/'] + walk(lcclient)))
+        for state in states:
+            if not state.folderish:
+                assert_equal(state.local_digest, hashlib.md5(
+                    "Content %s" % state.local_name[5]).hexdigest())
+
+        # A budget exhausted scan postpones the digests to the next scan
+        lcclient.make_file('/', 'New File.txt', content="Some content.")
+        ctl.synchronizer.scan_digest_budget = 0
+        ctl.synchronizer.scan_local(sb, session=session)
+        new_state = session.query(LastKnownState).filter_by(
+            local_path='/New File.txt').one()
+        assert_equal(new_state.local_digest, None)
+        ctl.synchronizer.scan_digest_budget = None
+        ctl.synchronizer.scan_local(sb, session=session)
+        assert_equal(new_state.local_digest,
+                     hashlib.md5("Some content.").hexdigest())
+    finally:
+        ctl.dispose()
+        shutil.rmtree(conf_folder)
+
+
+@with_binding
+def test_postponed_digest_of_modified_file():
+    uid = FakeRemoteFileSystemClient.add('root', 'File.txt',
+                                         content="Some content.")
+    syn = binding.ctl.synchronizer
+    syn.digest_workers = 2
+    syn.scan_remote(binding.sb)
+    syn.synchronize()
+    assert_equal(binding.local.get_content('/File.txt'), "Some content.")
+
+    # The modified file is beyond the scan budget
+    binding.local.update_content('/File.txt', "Some other content.")
+    mtime = time.time() + 10
+    os.utime(binding.local._abspath('/File.txt'), (mtime, mtime))
+    syn.scan_digest_budget = 0
+    syn.scan_local(binding.sb)
+    syn.synchronize()
+    assert_equal(FakeRemoteFileSystemClient.contents[uid], "Some content.")
+
+    # The modification is detected again once the digest is computed
+    syn.scan_digest_budget = None
+    syn.scan_local(binding.sb)
+    syn.synchronize()
+    assert_equal(FakeRemoteFileSystemClient.contents[uid],
+                 "Some other content.")
+    session = binding.ctl.get_session()
+    pair = session.query(LastKnownState).filter_by(remote_ref=uid).one()
+    assert_equal(pair.pair_state, 'synchronized')
+    assert_equal(pair.local_digest,
+                 hashlib.md5("Some other content.").hexdigest())
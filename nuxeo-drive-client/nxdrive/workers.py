@@ -0,0 +1,250 @@
+"""Thread pools to overlap file system and network latencies.
+
+Workers only perform I/O and never access the SQLAlchemy session: their
+results are consumed by the synchronization thread that remains the single
+writer of the state database.
+"""
+
+import sys
+import time
+from threading import Event
+from threading import Lock
+from threading import Thread
+from Queue import Queue
+from Queue import Full
+from Queue import Empty
+
+from nxdrive.logging_config import get_logger
+
+
+log = get_logger(__name__)
+
+
+class Future(object):
+    """Result of a task that can be run either by a worker or inline
+
+    The first caller of run executes the task. This makes it possible for the
+    consumer of a queued task to execute it in its own thread instead of
+    waiting for a worker to pick it up.
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._started = False
+        self._lock = Lock()
+        self._done = Event()
+        self._result = None
+        self._exc_info = None
+
+    def run(self):
+        """Execute the task if not already started, return True if so"""
+        with self._lock:
+            if self._started:
+                return False
+            self._started = True
+        try:
+            self._result = self._func(*self._args, **self._kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            # Release references as soon as possible
+            self._func = self._args = self._kwargs = None
+            self._done.set()
+        return True
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        """Wait for the task to complete and return its result
+
+        Exceptions raised by the task are raised again in the calling thread.
+        """
+        self._done.wait()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class WorkerPool(object):
+    """Fixed number of daemon threads consuming a bounded queue of tasks"""
+
+    def __init__(self, n_workers, max_queued=1000, name='Worker'):
+        if n_workers < 1:
+            raise ValueError("Invalid number of workers: %r" % n_workers)
+        self._queue = Queue(max_queued)
+        self._threads = []
+        for i in range(n_workers):
+            thread = Thread(target=self._work, name='%s-%d' % (name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, future, block=True):
+        """Queue a future, return False if the queue is full and not block"""
+        try:
+            self._queue.put(future, block)
+        except Full:
+            return False
+        return True
+
+    def submit(self, func, *args, **kwargs):
+        future = Future(func, *args, **kwargs)
+        self.put(future)
+        return future
+
+    def _work(self):
+        while True:
+            future = self._queue.get()
+            if future is None:
+                return
+            future.run()
+
+    def stop(self):
+        """Discard pending tasks and wait for the running ones"""
+        while True:
+            try:
+                self._queue.get_nowait()
+            except Empty:
+                break
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        del self._threads[:]
+
+
+class TreeWalker(object):
+    """Prefetch the children of the folders of a tree with a worker pool
+
+    The walker is a drop-in replacement for the get_children_info method of
+    a client: listings are prefetched breadth-first by the workers while the
+    consumer walks the tree in its own order. Folders that are not yet
+    prefetched are listed inline by the consumer so that it never waits on a
+    full queue. At most max_prefetched listings are kept in memory.
+
+    get_key extracts the argument of list_children from a child info, the
+    path by default.
+    """
+
+    def __init__(self, list_children, pool, get_key=None,
+                 max_prefetched=1000):
+        self._list_children = list_children
+        self._pool = pool
+        self._get_key = (get_key if get_key is not None
+                         else lambda info: info.path)
+        self._max_prefetched = max_prefetched
+        self._futures = {}
+        self._lock = Lock()
+        self.prefetched = 0
+        self.listed_inline = 0
+        self.folders = 0
+        self.items = 0
+        self._start_time = time.time()
+
+    def get_stats(self):
+        """Progress and throughput counters of the walk"""
+        with self._lock:
+            elapsed = time.time() - self._start_time
+            return {
+                'folders': self.folders,
+                'items': self.items,
+                'prefetched': self.prefetched,
+                'listed_inline': self.listed_inline,
+                'pending': len(self._futures),
+                'elapsed': elapsed,
+                'items_per_second': self.items / elapsed if elapsed else 0.0,
+            }
+
+    def prefetch(self, key):
+        """Schedule the listing of a folder if there is room for it"""
+        with self._lock:
+            if (key in self._futures
+                    or len(self._futures) >= self._max_prefetched):
+                return False
+            future = Future(self._list, key)
+            self._futures[key] = future
+        if not self._pool.put(future, block=False):
+            with self._lock:
+                self._futures.pop(key, None)
+            return False
+        return True
+
+    def _list(self, key):
+        children = self._list_children(key)
+        with self._lock:
+            self.folders += 1
+            self.items += len(children)
+        for child in children:
+            if child.folderish:
+                self.prefetch(self._get_key(child))
+        return children
+
+    def get_children_info(self, key):
+        with self._lock:
+            future = self._futures.pop(key, None)
+            if future is None:
+                self.listed_inline += 1
+        if future is None:
+            return self._list(key)
+        ran_inline = future.run()
+        with self._lock:
+            if ran_inline:
+                self.listed_inline += 1
+            else:
+                self.prefetched += 1
+        return future.result()
+
+
+class DigestPostponed(IOError):
+    """The digest of a file is not computed to preserve the scan budget
+
+    Subclass of IOError so that it is handled as a file being written by
+    another process: the digest computation is postponed to a later scan.
+    """
+
+
+class DigestPool(object):
+    """Hash the content of local files ahead of their use by a scan
+
+    Digests are computed by the workers of the pool as soon as the files are
+    listed so that hashing overlaps with the rest of the scan. Each scan is
+    granted a byte budget: the digests of the files submitted once the
+    budget is exhausted are postponed so that a huge import cannot block the
+    synchronization loop for hours.
+    """
+
+    def __init__(self, pool, byte_budget=None):
+        self._pool = pool
+        self._remaining = byte_budget
+        self.submitted = 0
+        self.submitted_bytes = 0
+        self.postponed = 0
+
+    def submit(self, info):
+        """Schedule the digest computation of a file info"""
+        if info.folderish or info.get_cached_digest() is not None:
+            return
+        try:
+            size = info.get_size()
+        except OSError:
+            # Deleted in the mean time: let the scan handle it
+            return
+        if self._remaining is not None:
+            if size > self._remaining:
+                self.postponed += 1
+                info.defer_digest(Future(self._postpone, info))
+                return
+            self._remaining -= size
+        self.submitted += 1
+        self.submitted_bytes += size
+        future = Future(info.compute_digest)
+        info.defer_digest(future)
+        # If the queue is full, the future is run inline when needed
+        self._pool.put(future, block=False)
+
+    def _postpone(self, info):
+        raise DigestPostponed("Digest of %s postponed: scan byte budget"
+                              " exhausted" % info.filepath)
@@ -19,6 +19,7 @@ package org.nuxeo.drive.service.impl;
 import java.io.Serializable;
 
 import org.codehaus.jackson.annotate.JsonIgnore;
+import org.codehaus.jackson.annotate.JsonProperty;
 import org.nuxeo.drive.adapter.FileSystemItem;
 
 /**
@@ -123,6 +124,11 @@ public class FileSystemItemChange implements Serializable {
         this.docUuid = docUuid;
     }
 
+    /**
+     * Serialized along with the change so that clients do not need to fetch
+     * the changed item again, the setter being ignored by deserialization.
+     */
+    @JsonProperty
     public FileSystemItem getFileSystemItem() {
         return fileSystemItem;
     }
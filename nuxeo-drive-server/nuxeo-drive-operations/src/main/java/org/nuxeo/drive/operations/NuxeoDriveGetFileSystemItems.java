@@ -0,0 +1,68 @@
+/*
+ * (C) Copyright 2013 Nuxeo SA (http://nuxeo.com/) and contributors.
+ *
+ * All rights reserved. This program and the accompanying materials
+ * are made available under the terms of the GNU Lesser General Public License
+ * (LGPL) version 2.1 which accompanies this distribution, and is available at
+ * http://www.gnu.org/licenses/lgpl.html
+ *
+ * This library is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+ * Lesser General Public License for more details.
+ */
+package org.nuxeo.drive.operations;
+
+import java.util.ArrayList;
+import java.util.List;
+
+import org.codehaus.jackson.map.ObjectMapper;
+import org.codehaus.jackson.type.TypeReference;
+import org.nuxeo.drive.adapter.FileSystemItem;
+import org.nuxeo.drive.service.FileSystemItemManager;
+import org.nuxeo.ecm.automation.OperationContext;
+import org.nuxeo.ecm.automation.core.Constants;
+import org.nuxeo.ecm.automation.core.annotations.Context;
+import org.nuxeo.ecm.automation.core.annotations.Operation;
+import org.nuxeo.ecm.automation.core.annotations.OperationMethod;
+import org.nuxeo.ecm.automation.core.annotations.Param;
+import org.nuxeo.ecm.core.api.Blob;
+import org.nuxeo.runtime.api.Framework;
+
+/**
+ * Get the {@link FileSystemItem}s with the given ids, passed as a JSON array
+ * of strings, for the currently authenticated user, in the same order. A null
+ * item is returned for each id that does not match any item.
+ * <p>
+ * Spares a request per item to the clients refreshing a batch of changed
+ * items.
+ */
+@Operation(id = NuxeoDriveGetFileSystemItems.ID, category = Constants.CAT_SERVICES, label = "Nuxeo Drive: Get file system items")
+public class NuxeoDriveGetFileSystemItems {
+
+    public static final String ID = "NuxeoDrive.GetFileSystemItems";
+
+    @Context
+    protected OperationContext ctx;
+
+    @Param(name = "ids")
+    protected String ids;
+
+    @OperationMethod
+    public Blob run() throws Exception {
+
+        FileSystemItemManager fileSystemItemManager = Framework.getLocalService(FileSystemItemManager.class);
+        // The ids are built from repository names and document ids, hence
+        // may contain any character
+        List<String> idList = new ObjectMapper().readValue(ids,
+                new TypeReference<List<String>>() {
+                });
+        List<FileSystemItem> fsItems = new ArrayList<FileSystemItem>();
+        for (String id : idList) {
+            fsItems.add(fileSystemItemManager.getFileSystemItemById(id,
+                    ctx.getPrincipal()));
+        }
+        return NuxeoDriveOperationHelper.asJSONBlob(fsItems);
+    }
+
+}
@@ -24,6 +24,7 @@ import static org.junit.Assert.assertTrue;
 import static org.junit.Assert.fail;
 
 import java.io.Serializable;
+import java.util.Arrays;
 import java.util.HashMap;
 import java.util.Iterator;
 import java.util.List;
@@ -362,6 +363,35 @@ public class TestFileSystemItemOperations {
                 Object.class));
     }
 
+    @Test
+    public void testGetFileSystemItems() throws Exception {
+
+        // Get sync root, file in sync root and deleted file at once
+        file2.followTransition("delete");
+        session.save();
+        String syncRootId = SYNC_ROOT_FOLDER_ITEM_ID_PREFIX + syncRoot1.getId();
+        String file1Id = DEFAULT_FILE_SYSTEM_ITEM_ID_PREFIX + file1.getId();
+        String file2Id = DEFAULT_FILE_SYSTEM_ITEM_ID_PREFIX + file2.getId();
+        Blob fileSystemItemsJSON = (Blob) clientSession.newRequest(
+                NuxeoDriveGetFileSystemItems.ID).set(
+                "ids",
+                mapper.writeValueAsString(Arrays.asList(syncRootId, file2Id,
+                        file1Id))).execute();
+        assertNotNull(fileSystemItemsJSON);
+
+        List<Map<String, Object>> fileSystemItems = mapper.readValue(
+                fileSystemItemsJSON.getStream(),
+                new TypeReference<List<Map<String, Object>>>() {
+                });
+        assertNotNull(fileSystemItems);
+        assertEquals(3, fileSystemItems.size());
+        assertEquals(syncRootId, fileSystemItems.get(0).get("id"));
+        assertEquals("folder1", fileSystemItems.get(0).get("name"));
+        assertNull(fileSystemItems.get(1));
+        assertEquals(file1Id, fileSystemItems.get(2).get("id"));
+        assertEquals("First file.odt", fileSystemItems.get(2).get("name"));
+    }
+
     @Test
     public void testGetChildren() throws Exception {
 
@@ -0,0 +1,94 @@
+"""Time the first scans of a new binding, with and without bulk ingest
+
+The local tree is built with create_folders.make_folder_tree and mirrored
+on a fake remote file system. Each scan runs on a fresh configuration
+folder, the states being created one by one (ingest_chunk_size = 0) or
+inserted in bulk by the synchronizer. Usage::
+
+    python bench_initial_scan.py [n_folders] [ingest_chunk_size]
+
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+from StringIO import StringIO
+
+from create_folders import make_folder_tree
+from nxdrive.client import LocalClient
+from nxdrive.controller import Controller
+from nxdrive.model import LastKnownState
+from nxdrive.model import ServerBinding
+from nxdrive.tests.common import FakeRemoteFileSystemClient
+
+
+def make_trees(n_folders, local_folder):
+    # make_folder_tree prints each folder and file it creates
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        make_folder_tree(n_folders=n_folders, base_folder=local_folder)
+    finally:
+        sys.stdout = stdout
+
+    # Mirror the local tree on the fake remote file system
+    root = FakeRemoteFileSystemClient.reset()
+    client = LocalClient(local_folder)
+    folders = [('/', root)]
+    while folders:
+        path, uid = folders.pop()
+        for info in client.get_children_info(path):
+            if info.folderish:
+                folders.append((info.path, FakeRemoteFileSystemClient.add(
+                    uid, os.path.basename(info.path), folderish=True)))
+            else:
+                FakeRemoteFileSystemClient.add(
+                    uid, os.path.basename(info.path),
+                    content=client.get_content(info.path))
+    return root
+
+
+def time_scan(local_folder, root, scan, ingest_chunk_size):
+    conf_folder = tempfile.mkdtemp('-nuxeo-drive-bench')
+    ctl = Controller(conf_folder)
+    try:
+        ctl.remote_fs_client_factory = FakeRemoteFileSystemClient
+        session = ctl.get_session()
+        sb = ServerBinding(local_folder, 'http://localhost:8080/nuxeo/',
+                           'Administrator', remote_password='Administrator')
+        session.add(sb)
+        session.add(LastKnownState(
+            local_folder, local_info=LocalClient(local_folder).get_info('/'),
+            remote_info=FakeRemoteFileSystemClient.tree[root],
+            local_state='synchronized', remote_state='synchronized'))
+        session.commit()
+
+        syn = ctl.synchronizer
+        syn.ingest_chunk_size = ingest_chunk_size
+        start = time.time()
+        getattr(syn, scan)(sb)
+        duration = time.time() - start
+        n_states = session.query(LastKnownState).count() - 1
+        return n_states, duration
+    finally:
+        ctl.dispose()
+        shutil.rmtree(conf_folder)
+
+
+def main(n_folders=10, ingest_chunk_size=1000):
+    local_folder = tempfile.mkdtemp('-nuxeo-drive-bench')
+    try:
+        root = make_trees(n_folders, local_folder)
+        for scan in ('scan_local', 'scan_remote'):
+            for label, chunk_size in (('before', 0),
+                                      ('after', ingest_chunk_size)):
+                n_states, duration = time_scan(local_folder, root, scan,
+                                               chunk_size)
+                print("%-11s %-6s %d states in %.2fs (%.0f states/s)" % (
+                    scan, label, n_states, duration, n_states / duration))
+    finally:
+        shutil.rmtree(local_folder)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
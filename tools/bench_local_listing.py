@@ -0,0 +1,106 @@
+"""Count the file system calls per entry of LocalClient.get_children_info
+
+Compare the current implementation with the previous one that called
+get_info, and hence os.path.exists, os.path.isdir and os.stat, for each
+child. Usage::
+
+    python bench_local_listing.py [n_files] [n_folders]
+
+"""
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from nxdrive.client import LocalClient
+from nxdrive.client import NotFound
+from nxdrive.client import local_client
+
+
+COUNTED_FUNCTIONS = [
+    (os, 'stat'),
+    (os, 'lstat'),
+    (os, 'listdir'),
+]
+if local_client.scandir is not None:
+    COUNTED_FUNCTIONS.append((local_client, 'scandir'))
+
+
+def legacy_get_children_info(client, ref):
+    """Listing as implemented before the single stat optimization"""
+    os_path = client._abspath(ref)
+    result = []
+    children = os.listdir(os_path)
+    children.sort()
+    for child_name in children:
+        if not client.is_ignored(child_name):
+            if ref == '/':
+                child_ref = ref + child_name
+            else:
+                child_ref = ref + '/' + child_name
+            child_os_path = client._abspath(child_ref)
+            try:
+                if not os.path.exists(child_os_path):
+                    raise NotFound(child_ref)
+                os.path.isdir(child_os_path)
+                stat_info = os.stat(child_os_path)
+                result.append(client._make_info(child_ref, stat_info))
+            except (OSError, NotFound):
+                pass
+    return result
+
+
+def count_calls(func, *args):
+    counts = dict((name, 0) for _, name in COUNTED_FUNCTIONS)
+    originals = []
+
+    def make_wrapper(name, original):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return original(*args, **kwargs)
+        return wrapper
+
+    for module, name in COUNTED_FUNCTIONS:
+        original = getattr(module, name)
+        originals.append((module, name, original))
+        setattr(module, name, make_wrapper(name, original))
+    try:
+        func(*args)
+    finally:
+        for module, name, original in originals:
+            setattr(module, name, original)
+    return counts
+
+
+def report(label, func, client, n_entries):
+    counts = count_calls(func, client, '/')
+    duration = min(timeit.repeat(lambda: func(client, '/'),
+                                 number=10, repeat=3)) / 10
+    total = sum(counts.values())
+    details = ", ".join("%s: %d" % item for item in sorted(counts.items()))
+    print("%-8s %.2f calls per entry (%s), %.2fms per listing" % (
+        label, float(total) / n_entries, details, duration * 1000))
+
+
+def main(n_files=1000, n_folders=100):
+    base_folder = tempfile.mkdtemp('-nuxeo-drive-bench')
+    try:
+        for i in range(n_files):
+            with open(os.path.join(base_folder, 'File %04d.txt' % i),
+                      'wb') as f:
+                f.write('Content %d' % i)
+        for i in range(n_folders):
+            os.mkdir(os.path.join(base_folder, 'Folder %04d' % i))
+        client = LocalClient(base_folder)
+        n_entries = n_files + n_folders
+        print("Listing %d entries, scandir module available: %s" % (
+            n_entries, local_client.scandir is not None))
+        report('before', legacy_get_children_info, client, n_entries)
+        report('after', LocalClient.get_children_info, client, n_entries)
+    finally:
+        shutil.rmtree(base_folder)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])